@@ -0,0 +1,50 @@
+import argparse
+import json
+import os
+import time
+
+from Crypto.Cipher import Salsa20
+
+from connection.ciphers import new_context
+
+
+def legacy_round_trip(token: bytes):
+    # The path used before cipher contexts: split the token and build a new
+    # Salsa20 cipher for every packet on both ends.
+    def algorithm(): return Salsa20.new(key=token[:-8], nonce=token[-8:])
+    return lambda packet: algorithm().decrypt(algorithm().encrypt(packet))
+
+
+def context_round_trip(name: str, token: bytes):
+    sender, receiver = new_context(name, token, True), new_context(name, token, False)
+    return lambda packet: receiver.decrypt(sender.encrypt(packet))
+
+
+def measure(round_trip, size: int, count: int) -> dict:
+    packet = os.urandom(size)
+    started = time.perf_counter()
+    for _ in range(count): round_trip(packet)
+    elapsed = time.perf_counter() - started
+    return dict(size=size, packets=count, us_per_packet=elapsed / count * 1e6,
+                mb_per_second=size * count / elapsed / 1e6)
+
+
+def main(arguments: list = None):
+    parser = argparse.ArgumentParser(description='Cipher microbenchmark (encrypt + decrypt)')
+    parser.add_argument('--sizes', default='64,512,1400', help='Packet sizes in bytes')
+    parser.add_argument('--count', type=int, default=20000, help='Packets per measurement')
+    args = parser.parse_args(arguments)
+    token = os.urandom(20).hex().encode()
+    candidates = {
+        'salsa20-per-packet': legacy_round_trip(token),
+        'salsa20-context': context_round_trip('salsa20', token),
+        'chacha20-poly1305': context_round_trip('chacha20-poly1305', token)
+    }
+    results = {name: [measure(round_trip, int(size), args.count)
+                      for size in args.sizes.split(',')]
+               for name, round_trip in candidates.items()}
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
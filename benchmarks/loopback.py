@@ -0,0 +1,251 @@
+import argparse
+import gc
+import json
+import multiprocessing
+import os
+import platform
+import socket
+import struct
+import subprocess
+import threading
+import time
+import tracemalloc
+
+from connection import VPNClient, VPNServer
+from connection.cluster import VPNCluster
+from connection.database import open_client
+from connection.database.mongodb import Account, Network
+
+# Timestamp and sequence number carried in every payload.
+PROBE = struct.Struct('!dI')
+
+
+class SocketDevice:
+    # Stands in for a TUN device: the client engine reads and writes one end
+    # of a datagram socketpair and the benchmark the other one.
+    def __init__(self, mtu: int = 1500):
+        self.device, self.peer = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.mtu = mtu
+        # Queue about as many packets as a TUN device would.
+        for end in (self.device, self.peer):
+            end.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4 << 20)
+            end.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 << 20)
+
+    def fileno(self) -> int:
+        return self.device.fileno()
+
+    def close(self):
+        self.device.close(), self.peer.close()
+
+
+class ClusterServer(VPNServer):
+    # Server of a cluster worker, it tells the benchmark once it is bound to
+    # the shared port.
+    ready = None
+
+    def prepare_storage(self):
+        self.ready.release()
+        return super().prepare_storage()
+
+
+def ipv4_packet(source: str, destination: str, payload: bytes) -> bytes:
+    # IPv4 + UDP headers, checksums are left empty as nothing checks them.
+    udp = struct.pack('!HHHH', 40000, 9, 8 + len(payload), 0)
+    header = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 28 + len(payload), 0, 0, 64, 17, 0,
+                         socket.inet_aton(source), socket.inet_aton(destination))
+    return header + udp + payload
+
+
+def percentile(samples: list, quantile: float) -> float:
+    return samples[min(int(len(samples) * quantile), len(samples) - 1)] if samples else 0.0
+
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def git_commit() -> str or None:
+    try: return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError): return None
+
+
+class Scenario:
+    def __init__(self, clients: int, size: int, packets: int, engine: str, cipher: str, rate: float = 0,
+                 coalesce: bool = True, compression: str = None, workers: int = 0):
+        self.clients, self.size, self.packets = clients, size, packets
+        # Packets per second sent by each client, 0 sends as fast as possible.
+        self.engine, self.cipher, self.rate = engine, cipher, rate
+        # Codec asked for by the clients, the padding compresses very well.
+        self.coalesce, self.compression = coalesce, compression
+        # With workers the server runs as a VPNCluster of that many processes.
+        self.workers, self.cluster = workers, None
+        self.sending, self.last_received = False, 0.0
+        self.server: VPNServer or None = None
+        self.thread: threading.Thread or None = None
+        self.endpoints: list[tuple[VPNClient, tuple, SocketDevice]] = []
+
+    def start_server(self) -> int:
+        database = open_client('memory://')
+        self.server = VPNServer(database, 'vpn-benchmark', engine=self.engine)
+        self.server.ip_address = '127.0.0.1'
+        network = Network(database['vpn-benchmark']['networks'])
+        network.create('10.0.0.0/16', self.clients)
+        for index in range(self.clients):
+            account = self.server.new_account(f'user-{index}', 'benchmark')
+            network.to_network(Account(database['vpn-benchmark']['accounts'], account['id']))
+        port = free_port()
+        if self.workers: return self.start_cluster(database, port)
+        self.thread = threading.Thread(target=self.server.run_server, args=(port,), daemon=True)
+        self.thread.start()
+        # Wait until the control plane is up.
+        while not self.server.handshakes.threads: time.sleep(0.01)
+        return port
+
+    def start_cluster(self, database, port: int) -> int:
+        # The workers are forked after the accounts were created, every one
+        # of them starts from a copy of the in-memory storage.
+        ClusterServer.ready = ready = multiprocessing.get_context('fork').Semaphore(0)
+
+        def new_server():
+            server = ClusterServer(database, 'vpn-benchmark', engine=self.engine)
+            server.ip_address = '127.0.0.1'
+            return server
+
+        self.cluster = VPNCluster(new_server, self.workers)
+        self.thread = threading.Thread(target=self.cluster.run_server, args=(port,), daemon=True)
+        self.thread.start()
+        # The clients connect once every worker is bound, so the kernel does
+        # not send them to another worker later.
+        [ready.acquire() for _ in range(self.workers)]
+        time.sleep(0.2)
+        return port
+
+    def connect(self, port: int) -> dict:
+        # Every client authenticates at the same time, the memory taken by
+        # the server for the new sessions is traced meanwhile.
+        clients = [VPNClient(('127.0.0.1', port)) for _ in range(self.clients)]
+        for client in clients:
+            client.ciphers, client.coalesce = [self.cipher], self.coalesce
+            client.compression = [self.compression] if self.compression else []
+        configurations = [None] * self.clients
+
+        def authenticate(index: int):
+            configurations[index] = clients[index].authenticate(f'user-{index}', 'benchmark')
+
+        threads = [threading.Thread(target=authenticate, args=(index,)) for index in range(self.clients)]
+        gc.collect(), tracemalloc.start()
+        baseline, started = tracemalloc.get_traced_memory()[0], time.perf_counter()
+        [thread.start() for thread in threads], [thread.join() for thread in threads]
+        elapsed = time.perf_counter() - started
+        gc.collect()
+        memory = tracemalloc.get_traced_memory()[0] - baseline
+        tracemalloc.stop()
+        for client, configuration in zip(clients, configurations):
+            device = SocketDevice()
+            client.start_engine([device], configuration[2])
+            self.endpoints.append((client, configuration, device))
+        return dict(handshakes_per_second=self.clients / elapsed,
+                    memory_per_session=memory / self.clients)
+
+    def receive(self, device: SocketDevice, expected: int, latencies: list, deadline: float):
+        # Stops once every packet arrived, or when the senders are done and
+        # nothing arrived for a second (the rest was lost).
+        device.peer.settimeout(1.0)
+        while len(latencies) < expected and time.perf_counter() < deadline:
+            try: packet = device.peer.recv(65535)
+            except socket.timeout:
+                if not self.sending: break
+                continue
+            received = time.perf_counter()
+            latencies.append(received - PROBE.unpack_from(packet, 28)[0])
+            self.last_received = max(self.last_received, received)
+
+    def send(self, index: int):
+        # Each client sends to the next one, a single client to itself.
+        _, source, device = self.endpoints[index]
+        destination = self.endpoints[(index + 1) % self.clients][1]
+        padding = b'\x00' * max(self.size - 28 - PROBE.size, 0)
+        started = time.perf_counter()
+        for sequence in range(self.packets):
+            if self.rate:
+                delay = started + sequence / self.rate - time.perf_counter()
+                if delay > 0: time.sleep(delay)
+            payload = PROBE.pack(time.perf_counter(), sequence) + padding
+            device.peer.send(ipv4_packet(source[0], destination[0], payload))
+
+    def forward(self, timeout: float) -> dict:
+        latencies = [[] for _ in self.endpoints]
+        deadline = time.perf_counter() + timeout
+        receivers = [threading.Thread(target=self.receive, args=(endpoint[2], self.packets, latencies[index], deadline))
+                     for index, endpoint in enumerate(self.endpoints)]
+        senders = [threading.Thread(target=self.send, args=(index,)) for index in range(self.clients)]
+        [thread.start() for thread in receivers]
+        self.sending, started = True, time.perf_counter()
+        self.last_received = started
+        [thread.start() for thread in senders], [thread.join() for thread in senders]
+        self.sending = False
+        [thread.join() for thread in receivers]
+        elapsed = self.last_received - started or 1e-9
+        samples = sorted(latency for values in latencies for latency in values)
+        received, sent = len(samples), self.packets * self.clients
+        result = dict(sent=sent, received=received, loss=1 - received / sent,
+                      packets_per_second=received / elapsed,
+                      mbps=received * self.size * 8 / elapsed / 1e6,
+                      latency_us=dict(p50=percentile(samples, 0.5) * 1e6, p99=percentile(samples, 0.99) * 1e6,
+                                      p999=percentile(samples, 0.999) * 1e6))
+        # The counters of cluster workers stay in their processes.
+        if self.cluster is not None: return result
+        forward_latency = self.server.metrics.latency
+        result.update(server_forward_us=dict(p50=forward_latency.quantile(0.5) * 1e6,
+                                             p99=forward_latency.quantile(0.99) * 1e6),
+                      server_dropped=getattr(self.server.engine, 'dropped', 0),
+                      compression_saved=sum(self.server.compressor.saved.values().values()))
+        return result
+
+    def stop(self):
+        for client, _, device in self.endpoints:
+            client.engine.stop(), client.socket_server.close(), device.close()
+        if self.cluster is not None: self.cluster.close()
+        else: self.server.close()
+        self.thread.join(5)
+
+    def run(self, timeout: float) -> dict:
+        try:
+            result = dict(clients=self.clients, size=self.size, engine=self.engine, workers=self.workers,
+                          cipher=self.cipher, rate=self.rate, coalesce=self.coalesce, compression=self.compression)
+            result.update(self.connect(self.start_server()))
+            result.update(self.forward(timeout))
+            return result
+        finally:
+            if self.server is not None: self.stop()
+
+
+def main(arguments: list = None):
+    parser = argparse.ArgumentParser(description='Loopback benchmark of the VPN data plane')
+    parser.add_argument('--clients', default='1,4', help='Comma separated client counts')
+    parser.add_argument('--sizes', default='64,512,1400', help='Packet sizes in bytes')
+    parser.add_argument('--packets', type=int, default=5000, help='Packets sent by each client')
+    parser.add_argument('--engine', default='threads', help='Server dispatch engine')
+    parser.add_argument('--cipher', default='chacha20-poly1305', help='Cipher offered by the clients')
+    parser.add_argument('--rate', type=float, default=0, help='Packets per second per client, 0 is unpaced')
+    parser.add_argument('--no-coalesce', dest='coalesce', action='store_false', help='Do not bundle small packets')
+    parser.add_argument('--compression', help='Compression codec asked for by the clients (zlib or lz4)')
+    parser.add_argument('--workers', default='0', help='Comma separated cluster worker counts, 0 is one process')
+    parser.add_argument('--timeout', type=float, default=30.0, help='Seconds to wait for each scenario')
+    parser.add_argument('--output', help='Also write the results to this file')
+    args = parser.parse_args(arguments)
+    results = [Scenario(int(clients), int(size), args.packets, args.engine, args.cipher, args.rate,
+                        args.coalesce, args.compression, int(workers)).run(args.timeout)
+               for workers in args.workers.split(',') for clients in args.clients.split(',')
+               for size in args.sizes.split(',')]
+    report = dict(commit=git_commit(), python=platform.python_version(), cpus=os.cpu_count(),
+                  packets=args.packets, results=results)
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as file: json.dump(report, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+import argparse
+import json
+import time
+
+from connection.database import open_client
+from connection.database.mongodb import Account, Connection, Network, create_indexes
+
+
+def populate(database, accounts: int):
+    # Accounts joined to one network, each with an open connection.
+    network = Network(database['networks'])
+    network.create('10.0.0.0/8', accounts)
+    connections = Connection(database['connections'])
+    for index in range(accounts):
+        account = Account(database['accounts'])
+        account.create(username=f'user-{index}', password='', networks={})
+        ip_address = network.to_network(account)
+        connections.create(network, account, ip_address, ('127.0.0.1', 10000 + index))
+    return network
+
+
+def measure(lookup, count: int) -> float:
+    started = time.perf_counter()
+    for index in range(count): lookup(index)
+    return (time.perf_counter() - started) / count * 1e6
+
+
+def run(uri: str, accounts: int, count: int) -> dict:
+    client = open_client(uri)
+    if hasattr(client, 'drop_database'): client.drop_database('vpn-benchmark')
+    database = client['vpn-benchmark']
+    create_indexes(database)
+    network = populate(database, accounts)
+    ids = [account['_id'] for account in database['accounts'].find({}, ['_id'])]
+    lookups = {
+        'connection_by_address': lambda i: Connection(database['connections']).get(
+            connection=f'127.0.0.1:{10000 + i % accounts}'),
+        'account_by_username': lambda i: Account(database['accounts']).get(
+            ['password', 'networks'], username=f'user-{i % accounts}'),
+        'connection_by_route': lambda i: Connection(database['connections']).get(
+            network_id=network.id, ip_address=f'10.0.{(i % accounts + 1) // 256}.{(i % accounts + 1) % 256}'),
+        'transfer_increment': lambda i: database['accounts'].update_one(
+            {'_id': ids[i % accounts]}, {'$inc': {'transfer_ratio': 1}})
+    }
+    return {name: measure(lookup, count) for name, lookup in lookups.items()}
+
+
+def main(arguments: list = None):
+    parser = argparse.ArgumentParser(description='Storage backend latency (us per operation)')
+    parser.add_argument('--backends', default='memory://', help='Comma separated storage URIs')
+    parser.add_argument('--accounts', type=int, default=2000)
+    parser.add_argument('--count', type=int, default=5000)
+    args = parser.parse_args(arguments)
+    results = {uri: run(uri, args.accounts, args.count) for uri in args.backends.split(',')}
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+import threading
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING: from pymongo.database import Database
+
+
+class TransferAccounting:
+    def __init__(self, database: 'Database', interval: float = 5.0, max_pending: int = 1024):
+        self.database = database
+        # Flush every `interval` seconds or as soon as `max_pending` counters
+        # are waiting, whatever happens first.
+        self.interval, self.max_pending = interval, max_pending
+        self.pending = dict(accounts={}, connections={})
+        self.lock = threading.Lock()
+        self.wakeup, self.running = threading.Event(), False
+        self.thread: threading.Thread or None = None
+
+    def add(self, account_id, connection_id, length: int):
+        with self.lock:
+            # Read the pending counters under the lock, flush() may swap them.
+            accounts, connections = self.pending['accounts'], self.pending['connections']
+            accounts[account_id] = accounts.get(account_id, 0) + length
+            connections[connection_id] = connections.get(connection_id, 0) + length
+            pending = len(accounts) + len(connections)
+        if pending >= self.max_pending: self.wakeup.set()
+
+    def restore(self, collection: str, counters: dict):
+        # Merge counters that could not be written back into the pending ones.
+        with self.lock:
+            pending = self.pending[collection]
+            for key, value in counters.items():
+                pending[key] = pending.get(key, 0) + value
+
+    def flush(self):
+        from pymongo import UpdateOne
+        # Swap the pending counters so the packet path never waits on the
+        # database.
+        with self.lock:
+            pending = self.pending
+            self.pending = dict(accounts={}, connections={})
+        for collection, counters in pending.items():
+            if not counters: continue
+            requests = [UpdateOne({'_id': key}, {'$inc': {'transfer_ratio': value}})
+                        for key, value in counters.items()]
+            try:
+                self.database[collection].bulk_write(requests, ordered=False)
+            except Exception:
+                self.restore(collection, counters)
+                raise
+
+    def run(self):
+        while self.running:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try: self.flush()
+            except Exception as error: print('Transfer accounting flush failed:', error)
+
+    def start(self):
+        if self.thread is not None: return self
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        # Stop the flush thread and write every pending counter.
+        self.running, thread, self.thread = False, self.thread, None
+        self.wakeup.set()
+        if thread is not None: thread.join()
+        self.flush()
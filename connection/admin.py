@@ -0,0 +1,157 @@
+import argparse
+import csv
+import json
+import multiprocessing
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator, TYPE_CHECKING
+
+from bson import ObjectId
+
+from connection.database.mongodb import Network
+from connection.handshake import new_process_pool
+
+if TYPE_CHECKING: from pymongo.database import Database
+
+# Fields returned by the listings unless others are asked for, password
+# hashes and the address maps of the networks are never listed by default.
+ACCOUNT_FIELDS = 'username', 'networks', 'transfer_ratio', 'rate_limit'
+NETWORK_FIELDS = 'network_range', 'subnet_mask', 'max_address', 'next_address', 'rate_limit'
+
+
+def hash_password(password: str, rounds: int = 10) -> str:
+    import bcrypt
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds)).decode('utf-8')
+
+
+def chunks(items: Iterable, size: int) -> Iterator[list]:
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk: yield chunk
+
+
+class AdminAPI:
+    def __init__(self, database: 'Database', processes: int = None, rounds: int = 10, batch_size: int = 1000):
+        # Passwords are hashed by a pool of processes and the documents
+        # written `batch_size` at a time.
+        self.database, self.processes, self.rounds = database, processes, rounds
+        self.batch_size = batch_size
+        self.pool: ProcessPoolExecutor or None = None
+
+    def new_pool(self) -> ProcessPoolExecutor:
+        if self.pool is None: self.pool = new_process_pool(self.processes)
+        return self.pool
+
+    def hash_passwords(self, passwords: list[str]) -> list[str]:
+        rounds = [self.rounds] * len(passwords)
+        chunksize = max(1, len(passwords) // (4 * (self.processes or multiprocessing.cpu_count())))
+        return list(self.new_pool().map(hash_password, passwords, rounds, chunksize=chunksize))
+
+    def create_accounts(self, users: Iterable[tuple[str, str]], network_id: str or ObjectId = None) -> dict:
+        # Create the accounts of (username, password) pairs, existing
+        # usernames are skipped. With a network id the new accounts also
+        # join it and get their addresses.
+        collection, created, skipped, addresses = self.database['accounts'], [], [], {}
+        for chunk in chunks(users, self.batch_size):
+            usernames = [username for username, _ in chunk]
+            existing = {account['username'] for account in
+                        collection.find({'username': {'$in': usernames}}, {'username': 1})}
+            chunk = [user for user in chunk if user[0] not in existing]
+            skipped += [username for username in usernames if username in existing]
+            if not chunk: continue
+            passwords = self.hash_passwords([password for _, password in chunk])
+            documents = [dict(_id=ObjectId(), username=username, password=password, networks={})
+                         for (username, _), password in zip(chunk, passwords)]
+            collection.insert_many(documents, ordered=False)
+            ids = [document['_id'] for document in documents]
+            created += ids
+            if network_id is not None: addresses.update(self.join_network(network_id, ids))
+        return dict(created=created, skipped=skipped, addresses=addresses)
+
+    def join_network(self, network_id: str or ObjectId, account_ids: Iterable) -> dict[str, str]:
+        network, addresses = Network(self.database['networks'], network_id), {}
+        for chunk in chunks(account_ids, self.batch_size):
+            addresses.update(network.join_many(self.database['accounts'], chunk))
+        return addresses
+
+    def create_network(self, network_range: str or tuple, max_address: int) -> ObjectId:
+        return Network(self.database['networks']).create(network_range, max_address)['id']
+
+    def stream(self, collection: str, fields: Iterable[str], page_size: int = None, after: str = None,
+               **filters) -> Iterator[dict]:
+        # Pages are read in _id order from the last _id returned, so every
+        # page is an index range scan however deep the listing goes.
+        page_size, after = page_size or self.batch_size, ObjectId(after) if after else None
+        while True:
+            page = self.find_page(collection, fields, page_size, after, filters)
+            yield from page
+            if len(page) < page_size: return
+            after = page[-1]['_id']
+
+    def find_page(self, collection: str, fields: Iterable[str], limit: int, after: ObjectId or None,
+                  filters: dict) -> list[dict]:
+        query = dict(filters, _id={'$gt': after}) if after else filters
+        return list(self.database[collection].find(query, list(fields)).sort('_id', 1).limit(limit))
+
+    def page(self, collection: str, fields: Iterable[str], page_size: int = 100, after: str = None,
+             **filters) -> tuple[list[dict], str or None]:
+        # One page and the cursor of the next one, None after the last page.
+        # One more document is read to tell whether there is a next page.
+        page = self.find_page(collection, fields, page_size + 1, ObjectId(after) if after else None, filters)
+        return page[:page_size], str(page[page_size - 1]['_id']) if len(page) > page_size else None
+
+    def accounts(self, fields: Iterable[str] = ACCOUNT_FIELDS, page_size: int = None, after: str = None,
+                 **filters) -> Iterator[dict]:
+        return self.stream('accounts', fields, page_size, after, **filters)
+
+    def networks(self, fields: Iterable[str] = NETWORK_FIELDS, page_size: int = None, after: str = None,
+                 **filters) -> Iterator[dict]:
+        return self.stream('networks', fields, page_size, after, **filters)
+
+    def close(self):
+        if self.pool is not None: self.pool.shutdown()
+        self.pool = None
+
+
+def main(arguments: list = None):
+    parser = argparse.ArgumentParser(description='Bulk administration of the VPN accounts and networks')
+    parser.add_argument('--uri', default='mongodb://localhost:27017/', help='Database URI')
+    parser.add_argument('--database', default='test_network', help='Database name')
+    parser.add_argument('--processes', type=int, help='Processes hashing the passwords')
+    commands = parser.add_subparsers(dest='command', required=True)
+    accounts = commands.add_parser('import-accounts', help='Create the accounts of a username,password CSV file')
+    accounts.add_argument('file', help='CSV file, - reads stdin')
+    accounts.add_argument('--network', help='Network the new accounts join')
+    network = commands.add_parser('create-network', help='Create a network')
+    network.add_argument('network_range', help='Range in CIDR notation')
+    network.add_argument('max_address', type=int, help='Maximum number of addresses')
+    for name in ('accounts', 'networks'):
+        listing = commands.add_parser(name, help=f'Stream the {name} as JSON lines')
+        listing.add_argument('--fields', help='Comma separated fields')
+        listing.add_argument('--page-size', type=int, default=1000, help='Documents read per query')
+        listing.add_argument('--after', help='Start after this id')
+    args = parser.parse_args(arguments)
+    from connection.database import open_client
+    admin = AdminAPI(open_client(args.uri)[args.database], args.processes)
+    try:
+        if args.command == 'import-accounts':
+            file = sys.stdin if args.file == '-' else open(args.file, newline='')
+            with file: result = admin.create_accounts(((row[0], row[1]) for row in csv.reader(file) if row),
+                                                      args.network)
+            print(json.dumps(dict(created=len(result['created']), skipped=result['skipped'])))
+        elif args.command == 'create-network':
+            print(admin.create_network(args.network_range, args.max_address))
+        else:
+            fields = args.fields.split(',') if args.fields else ACCOUNT_FIELDS if args.command == 'accounts' \
+                else NETWORK_FIELDS
+            for document in admin.stream(args.command, fields, args.page_size, args.after):
+                print(json.dumps(document, default=str))
+    finally: admin.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import platform
+import socket
+import struct
+import threading
+
+MSG_WAITFORONE = 0x10000
+
+
+class IOVec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+
+class MsgHdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_name', ctypes.c_void_p), ('msg_namelen', ctypes.c_uint32),
+        ('msg_iov', ctypes.POINTER(IOVec)), ('msg_iovlen', ctypes.c_size_t),
+        ('msg_control', ctypes.c_void_p), ('msg_controllen', ctypes.c_size_t),
+        ('msg_flags', ctypes.c_int)
+    ]
+
+
+class MMsgHdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', MsgHdr), ('msg_len', ctypes.c_uint)]
+
+
+class SockAddrIn(ctypes.Structure):
+    _fields_ = [
+        ('sin_family', ctypes.c_ushort), ('sin_port', ctypes.c_uint16),
+        ('sin_addr', ctypes.c_uint32), ('sin_zero', ctypes.c_char * 8)
+    ]
+
+
+def load_libc():
+    # recvmmsg/sendmmsg only exist on Linux, every other platform falls back
+    # to one system call per datagram.
+    if platform.system() != 'Linux': return None
+    try: libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except OSError: return None
+    if not hasattr(libc, 'recvmmsg') or not hasattr(libc, 'sendmmsg'): return None
+    libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(MMsgHdr), ctypes.c_uint,
+                              ctypes.c_int, ctypes.c_void_p]
+    libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(MMsgHdr), ctypes.c_uint, ctypes.c_int]
+    return libc
+
+
+LIBC = load_libc()
+
+
+class BatchSocket:
+    def __init__(self, sock: socket.socket, batch_size: int = 32, buffer_size: int = 65535):
+        self.socket, self.batch_size, self.buffer_size = sock, batch_size, buffer_size
+        # Batched calls are only used for IPv4 UDP sockets when libc has them.
+        self.batched = LIBC is not None and sock.family == socket.AF_INET and batch_size > 1
+        # Counters used to report how full the batches are.
+        self.received, self.receive_calls = 0, 0
+        self.sent, self.send_calls = 0, 0
+        # Receive and send structures are kept per thread so several threads
+        # can share the socket.
+        self.local = threading.local()
+
+    def _receive_slots(self):
+        # Preallocate one receive buffer, address and header per slot, they
+        # are reused by every recvmmsg call of the thread.
+        if getattr(self.local, 'buffer', None) is None:
+            size, count = self.buffer_size, self.batch_size
+            self.local.buffer = bytearray(size * count)
+            base = ctypes.addressof((ctypes.c_char * len(self.local.buffer)).from_buffer(self.local.buffer))
+            self.local.receive_names = names = (SockAddrIn * count)()
+            self.local.receive_vectors = vectors = (IOVec * count)()
+            self.local.receive_headers = headers = (MMsgHdr * count)()
+            for index in range(count):
+                vectors[index].iov_base, vectors[index].iov_len = base + size * index, size
+                header = headers[index].msg_hdr
+                header.msg_name = ctypes.cast(ctypes.pointer(names[index]), ctypes.c_void_p)
+                header.msg_iov, header.msg_iovlen = ctypes.pointer(vectors[index]), 1
+        return self.local.buffer, self.local.receive_names, self.local.receive_headers
+
+    @property
+    def receive_fill(self) -> float:
+        return self.received / (self.receive_calls * self.batch_size or 1)
+
+    @property
+    def send_fill(self) -> float:
+        return self.sent / (self.send_calls * self.batch_size or 1)
+
+    def stats(self) -> dict:
+        return dict(batched=self.batched, batch_size=self.batch_size,
+                    received=self.received, receive_calls=self.receive_calls,
+                    receive_fill=self.receive_fill, sent=self.sent,
+                    send_calls=self.send_calls, send_fill=self.send_fill)
+
+    def recv_batch(self) -> list[tuple[bytes, tuple]]:
+        # Blocking sockets wait for at least one datagram, non-blocking ones
+        # return an empty list once nothing is queued.
+        self.receive_calls += 1
+        if not self.batched:
+            datagrams = []
+            try:
+                datagrams.append(self.socket.recvfrom(self.buffer_size))
+                while not self.socket.getblocking() and len(datagrams) < self.batch_size:
+                    datagrams.append(self.socket.recvfrom(self.buffer_size))
+            except BlockingIOError: pass
+            self.received += len(datagrams)
+            return datagrams
+        buffer, names, headers = self._receive_slots()
+        for index in range(self.batch_size):
+            headers[index].msg_hdr.msg_namelen = ctypes.sizeof(SockAddrIn)
+        # Take every datagram already queued, up to the batch size.
+        count = -1
+        while count < 0:
+            count = LIBC.recvmmsg(self.socket.fileno(), headers, self.batch_size, MSG_WAITFORONE, None)
+            error = ctypes.get_errno() if count < 0 else 0
+            if error in (errno.EAGAIN, errno.EWOULDBLOCK): return []
+            # Retry when a signal interrupts the call, like socket.recvfrom.
+            if count < 0 and error != errno.EINTR: raise OSError(error, os.strerror(error))
+        # A shut down socket reports an empty datagram without a sender.
+        if count == 0 or headers[0].msg_hdr.msg_namelen == 0: return [(b'', None)]
+        self.received += count
+        datagrams, view = [], memoryview(buffer)
+        for index in range(count):
+            start, name = self.buffer_size * index, names[index]
+            # The payload is copied out since the buffer is reused right away.
+            packet = bytes(view[start:start + headers[index].msg_len])
+            address = socket.inet_ntoa(struct.pack('=I', name.sin_addr)), socket.ntohs(name.sin_port)
+            datagrams.append((packet, address))
+        return datagrams
+
+    def _send_headers(self):
+        # Send structures are kept per thread so workers can send concurrently.
+        if getattr(self.local, 'headers', None) is None:
+            count = self.batch_size
+            self.local.names, self.local.vectors = (SockAddrIn * count)(), (IOVec * count)()
+            self.local.headers = (MMsgHdr * count)()
+            for index in range(count):
+                header = self.local.headers[index].msg_hdr
+                header.msg_name = ctypes.cast(ctypes.pointer(self.local.names[index]), ctypes.c_void_p)
+                header.msg_namelen = ctypes.sizeof(SockAddrIn)
+                header.msg_iov, header.msg_iovlen = ctypes.pointer(self.local.vectors[index]), 1
+        return self.local.names, self.local.vectors, self.local.headers
+
+    def send_batch(self, datagrams: list[tuple[bytes, tuple]]) -> int:
+        if not self.batched:
+            for packet, address in datagrams:
+                self.send_calls, self.sent = self.send_calls + 1, self.sent + 1
+                self.socket.sendto(packet, address)
+            return len(datagrams)
+        names, vectors, headers = self._send_headers()
+        sent = 0
+        for start in range(0, len(datagrams), self.batch_size):
+            chunk = datagrams[start:start + self.batch_size]
+            # Keep the buffers referenced until sendmmsg returns.
+            buffers = [ctypes.c_char_p(bytes(packet)) for packet, _ in chunk]
+            for index, (packet, address) in enumerate(chunk):
+                name = names[index]
+                name.sin_family = socket.AF_INET
+                name.sin_addr = struct.unpack('=I', socket.inet_aton(address[0]))[0]
+                name.sin_port = socket.htons(address[1])
+                vectors[index].iov_base = ctypes.cast(buffers[index], ctypes.c_void_p)
+                vectors[index].iov_len = len(packet)
+            offset = 0
+            while offset < len(chunk):
+                self.send_calls += 1
+                count = LIBC.sendmmsg(self.socket.fileno(), ctypes.byref(headers[offset]),
+                                      len(chunk) - offset, 0)
+                # Skip a datagram the kernel refused instead of retrying it.
+                if count <= 0: count = 1
+                else: sent, self.sent = sent + count, self.sent + count
+                offset += count
+        return sent
@@ -0,0 +1,120 @@
+import itertools
+import os
+import struct
+from typing import Optional
+
+from Crypto.Cipher import Salsa20
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+from cryptography.hazmat.primitives.hashes import SHA256
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+# Frame header of the AEAD framing: frame kind, flags and packet counter.
+# The whole header is authenticated as associated data.
+FRAME_HEADER = struct.Struct('!BBQ')
+FRAME_DATA = 0x10
+# Several packets, each preceded by its 16-bit length.
+FRAME_BUNDLE = 0x11
+# Empty frame sent by idle clients to keep their session and NAT mapping.
+FRAME_KEEPALIVE = 0x12
+# Path MTU probe padded to the probed size, answered with the size received.
+FRAME_PROBE = 0x13
+# Random nonce sent to a new address of a session resumed from the store,
+# the client echoes it to prove it holds the session key.
+FRAME_CHALLENGE = 0x14
+# Frame flag of the frames whose header is followed by the session ticket,
+# it lets the server find the session of a client whose address changed.
+FLAG_SESSION = 0x02
+TICKET_LENGTH = 8
+TAG_LENGTH = 16
+
+
+def frame_ticket(frame: bytes) -> Optional[tuple[bytes, int]]:
+    # Session ticket and counter of a framed packet, None without a ticket.
+    if len(frame) < FRAME_HEADER.size + TICKET_LENGTH + TAG_LENGTH or not frame[1] & FLAG_SESSION: return None
+    counter = FRAME_HEADER.unpack_from(frame)[2]
+    return bytes(frame[FRAME_HEADER.size:FRAME_HEADER.size + TICKET_LENGTH]), counter
+
+
+class Salsa20Context:
+    # The legacy framing has no frame header, so only data frames exist.
+    name, overhead, framed = 'salsa20', 0, False
+
+    def __init__(self, token: bytes, initiator: bool = False):
+        # The legacy framing restarts the key stream for every packet, so
+        # only the key and nonce split is kept between packets.
+        self.key, self.nonce = token[:-8], token[-8:]
+
+    def seal(self, payload: bytes, kind: int = FRAME_DATA, flags: int = 0) -> bytes:
+        return Salsa20.new(key=self.key, nonce=self.nonce).encrypt(payload)
+
+    def open(self, frame: bytes) -> Optional[tuple[int, int, bytes]]:
+        return FRAME_DATA, 0, Salsa20.new(key=self.key, nonce=self.nonce).decrypt(frame)
+
+    def encrypt(self, packet: bytes) -> bytes:
+        return self.seal(packet)
+
+    def decrypt(self, frame: bytes) -> Optional[bytes]:
+        return self.open(frame)[2]
+
+
+class ChaCha20Poly1305Context:
+    name, overhead, framed = 'chacha20-poly1305', FRAME_HEADER.size + TAG_LENGTH, True
+
+    def __init__(self, token: bytes, initiator: bool = False):
+        # Derive the key once per session from the handshake token.
+        kdf = HKDF(algorithm=SHA256(), length=32, salt=None, info=b'vpn-service frame key')
+        self.aead = ChaCha20Poly1305(kdf.derive(token))
+        # Each direction uses its own nonce prefix so both ends can count
+        # from the same key without reusing a nonce.
+        prefixes = b'\x00\x00\x00\x01', b'\x00\x00\x00\x02'
+        self.send_prefix, self.receive_prefix = prefixes if initiator else prefixes[::-1]
+        # Start from a random counter so a context rebuilt from the same
+        # token does not replay the nonces of a previous one.
+        start = int.from_bytes(os.urandom(8), 'big') >> 1
+        self.counter = itertools.count(start)
+        # Highest counter received, a frame from a new address must be newer
+        # for the session to move there.
+        self.received = -1
+        # Ticket sent after the header of every frame once attached.
+        self.ticket = b''
+
+    def attach(self, ticket: bytes):
+        self.ticket = ticket
+        self.overhead = FRAME_HEADER.size + len(ticket) + TAG_LENGTH
+
+    def seal(self, payload: bytes, kind: int = FRAME_DATA, flags: int = 0) -> bytes:
+        counter = next(self.counter) & 0xFFFFFFFFFFFFFFFF
+        if self.ticket: flags |= FLAG_SESSION
+        header = FRAME_HEADER.pack(kind, flags, counter) + self.ticket
+        nonce = self.send_prefix + counter.to_bytes(8, 'big')
+        return header + self.aead.encrypt(nonce, payload, header)
+
+    def open(self, frame: bytes) -> Optional[tuple[int, int, bytes]]:
+        if len(frame) < FRAME_HEADER.size + TAG_LENGTH: return None
+        kind, flags, counter = FRAME_HEADER.unpack_from(frame)
+        nonce = self.receive_prefix + counter.to_bytes(8, 'big')
+        # The ticket is authenticated with the rest of the header.
+        length = FRAME_HEADER.size + (TICKET_LENGTH if flags & FLAG_SESSION else 0)
+        try: payload = self.aead.decrypt(nonce, frame[length:], frame[:length])
+        except InvalidTag: return None
+        if counter > self.received: self.received = counter
+        return kind, flags & ~FLAG_SESSION, payload
+
+    def encrypt(self, packet: bytes) -> bytes:
+        return self.seal(packet)
+
+    def decrypt(self, frame: bytes) -> Optional[bytes]:
+        opened = self.open(frame)
+        return opened[2] if opened is not None and opened[0] == FRAME_DATA else None
+
+
+# Ciphers by handshake identifier, the client offers them in its preferred
+# order and the server picks the first one it supports.
+CIPHERS = {0: Salsa20Context, 1: ChaCha20Poly1305Context}
+CIPHER_IDS = {context.name: cipher_id for cipher_id, context in CIPHERS.items()}
+
+
+def new_context(name: str, token: bytes or str, initiator: bool = False):
+    token = token.encode() if type(token) is str else token
+    return CIPHERS[CIPHER_IDS[name]](token, initiator)
@@ -0,0 +1,155 @@
+import os
+import select
+import socket
+import threading
+import time
+
+from connection.batch_io import BatchSocket
+from connection.ciphers import FRAME_BUNDLE, FRAME_CHALLENGE, FRAME_DATA, FRAME_KEEPALIVE
+from connection.coalesce import MAX_DATAGRAM, bundle, group, unbundle
+from connection.compression import Compressor, flow_key
+from connection.metrics import TrafficMetrics
+
+EPOLLEXCLUSIVE = getattr(select, 'EPOLLEXCLUSIVE', 0)
+
+
+class ClientEngine:
+    def __init__(self, io: BatchSocket, server_address: tuple, cipher, devices: list,
+                 metrics: TrafficMetrics = None, batch_size: int = 32, coalesce: bool = False,
+                 flush_delay: float = 0.0, codec=None, keepalive: float = 0.0, max_datagram: int = MAX_DATAGRAM,
+                 error: bytes = b'\x03'):
+        self.io, self.cipher, self.devices = io, cipher, devices
+        # Batched sends need a numeric address.
+        self.server_address = socket.gethostbyname(server_address[0]), server_address[1]
+        self.metrics, self.batch_size = metrics, batch_size
+        # With coalescing the packets read together are bundled, waiting up
+        # to `flush_delay` seconds once for more packets to arrive.
+        self.coalesce, self.flush_delay = coalesce, flush_delay
+        # Bundles fit in datagrams of `max_datagram` bytes.
+        self.max_datagram = max_datagram
+        # Payloads are compressed with the negotiated codec while it pays off.
+        self.codec = codec
+        self.compressor = Compressor(metrics.registry if metrics is not None else None)
+        # A keepalive frame is sent after `keepalive` seconds without
+        # sending anything, so the session and the NAT mapping stay up.
+        self.keepalive, self.last_sent = keepalive, time.monotonic()
+        # Datagram of the server for frames of a session it does not know,
+        # the engine stops and `lost` is set.
+        self.error, self.lost = error, False
+        self.threads: list[threading.Thread] = []
+        self.running = False
+        # A pipe registered in every poller wakes the workers up on stop().
+        self.wakeup = os.pipe()
+
+    def drain_device(self, fd: int, buffer: bytearray) -> int:
+        # Read up to a batch of packets into the reused buffer and send them
+        # to the server with as few system calls as possible.
+        frames, packets, view = [], [], memoryview(buffer)
+        waited = not (self.coalesce and self.flush_delay)
+        while len(frames) + len(packets) < self.batch_size:
+            try: length = os.readv(fd, [buffer])
+            except BlockingIOError:
+                if waited or not packets: break
+                select.select([fd], [], [], self.flush_delay)
+                waited = True
+                continue
+            if length == 0: break
+            if self.coalesce: packets.append(bytes(view[:length]))
+            else: frames.append(self.seal(view[:length]))
+        if packets: frames += self.bundle(packets)
+        if not frames: return 0
+        self.io.send_batch([(frame, self.server_address) for frame in frames])
+        self.last_sent = time.monotonic()
+        sent = sum(len(frame) for frame in frames)
+        if self.metrics is not None: self.metrics.sent((), sent, len(frames))
+        return sent
+
+    def bundle(self, packets: list[bytes]) -> list[bytes]:
+        # Pack the packets in order into frames that fit a datagram.
+        groups = group(packets, self.max_datagram - self.cipher.overhead)
+        return [self.seal(packets[0]) if len(packets) == 1 else self.seal(bundle(packets), FRAME_BUNDLE)
+                for packets in groups]
+
+    def seal(self, payload: bytes, kind: int = FRAME_DATA) -> bytes:
+        if self.codec is None: return self.cipher.seal(payload, kind)
+        key = flow_key(payload) if kind == FRAME_DATA else kind
+        return self.compressor.seal(self.cipher, self.codec, key, payload, kind)
+
+    def send_keepalive(self):
+        # Legacy ciphers have no frame kind, an empty data frame stands in.
+        self.last_sent = time.monotonic()
+        frame = self.cipher.seal(b'', FRAME_KEEPALIVE) if self.cipher.framed else self.cipher.seal(b'')
+        try: self.io.socket.sendto(frame, self.server_address)
+        except OSError: pass
+
+    def answer(self, nonce: bytes):
+        # The server asks for proof of the session key before moving the
+        # session to a new address of the client.
+        try: self.io.socket.sendto(self.cipher.seal(nonce, FRAME_CHALLENGE), self.server_address)
+        except OSError: pass
+
+    def drain_socket(self, fd: int) -> int:
+        # Open every queued frame and write its packets to this worker's queue.
+        written = packets = 0
+        for frame, address in self.io.recv_batch():
+            if frame == self.error and address == self.server_address:
+                self.expire()
+                break
+            frame = self.cipher.open(frame)
+            if frame is None: continue
+            kind, flags, payload = frame
+            if flags: payload = self.compressor.decompress(self.codec, flags, payload)
+            if payload is None: continue
+            if kind == FRAME_CHALLENGE:
+                self.answer(payload)
+                continue
+            for packet in [payload] if kind == FRAME_DATA else unbundle(payload) if kind == FRAME_BUNDLE else []:
+                try: written, packets = written + os.write(fd, packet), packets + 1
+                except BlockingIOError: pass
+        if packets and self.metrics is not None: self.metrics.received((), written, packets)
+        return written
+
+    def worker(self, device):
+        fd, server = device.fileno(), self.io.socket.fileno()
+        buffer = bytearray(getattr(device, 'mtu', 1500) + 64)
+        poller = select.epoll()
+        poller.register(fd, select.EPOLLIN)
+        # Only one of the workers waiting on the shared socket is woken up.
+        poller.register(server, select.EPOLLIN | EPOLLEXCLUSIVE)
+        poller.register(self.wakeup[0], select.EPOLLIN)
+        try:
+            while self.running:
+                # Wake up in time for the next keepalive.
+                timeout = max(self.last_sent + self.keepalive - time.monotonic(), 0) if self.keepalive else -1
+                for fileno, _ in poller.poll(timeout):
+                    if fileno == fd: self.drain_device(fd, buffer)
+                    elif fileno == server: self.drain_socket(fd)
+                if self.keepalive and time.monotonic() - self.last_sent >= self.keepalive: self.send_keepalive()
+        finally: poller.close()
+
+    def start(self):
+        self.running = True
+        # Both sides are drained until they would block.
+        self.io.socket.setblocking(False)
+        for device in self.devices:
+            os.set_blocking(device.fileno(), False)
+            thread = threading.Thread(target=self.worker, args=(device,), daemon=True)
+            self.threads.append(thread), thread.start()
+        return self
+
+    def expire(self):
+        # Called from a worker, the others are woken up and every one of
+        # them returns, join() does the rest.
+        self.lost, self.running = True, False
+        os.write(self.wakeup[1], b'\x00')
+
+    def join(self) -> bool:
+        # Returns whether the engine stopped because the session was lost.
+        [thread.join() for thread in self.threads]
+        return self.lost
+
+    def stop(self):
+        self.running = False
+        os.write(self.wakeup[1], b'\x00')
+        self.join()
+        self.threads = []
@@ -0,0 +1,146 @@
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import struct
+import tempfile
+import threading
+from typing import Callable, Optional
+
+from connection.sessions import Session
+
+
+class WorkerPeers:
+    def __init__(self, server, index: int, workers: int, directory: str):
+        self.server, self.index, self.workers = server, index, workers
+        self.paths = [os.path.join(directory, f'worker-{n}.sock') for n in range(workers)]
+        # Routes announced by the other workers, keyed by network id and
+        # virtual ip, pointing at the worker that owns the session.
+        self.routes: dict[tuple[str, str], int] = {}
+        self.channel = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.channel.bind(self.paths[index])
+        # Messages are sent with MSG_DONTWAIT, a worker that does not keep up
+        # loses them instead of stalling the forwarding threads of the others.
+        self.dropped = server.metrics.registry.counter('vpn_cluster_dropped_total',
+                                                       'Messages to other workers dropped on a full channel, by kind.',
+                                                       ('kind',))
+        self.thread: threading.Thread or None = None
+        server.sessions.watchers.append(self)
+
+    def pack(self, kind: bytes, network_id: str, ip_address: str, payload: bytes = b''):
+        network_id, ip_address = network_id.encode(), ip_address.encode()
+        header = struct.pack('!cHB', kind, self.index, len(network_id)) + network_id
+        return header + bytes([len(ip_address)]) + ip_address + payload
+
+    def unpack(self, message: bytes):
+        kind, index, length = struct.unpack_from('!cHB', message)
+        network_id = message[4:4 + length].decode()
+        offset = 5 + length + message[4 + length]
+        ip_address = message[5 + length:offset].decode()
+        return kind, index, network_id, ip_address, message[offset:]
+
+    def send(self, message: bytes, path: str) -> bool:
+        try: self.channel.sendto(message, socket.MSG_DONTWAIT, path)
+        except OSError:
+            self.dropped.add(1, (chr(message[0]),))
+            return False
+        return True
+
+    def broadcast(self, message: bytes):
+        for index, path in enumerate(self.paths):
+            if index != self.index: self.send(message, path)
+
+    def added(self, session: Session):
+        # Tell the other workers this worker now owns the session.
+        account_id = str(session.account_id).encode()
+        self.broadcast(self.pack(b'A', session.network_id, session.ip_address, account_id))
+
+    def removed(self, session: Session):
+        # Another session of this worker may still own the same route.
+        if self.server.sessions.route(session.network_id, session.ip_address): return
+        self.broadcast(self.pack(b'W', session.network_id, session.ip_address))
+
+    def owns(self, network_id: str, ip_address: str) -> bool:
+        # Whether another worker announced a session with this address.
+        return (network_id, ip_address) in self.routes
+
+    def handoff(self, network_id: str, ip_address: str, packet: bytes) -> bool:
+        # Pass a decrypted packet to the worker owning its destination.
+        index = self.routes.get((network_id, ip_address))
+        if index is None: return False
+        # A dropped packet is not routed elsewhere, the owner is known.
+        self.send(self.pack(b'P', network_id, ip_address, packet), self.paths[index])
+        return True
+
+    def receive(self):
+        while True:
+            try: message = self.channel.recv(65535)
+            except OSError: break
+            if not message: break
+            kind, index, network_id, ip_address, payload = self.unpack(message)
+            if kind == b'A':
+                self.routes[network_id, ip_address] = index
+                # The account reconnected through another worker, so any
+                # session kept here is stale.
+                self.server.sessions.remove_account(payload.decode())
+            elif kind == b'W' and self.routes.get((network_id, ip_address)) == index:
+                del self.routes[network_id, ip_address]
+            elif kind == b'P':
+                self.server.deliver(network_id, ip_address, payload)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.receive, daemon=True)
+        self.thread.start()
+        return self
+
+    def close(self):
+        try: self.channel.shutdown(socket.SHUT_RDWR)
+        except OSError: pass
+        self.channel.close()
+
+
+def stop_worker(*_):
+    raise SystemExit
+
+
+def run_worker(factory: Callable, index: int, workers: int, directory: str,
+               port: int, tunnel: bool):
+    # Every worker builds its own server (and database client) after the
+    # fork and binds the shared port with SO_REUSEPORT.
+    server = factory()
+    server.reuse_port = True
+    server.peers = WorkerPeers(server, index, workers, directory).start()
+    # Turn the terminate() signal into an exception so counters get flushed.
+    signal.signal(signal.SIGTERM, stop_worker)
+    try: server.run_server(port, tunnel)
+    except (KeyboardInterrupt, SystemExit): pass
+    finally: server.close()
+
+
+class VPNCluster:
+    def __init__(self, factory: Callable, workers: Optional[int] = None):
+        # The factory is called inside each worker process and must return
+        # a new VPNServer.
+        self.factory, self.workers = factory, workers or os.cpu_count()
+        self.processes: list[multiprocessing.Process] = []
+
+    def run_server(self, port: int = 5732, tunnel: bool = False):
+        directory = tempfile.mkdtemp(prefix='vpn-cluster-')
+        for index in range(self.workers):
+            args = self.factory, index, self.workers, directory, port, tunnel
+            # Not daemonic, the handshake stage of every worker starts its
+            # own pool of processes for bcrypt.
+            process = multiprocessing.Process(target=run_worker, args=args)
+            self.processes.append(process), process.start()
+        try: [process.join() for process in self.processes]
+        except KeyboardInterrupt: pass
+        finally:
+            self.close()
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def close(self):
+        for process in self.processes:
+            if process.is_alive(): process.terminate()
+        [process.join() for process in self.processes]
+        self.processes = []
@@ -0,0 +1,89 @@
+import struct
+import threading
+
+from connection.ciphers import FRAME_BUNDLE, FRAME_DATA
+
+# Largest UDP payload that fits a 1500 bytes path MTU (IPv4 + UDP headers).
+MAX_DATAGRAM = 1472
+# Every packet of a bundle is preceded by its length.
+BUNDLE_ENTRY = struct.Struct('!H')
+
+
+def bundle(packets: list) -> bytes:
+    return b''.join(BUNDLE_ENTRY.pack(len(packet)) + bytes(packet) for packet in packets)
+
+
+def unbundle(payload: bytes) -> list[memoryview]:
+    view, packets, offset = memoryview(payload), [], 0
+    while offset + BUNDLE_ENTRY.size <= len(view):
+        length, = BUNDLE_ENTRY.unpack_from(view, offset)
+        offset += BUNDLE_ENTRY.size
+        # A truncated entry ends the bundle.
+        if offset + length > len(view): break
+        packets.append(view[offset:offset + length])
+        offset += length
+    return packets
+
+
+def group(packets: list, budget: int) -> list[list]:
+    # Split the packets, in order, into groups whose bundle fits the budget.
+    groups, size = [], budget
+    for packet in packets:
+        length = BUNDLE_ENTRY.size + len(packet)
+        if size + length > budget:
+            groups.append([])
+            size = 0
+        groups[-1].append(packet)
+        size += length
+    return groups
+
+
+class Coalescer:
+    def __init__(self, max_datagram: int = MAX_DATAGRAM, seal=None):
+        # seal(session, payload, kind) returns the frame, the session's
+        # cipher seals it as it is by default.
+        self.max_datagram, self.seal_frame = max_datagram, seal or self.encrypt
+        # Packets waiting per destination session, kept per thread so the
+        # forwarding threads never share a buffer. They are sealed when the
+        # next packet does not fit and at the end of every batch.
+        self.local = threading.local()
+        self.bundles = self.packets = 0
+
+    def pending(self) -> dict:
+        try: return self.local.pending
+        except AttributeError:
+            pending = self.local.pending = {}
+            return pending
+
+    def budget(self, session) -> int:
+        # Bundles also stay within the tunnel MTU of the session.
+        return min(self.max_datagram - session.cipher.overhead, session.mtu)
+
+    def add(self, session, packet: bytes) -> list[tuple]:
+        # Returns the (session, frame) pairs that had to be sealed to make room.
+        pending, length = self.pending(), BUNDLE_ENTRY.size + len(packet)
+        packets, size = pending.get(session, ([], 0))
+        sealed = []
+        if packets and size + length > self.budget(session):
+            sealed.append(self.seal(session, packets))
+            packets, size = [], 0
+        packets.append(packet)
+        pending[session] = packets, size + length
+        return sealed
+
+    @staticmethod
+    def encrypt(session, payload: bytes, kind: int) -> bytes:
+        return session.cipher.seal(payload, kind)
+
+    def seal(self, session, packets: list) -> tuple:
+        # A lone packet is sent as a plain data frame.
+        if len(packets) == 1: return session, self.seal_frame(session, bytes(packets[0]), FRAME_DATA)
+        self.bundles, self.packets = self.bundles + 1, self.packets + len(packets)
+        return session, self.seal_frame(session, bundle(packets), FRAME_BUNDLE)
+
+    def flush(self) -> list[tuple]:
+        pending = self.pending()
+        if not pending: return []
+        sealed = [self.seal(session, packets) for session, (packets, _) in pending.items()]
+        pending.clear()
+        return sealed
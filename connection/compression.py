@@ -0,0 +1,155 @@
+import importlib.util
+import threading
+import time
+import zlib
+from typing import Optional
+
+from connection.ciphers import FRAME_DATA
+from connection.metrics import MetricsRegistry
+
+# Frame flag of a payload compressed with the codec of the session.
+FLAG_COMPRESSED = 0x01
+# Payloads shorter than this are never worth compressing.
+MIN_LENGTH = 128
+# Largest payload a compressed frame may expand to.
+MAX_LENGTH = 1 << 16
+
+
+class ZlibCodec:
+    name = 'zlib'
+
+    def __init__(self, level: int = 1):
+        # Raw deflate, the frame already says the payload is compressed.
+        self.level = level
+
+    @staticmethod
+    def available() -> bool:
+        return True
+
+    def compress(self, payload: bytes) -> bytes:
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        return compressor.compress(payload) + compressor.flush()
+
+    def decompress(self, payload: bytes) -> Optional[bytes]:
+        decompressor = zlib.decompressobj(-15)
+        try: packet = decompressor.decompress(payload, MAX_LENGTH)
+        except zlib.error: return None
+        # Payloads that expand past MAX_LENGTH are refused. The output may
+        # stop at MAX_LENGTH with the whole input consumed, so the stream must
+        # also have ended.
+        return packet if decompressor.eof and not decompressor.unconsumed_tail else None
+
+
+class Lz4Codec:
+    name = 'lz4'
+
+    def __init__(self):
+        import lz4.block
+        self.block = lz4.block
+
+    @staticmethod
+    def available() -> bool:
+        return importlib.util.find_spec('lz4') is not None
+
+    def compress(self, payload: bytes) -> bytes:
+        return self.block.compress(payload, mode='fast', store_size=True)
+
+    def decompress(self, payload: bytes) -> Optional[bytes]:
+        # The block starts with its uncompressed size, checked before expanding.
+        if len(payload) < 4 or int.from_bytes(payload[:4], 'little') > MAX_LENGTH: return None
+        try: return self.block.decompress(payload)
+        except self.block.LZ4BlockError: return None
+
+
+# Codecs by handshake identifier, negotiated like the ciphers.
+CODECS = {0: ZlibCodec, 1: Lz4Codec}
+CODEC_IDS = {codec.name: codec_id for codec_id, codec in CODECS.items()}
+
+
+def new_codec(name: str or None):
+    return CODECS[CODEC_IDS[name]]() if name else None
+
+
+def available_codecs() -> list[str]:
+    return [codec.name for codec in CODECS.values() if codec.available()]
+
+
+def flow_key(packet: bytes) -> bytes:
+    # Protocol, addresses and ports straight from the IP header.
+    version = packet[0] >> 4 if packet else 0
+    if version == 4:
+        offset = (packet[0] & 0x0F) * 4
+        return bytes(packet[9:10]) + bytes(packet[12:20]) + bytes(packet[offset:offset + 4])
+    if version == 6: return bytes(packet[6:7]) + bytes(packet[8:44])
+    return b''
+
+
+class FlowRatio:
+    __slots__ = 'skip', 'backoff'
+
+    def __init__(self):
+        # Packets left to send uncompressed and the length of the next pause.
+        self.skip = self.backoff = 0
+
+
+class Compressor:
+    def __init__(self, registry: MetricsRegistry = None, ratio: float = 0.9, max_backoff: int = 1024,
+                 max_flows: int = 65536):
+        registry = registry or MetricsRegistry()
+        # A flow whose payloads do not shrink below `ratio` stops being
+        # compressed for a while, twice as long every time it fails again,
+        # so encrypted traffic only costs an attempt now and then.
+        self.ratio, self.max_backoff, self.max_flows = ratio, max_backoff, max_flows
+        self.flows: dict[tuple, FlowRatio] = {}
+        self.lock = threading.Lock()
+        self.saved = registry.counter('vpn_compression_saved_bytes_total',
+                                      'Bytes saved by compression by direction.', ('direction',))
+        self.seconds = registry.counter('vpn_compression_cpu_seconds_total',
+                                        'CPU time spent compressing and decompressing.', ('operation',))
+        self.packets = registry.counter('vpn_compression_packets_total',
+                                        'Payloads considered for compression by outcome.', ('outcome',))
+
+    def flow(self, key: tuple) -> FlowRatio:
+        state = self.flows.get(key)
+        if state is None:
+            with self.lock:
+                # Forget every flow rather than growing without bound.
+                if len(self.flows) >= self.max_flows: self.flows = {}
+                state = self.flows.setdefault(key, FlowRatio())
+        return state
+
+    def compress(self, codec, key: tuple, payload: bytes) -> tuple[bytes, int]:
+        # Returns the payload to seal and its frame flags.
+        if codec is None or len(payload) < MIN_LENGTH: return payload, 0
+        state = self.flow(key)
+        if state.skip:
+            state.skip -= 1
+            self.packets.add(1, ('skipped',))
+            return payload, 0
+        started = time.thread_time()
+        compressed = codec.compress(payload)
+        self.seconds.add(time.thread_time() - started, ('compress',))
+        if len(compressed) > len(payload) * self.ratio:
+            state.backoff = min(max(state.backoff * 2, 8), self.max_backoff)
+            state.skip = state.backoff
+            self.packets.add(1, ('incompressible',))
+            return payload, 0
+        state.backoff = 0
+        self.packets.add(1, ('compressed',))
+        self.saved.add(len(payload) - len(compressed), ('out',))
+        return compressed, FLAG_COMPRESSED
+
+    def decompress(self, codec, flags: int, payload: bytes) -> Optional[bytes]:
+        # Payloads of uncompressed frames are returned as they are, None
+        # when the frame cannot be expanded.
+        if not flags & FLAG_COMPRESSED: return payload
+        if codec is None: return None
+        started = time.thread_time()
+        packet = codec.decompress(payload)
+        self.seconds.add(time.thread_time() - started, ('decompress',))
+        if packet is not None: self.saved.add(len(packet) - len(payload), ('in',))
+        return packet
+
+    def seal(self, cipher, codec, key: tuple, payload: bytes, kind: int = FRAME_DATA) -> bytes:
+        payload, flags = self.compress(codec, key, payload)
+        return cipher.seal(payload, kind, flags)
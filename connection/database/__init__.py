@@ -0,0 +1,8 @@
+def open_client(uri: str = 'mongodb://localhost:27017/'):
+    # Storage backends share the pymongo client/database/collection API, the
+    # in-memory one keeps everything in the current process.
+    if uri.startswith('memory://'):
+        from .memory import MemoryClient
+        return MemoryClient()
+    from pymongo import MongoClient
+    return MongoClient(uri)
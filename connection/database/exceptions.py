@@ -7,3 +7,14 @@ class AddressConflict(Exception):
         if self.ip_address:
             text = text.format(' ' + self.ip_address)
         return super().__init__(text.format('')) or self
+
+
+class AddressPoolExhausted(Exception):
+    def __init__(self, network_range: str = None):
+        self.network_range = network_range
+
+    def exhausted(self):
+        text = 'There are no free ip addresses left in the network{}.'
+        if self.network_range:
+            text = text.format(' ' + self.network_range)
+        return super().__init__(text.format('')) or self
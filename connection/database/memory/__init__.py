@@ -0,0 +1 @@
+from .collection import MemoryClient, MemoryCollection, MemoryCursor, MemoryDatabase
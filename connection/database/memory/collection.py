@@ -0,0 +1,341 @@
+import copy
+import threading
+
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+MISSING = object()
+
+
+class Result:
+    def __init__(self, **kwargs):
+        [setattr(self, key, value) for key, value in kwargs.items()]
+
+
+def get_path(document, path: str):
+    # Follow a dotted path through nested documents and list indexes.
+    for key in path.split('.'):
+        if isinstance(document, dict) and key in document: document = document[key]
+        elif isinstance(document, list) and key.isdigit() and int(key) < len(document):
+            document = document[int(key)]
+        else: return MISSING
+    return document
+
+
+def set_path(document: dict, path: str, value):
+    *parents, key = path.split('.')
+    for parent in parents: document = document.setdefault(parent, {})
+    document[key] = value
+
+
+def unset_path(document: dict, path: str):
+    *parents, key = path.split('.')
+    for parent in parents:
+        document = document.get(parent)
+        if not isinstance(document, dict): return
+    document.pop(key, None)
+
+
+def compare(value, operator: str, argument) -> bool:
+    if operator == '$exists': return (value is not MISSING) == bool(argument)
+    if operator == '$eq': return equals(value, argument)
+    if operator == '$ne': return not equals(value, argument)
+    if operator == '$in': return any(equals(value, item) for item in argument)
+    if operator == '$nin': return not any(equals(value, item) for item in argument)
+    if value is MISSING or value is None: return False
+    try:
+        if operator == '$lt': return value < argument
+        if operator == '$lte': return value <= argument
+        if operator == '$gt': return value > argument
+        if operator == '$gte': return value >= argument
+    except TypeError: return False
+    raise ValueError(f'Unsupported query operator {operator}')
+
+
+def equals(value, argument) -> bool:
+    # Like MongoDB, a list field matches any of its items.
+    if value is MISSING: return argument is None
+    return value == argument or (isinstance(value, list) and argument in value)
+
+
+def matches(document: dict, query: dict) -> bool:
+    for key, condition in query.items():
+        if key == '$and':
+            if not all(matches(document, item) for item in condition): return False
+            continue
+        if key == '$or':
+            if not any(matches(document, item) for item in condition): return False
+            continue
+        value = get_path(document, key)
+        operators = isinstance(condition, dict) and condition and all(k.startswith('$') for k in condition)
+        if operators:
+            if not all(compare(value, *item) for item in condition.items()): return False
+        elif not equals(value, condition): return False
+    return True
+
+
+def apply_update(document: dict, update: dict):
+    for operator, fields in update.items():
+        for path, value in fields.items():
+            current = get_path(document, path)
+            if operator == '$set': set_path(document, path, copy.deepcopy(value))
+            elif operator == '$unset': unset_path(document, path)
+            elif operator == '$inc': set_path(document, path, (0 if current is MISSING else current) + value)
+            elif operator == '$push':
+                items = value['$each'] if isinstance(value, dict) and '$each' in value else [value]
+                set_path(document, path, ([] if current is MISSING else current) + copy.deepcopy(items))
+            elif operator == '$pull' and isinstance(current, list):
+                set_path(document, path, [item for item in current if item != value])
+            elif operator == '$pop' and isinstance(current, list) and current:
+                set_path(document, path, current[1:] if value == -1 else current[:-1])
+            elif operator not in ('$pull', '$pop', '$setOnInsert'):
+                raise ValueError(f'Unsupported update operator {operator}')
+
+
+def project(document: dict, projection: dict or list or None) -> dict:
+    if not projection: return copy.deepcopy(document)
+    if isinstance(projection, (list, tuple)): projection = {field: 1 for field in projection}
+    slices = {key: value['$slice'] for key, value in projection.items()
+              if isinstance(value, dict) and '$slice' in value}
+    included = [key for key, value in projection.items() if key not in slices and value and key != '_id']
+    excluded = [key for key, value in projection.items() if key not in slices and not value]
+    if included:
+        # Inclusion projection: only the listed fields plus the _id.
+        result = {} if '_id' in excluded else {'_id': document.get('_id')}
+        for path in included + list(slices):
+            value = get_path(document, path)
+            if value is not MISSING: set_path(result, path, copy.deepcopy(value))
+    else:
+        result = copy.deepcopy(document)
+        [unset_path(result, path) for path in excluded]
+    for path, count in slices.items():
+        value = get_path(result, path)
+        if isinstance(value, list):
+            set_path(result, path, value[:count] if count >= 0 else value[count:])
+    return result
+
+
+class MemoryCursor:
+    def __init__(self, documents: list[dict]):
+        self.documents, self.start, self.count = documents, 0, None
+
+    def skip(self, count: int):
+        self.start = count
+        return self
+
+    def limit(self, count: int):
+        self.count = count or None
+        return self
+
+    def sort(self, key: str or list, direction: int = 1):
+        keys = [(key, direction)] if isinstance(key, str) else key
+        for field, order in keys[::-1]:
+            def sort_key(document):
+                value = get_path(document, field)
+                return (value is not MISSING, str(type(value)), value if value is not MISSING else 0)
+            self.documents.sort(key=sort_key, reverse=order < 0)
+        return self
+
+    def __iter__(self):
+        end = None if self.count is None else self.start + self.count
+        return iter(self.documents[self.start:end])
+
+
+class MemoryCollection:
+    def __init__(self, name: str):
+        self.name, self.documents = name, {}
+        self.lock = threading.RLock()
+        # Hash indexes: fields -> values -> set of _id, plus unique flags.
+        self.indexes: dict[tuple, dict] = {}
+        self.unique: set[tuple] = set()
+        # Documents whose indexed fields hold lists cannot be hashed, they
+        # are candidates of every lookup of the index.
+        self.unhashed: dict[tuple, set] = {}
+
+    def create_index(self, keys: str or list, unique: bool = False, **kwargs):
+        fields = (keys,) if isinstance(keys, str) else tuple(field for field, _ in keys)
+        with self.lock:
+            if fields not in self.indexes:
+                self.indexes[fields], self.unhashed[fields] = {}, set()
+                [self._index(document) for document in self.documents.values()]
+            if unique: self.unique.add(fields)
+        return '_'.join(f'{field}_1' for field in fields)
+
+    def _index_key(self, fields: tuple, document: dict):
+        key = tuple(get_path(document, field) for field in fields)
+        try: hash(key)
+        except TypeError: return None
+        return key
+
+    def _index(self, document: dict):
+        keys = {fields: self._index_key(fields, document) for fields in self.indexes}
+        # Check every unique index before touching any of them.
+        for fields in self.unique:
+            owners = self.indexes[fields].get(keys[fields], set()) - {document['_id']}
+            if keys[fields] is not None and owners:
+                raise DuplicateKeyError(f'Duplicate key {dict(zip(fields, keys[fields]))} in {self.name}')
+        for fields, key in keys.items():
+            if key is not None: self.indexes[fields].setdefault(key, set()).add(document['_id'])
+            else: self.unhashed[fields].add(document['_id'])
+
+    def _unindex(self, document: dict):
+        for fields, index in self.indexes.items():
+            key = self._index_key(fields, document)
+            self.unhashed[fields].discard(document['_id'])
+            if key is not None and key in index:
+                index[key].discard(document['_id'])
+                if not index[key]: del index[key]
+
+    def _candidates(self, query: dict):
+        # Use the first hash index fully covered by equality conditions.
+        if '_id' in query and not isinstance(query['_id'], dict):
+            document = self.documents.get(query['_id'])
+            return [document] if document is not None else []
+        for fields, index in self.indexes.items():
+            if all(field in query and not isinstance(query[field], dict) for field in fields):
+                key = tuple(query[field] for field in fields)
+                # None also matches the documents without the field, which
+                # are indexed under another key.
+                if any(value is None for value in key): continue
+                try: ids = index.get(key, set())
+                except TypeError: continue
+                return [self.documents[_id] for _id in ids | self.unhashed[fields]]
+        return list(self.documents.values())
+
+    def _find(self, query: dict or None) -> list[dict]:
+        query = query or {}
+        return [document for document in self._candidates(query) if matches(document, query)]
+
+    def find_one(self, query: dict = None, projection: dict or list = None, **kwargs):
+        with self.lock:
+            documents = self._find(query)
+            return project(documents[0], projection) if documents else None
+
+    def find(self, query: dict = None, projection: dict or list = None, **kwargs):
+        with self.lock:
+            return MemoryCursor([project(document, projection) for document in self._find(query)])
+
+    def count_documents(self, query: dict = None, **kwargs) -> int:
+        with self.lock: return len(self._find(query))
+
+    def insert_one(self, document: dict, **kwargs):
+        with self.lock:
+            document.setdefault('_id', ObjectId())
+            stored = copy.deepcopy(document)
+            if stored['_id'] in self.documents:
+                raise DuplicateKeyError(f'Duplicate _id {stored["_id"]} in {self.name}')
+            self._index(stored)
+            self.documents[stored['_id']] = stored
+            return Result(inserted_id=document['_id'], acknowledged=True)
+
+    def insert_many(self, documents: list[dict], **kwargs):
+        return Result(inserted_ids=[self.insert_one(document).inserted_id for document in documents],
+                      acknowledged=True)
+
+    def _update(self, query: dict, update: dict, many: bool, upsert: bool = False):
+        with self.lock:
+            documents = self._find(query)
+            documents = documents if many else documents[:1]
+            for document in documents:
+                self._unindex(document)
+                previous = copy.deepcopy(document)
+                try:
+                    apply_update(document, update)
+                    self._index(document)
+                except Exception:
+                    # Keep the stored document and its index entries intact.
+                    document.clear(), document.update(previous), self._index(document)
+                    raise
+            upserted_id = None
+            if not documents and upsert:
+                document = {key: value for key, value in query.items() if not key.startswith('$')
+                            and not isinstance(value, dict)}
+                apply_update(document, {key: value for key, value in update.items()
+                                        if key != '$setOnInsert'})
+                apply_update(document, {'$set': update.get('$setOnInsert', {})})
+                upserted_id = self.insert_one(document).inserted_id
+            return Result(matched_count=len(documents), modified_count=len(documents),
+                          upserted_id=upserted_id, acknowledged=True)
+
+    def update_one(self, query: dict, update: dict, upsert: bool = False, **kwargs):
+        return self._update(query, update, False, upsert)
+
+    def update_many(self, query: dict, update: dict, upsert: bool = False, **kwargs):
+        return self._update(query, update, True, upsert)
+
+    def find_one_and_update(self, query: dict, update: dict, projection: dict or list = None,
+                            return_document: bool = ReturnDocument.BEFORE, upsert: bool = False,
+                            **kwargs):
+        with self.lock:
+            documents = self._find(query)
+            if not documents:
+                if upsert: self._update(query, update, False, True)
+                return None
+            before = project(documents[0], projection)
+            self._update({'_id': documents[0]['_id']}, update, False)
+            if return_document == ReturnDocument.BEFORE: return before
+            return project(self.documents[documents[0]['_id']], projection)
+
+    def _delete(self, query: dict, many: bool):
+        with self.lock:
+            documents = self._find(query)
+            documents = documents if many else documents[:1]
+            for document in documents:
+                self._unindex(document)
+                del self.documents[document['_id']]
+            return Result(deleted_count=len(documents), acknowledged=True)
+
+    def delete_one(self, query: dict, **kwargs):
+        return self._delete(query, False)
+
+    def delete_many(self, query: dict, **kwargs):
+        return self._delete(query, True)
+
+    def bulk_write(self, requests: list, ordered: bool = True, **kwargs):
+        # Accepts the pymongo request objects (UpdateOne, InsertOne, ...).
+        counts = dict(inserted_count=0, matched_count=0, modified_count=0, deleted_count=0)
+        with self.lock:
+            for request in requests:
+                kind = type(request).__name__
+                if kind == 'InsertOne':
+                    self.insert_one(request._doc)
+                    counts['inserted_count'] += 1
+                elif kind in ('UpdateOne', 'UpdateMany'):
+                    upsert = bool(getattr(request, '_upsert', False))
+                    result = self._update(request._filter, request._doc, kind == 'UpdateMany', upsert)
+                    counts['matched_count'] += result.matched_count
+                    counts['modified_count'] += result.modified_count
+                elif kind in ('DeleteOne', 'DeleteMany'):
+                    counts['deleted_count'] += self._delete(request._filter, kind == 'DeleteMany').deleted_count
+                else: raise ValueError(f'Unsupported bulk request {kind}')
+        return Result(acknowledged=True, **counts)
+
+
+class MemoryDatabase:
+    def __init__(self, name: str):
+        self.name, self.collections = name, {}
+        self.lock = threading.Lock()
+
+    def __getitem__(self, name: str) -> MemoryCollection:
+        with self.lock:
+            if name not in self.collections: self.collections[name] = MemoryCollection(name)
+            return self.collections[name]
+
+    def list_collection_names(self) -> list[str]:
+        return list(self.collections)
+
+
+class MemoryClient:
+    def __init__(self, *args, **kwargs):
+        # Same shape as pymongo.MongoClient: client[database][collection].
+        self.databases = {}
+        self.lock = threading.Lock()
+
+    def __getitem__(self, name: str) -> MemoryDatabase:
+        with self.lock:
+            if name not in self.databases: self.databases[name] = MemoryDatabase(name)
+            return self.databases[name]
+
+    def close(self):
+        pass
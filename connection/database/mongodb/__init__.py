@@ -1,2 +1,3 @@
 from .accounts import Account
 from .networks import Network, Connection
+from .indexes import CONNECTION_TTL, create_indexes
@@ -8,8 +8,9 @@ class Account:
             self.id = _id if type(_id) == ObjectId else ObjectId(_id)
         self.collection = collection
 
-    def get(self, **kwargs):
-        return self.collection.find_one(kwargs or {'_id': self.id})
+    def get(self, projection: dict or list = None, **kwargs):
+        # The projection limits the fetched fields to the ones needed.
+        return self.collection.find_one(kwargs or {'_id': self.id}, projection)
 
     def create(self, **kwargs):
         kwargs['id'] = self.collection.insert_one(kwargs).inserted_id
@@ -19,9 +20,16 @@ class Account:
     def delete(self, **kwargs):
         return self.collection.delete_one(kwargs or {'_id': self.id})
 
-    def filter(self, skip: int = 0, limit: int = 100, **kwargs):
-        return self.collection.find(kwargs).skip(skip).limit(limit)
+    def filter(self, skip: int = 0, limit: int = 100, projection: dict or list = None, **kwargs):
+        return self.collection.find(kwargs, projection).skip(skip).limit(limit)
 
     def update(self, **kwargs):
         self.collection.update_one({"_id": self.id}, {"$set": kwargs})
         return self.get()
+
+    def set_rate_limit(self, rate: float or None, burst: float = None, mode: str = 'drop'):
+        # Bandwidth limit in bytes per second, `mode` is 'drop' or 'queue'.
+        # A rate of None removes the limit.
+        if rate is None: return self.collection.update_one({'_id': self.id}, {'$unset': {'rate_limit': ''}})
+        rate_limit = dict(rate=rate, burst=burst or rate, mode=mode)
+        return self.collection.update_one({'_id': self.id}, {'$set': {'rate_limit': rate_limit}})
@@ -0,0 +1,24 @@
+# Connections not refreshed for this many seconds are removed by MongoDB.
+CONNECTION_TTL = 86400
+
+# Indexes used by the lookups of the server, they are created at start-up
+# and creating an index that already exists is a no-op.
+INDEXES = {
+    'accounts': [dict(keys='username', unique=True)],
+    'connections': [
+        dict(keys='connection'),
+        dict(keys='account_id'),
+        dict(keys='ticket'),
+        dict(keys='last_seen', expireAfterSeconds=CONNECTION_TTL),
+        dict(keys=[('network_id', 1), ('ip_address', 1)])
+    ]
+}
+
+
+def create_indexes(database) -> list[str]:
+    names = []
+    for collection, indexes in INDEXES.items():
+        for index in indexes:
+            arguments = dict(index)
+            names.append(database[collection].create_index(arguments.pop('keys'), **arguments))
+    return names
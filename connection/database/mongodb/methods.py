@@ -1,18 +1,27 @@
+import ipaddress
 import platform
 import subprocess
 
 
 def new_address(default_address: str, address_id: int):
-    # Split the default address into a list of integers.
-    ip_address = list(map(int, default_address.split('.')))
-    ip_address: list[int] = [*ip_address[:-1], address_id]
-    # Handle carry-over if necessary (e.g., for IP octets)
-    for index in range(4)[::-1]:
-        value = ip_address[index]
-        ip_address[index] = value - 255 * (value // 255)
-        if index != 0: ip_address[index - 1] += value // 255
+    # Convert the default address into an integer and replace the last
+    # octet with the address id, so that ids above 255 carry over into
+    # the upper octets (e.g., 10.0.0.0 + 256 => 10.0.1.0).
+    base = int(ipaddress.IPv4Address(default_address)) & ~0xFF
     # Convert the modified address back to a string.
-    return '.'.join(str(n) for n in ip_address)
+    return str(ipaddress.IPv4Address(base + address_id))
+
+
+def address_id(default_address: str, ip_address: str) -> int:
+    # Inverse of new_address, the id of an address inside the network.
+    base = int(ipaddress.IPv4Address(default_address)) & ~0xFF
+    return int(ipaddress.IPv4Address(ip_address)) - base
+
+
+def host_limit(network_range: str) -> int:
+    # Highest address id inside the range, the network (0) and broadcast
+    # ids are never handed out.
+    return max(2 ** (32 - int(network_range.split('/')[1])) - 2, 0)
 
 
 def network_properties(network_range: tuple or str = None) -> tuple:
@@ -1,11 +1,12 @@
+import datetime
 import os
 
 from bson import ObjectId
 from pymongo.collection import Collection
 
 from .accounts import Account
-from .methods import network_properties, new_address
-from ..exceptions import AddressConflict
+from .methods import address_id, host_limit, network_properties, new_address
+from ..exceptions import AddressPoolExhausted
 
 
 class Network(Account):
@@ -15,40 +16,116 @@ class Network(Account):
     def create(self, network_range: str or tuple, max_address: int):
         properties = network_properties(network_range)
         arguments = dict(subnet_mask=properties[1], network_range=properties[2])
-        return super().create(max_address=max_address, connections={}, **arguments)
+        # The address pool is the next never used address id plus a free
+        # list of released ids, both updated atomically.
+        pool = dict(next_address=1, released=[])
+        # The pool never grows past the broadcast address of the range.
+        max_address = min(max_address, host_limit(properties[2]))
+        return super().create(max_address=max_address, connections={}, **pool, **arguments)
+
+    def _prepare_pool(self, network: dict):
+        # Networks created before the address pool existed start counting
+        # after the highest address already assigned.
+        base_address = network['network_range'].split('/')[0]
+        used = [address_id(base_address, ip) for ip in network.get('connections', {}).values() if ip]
+        pool = dict(next_address=max(used, default=0) + 1, released=[])
+        self.collection.update_one({'_id': self.id, 'next_address': {'$exists': False}}, {'$set': pool})
 
     def _get_address(self):
-        network, address = self.get(), None
+        fields = dict(network_range=1, max_address=1, next_address=1)
+        network = self.collection.find_one({'_id': self.id}, fields)
+        if 'next_address' not in network: self._prepare_pool(network)
         base_address = network['network_range'].split('/')[0]
-        # Iterate through available IP addresses in the network.
-        for address_id in range(network['max_address']):
-            # If the IP address is not in use, assign it to
-            # the account.
-            address = new_address(base_address, address_id)
-            if address not in network['connections'].values():
-                break
-        return address
+        # Reuse a released address first.
+        query = {'_id': self.id, 'released.0': {'$exists': True}}
+        update, fields = {'$pop': {'released': -1}}, {'released': {'$slice': 1}, 'next_address': 1}
+        released = self.collection.find_one_and_update(query, update, fields)
+        if released is not None and released['released']:
+            return new_address(base_address, released['released'][0])
+        # Otherwise take the next address that was never assigned.
+        max_address = min(network['max_address'], host_limit(network['network_range']))
+        query = {'_id': self.id, 'next_address': {'$lte': max_address}}
+        update, fields = {'$inc': {'next_address': 1}}, {'next_address': 1}
+        pool = self.collection.find_one_and_update(query, update, fields)
+        if pool is None: raise AddressPoolExhausted(network['network_range']).exhausted()
+        return new_address(base_address, pool['next_address'])
 
     def to_network(self, account: Account):
-        network, account_details = self.get(), account.get()
-        # If not, add the network ID to the account's networks
-        # with an initial empty IP address.
-        if network['_id'] not in account_details['networks']:
-            networks = account_details['networks']
-            networks[self.id.__str__()] = dict(ip_address=None)
-            account.update(networks=networks)
-        # Try to get the IP address from network's connections.
-        arguments = account.id, self._get_address()
-        ip_address = network['connections'].get(*arguments)
-        address_list = network['connections'].items()
-        address_list = {value: key for key, value in address_list}
-        if account.id.__str__() not in network['connections']:
-            network['connections'][account.id.__str__()] = ip_address
-            if ip_address in address_list:
-                raise AddressConflict(ip_address).already_defined()
-            # Update the network with the new connections.
-            self.update(connections=network['connections'])
-        return ip_address
+        network_id, account_id = self.id.__str__(), account.id.__str__()
+        # Add the network ID to the account's networks with an initial
+        # empty IP address, without rewriting the other networks.
+        query = {'_id': account.id, f'networks.{network_id}': {'$exists': False}}
+        account.collection.update_one(query, {'$set': {f'networks.{network_id}': dict(ip_address=None)}})
+        # Return the IP address already assigned to the account, if any.
+        field = f'connections.{account_id}'
+        network = self.collection.find_one({'_id': self.id}, {field: 1})
+        if account_id in network.get('connections', {}):
+            return network['connections'][account_id]
+        ip_address = self._get_address()
+        # Only set the address if no concurrent join assigned one first.
+        query = {'_id': self.id, field: {'$exists': False}}
+        if self.collection.update_one(query, {'$set': {field: ip_address}}).modified_count:
+            return ip_address
+        self._release_address(ip_address)
+        return self.collection.find_one({'_id': self.id}, {field: 1})['connections'][account_id]
+
+    def _get_addresses(self, count: int) -> list[str]:
+        # Take a block of addresses with a single update of the pool, the
+        # released ones are still taken one at a time.
+        addresses = []
+        while len(addresses) < count:
+            fields = dict(network_range=1, max_address=1, next_address=1, released={'$slice': 1})
+            network = self.collection.find_one({'_id': self.id}, fields)
+            if 'next_address' not in network:
+                self._prepare_pool(network)
+                continue
+            if network.get('released'):
+                addresses.append(self._get_address())
+                continue
+            base_address, first = network['network_range'].split('/')[0], network['next_address']
+            max_address = min(network['max_address'], host_limit(network['network_range']))
+            block = min(count - len(addresses), max_address - first + 1)
+            if block <= 0:
+                [self._release_address(ip_address) for ip_address in addresses]
+                raise AddressPoolExhausted(network['network_range']).exhausted()
+            # Only claim the block if no other join moved the pool meanwhile.
+            query = {'_id': self.id, 'next_address': first}
+            if self.collection.update_one(query, {'$inc': {'next_address': block}}).modified_count:
+                addresses += [new_address(base_address, first + index) for index in range(block)]
+        return addresses
+
+    def join_many(self, accounts: Collection, account_ids: list) -> dict[str, str]:
+        # Bulk version of to_network(): the accounts without an address get
+        # one from a block of the pool, written with one update of the
+        # network and one bulk write of the accounts.
+        from pymongo import UpdateOne
+        network_id, account_ids = self.id.__str__(), [str(account_id) for account_id in account_ids]
+        fields = {f'connections.{account_id}': 1 for account_id in account_ids}
+        assigned = dict(self.collection.find_one({'_id': self.id}, fields).get('connections', {}))
+        missing = [account_id for account_id in account_ids if account_id not in assigned]
+        if not missing: return assigned
+        addresses = dict(zip(missing, self._get_addresses(len(missing))))
+        update = {f'connections.{account_id}': ip_address for account_id, ip_address in addresses.items()}
+        self.collection.update_one({'_id': self.id}, {'$set': update})
+        requests = [UpdateOne({'_id': ObjectId(account_id), f'networks.{network_id}': {'$exists': False}},
+                              {'$set': {f'networks.{network_id}': dict(ip_address=None)}}) for account_id in missing]
+        accounts.bulk_write(requests, ordered=False)
+        return {**assigned, **addresses}
+
+    def release_addresses(self, addresses: dict) -> int:
+        # Give back the addresses of several accounts (account id to address)
+        # with one bulk write. Each address is unset and pushed on the free
+        # list by the same update, only while the account still holds it.
+        from pymongo import UpdateOne
+        if not addresses: return 0
+        network = self.collection.find_one({'_id': self.id}, dict(network_range=1))
+        if network is None: return 0
+        base_address = network['network_range'].split('/')[0]
+        requests = [UpdateOne({'_id': self.id, f'connections.{account_id}': ip_address},
+                              {'$unset': {f'connections.{account_id}': ''},
+                               '$push': {'released': address_id(base_address, ip_address)}})
+                    for account_id, ip_address in addresses.items()]
+        return self.collection.bulk_write(requests, ordered=False).modified_count
 
 
 class Connection(Account):
@@ -56,11 +133,17 @@ class Connection(Account):
         super().__init__(collection, _id)
         self.close, self.length = lambda **kwargs: self.delete(**kwargs), 40
 
-    def create(self, network: Network, account: Account, ip_address: str, socket: tuple):
+    def create(self, network: Network, account: Account, ip_address: str, socket: tuple, **options):
+        # Extra options hold what was negotiated during the handshake.
         return super().create(
             account_id=account.id,
             encrypt=os.urandom(int(self.length / 2)).hex(),
             network_id=network.id,
             ip_address=ip_address,
-            connection=':'.join(map(str, socket))
+            connection=':'.join(map(str, socket)),
+            ticket=os.urandom(8).hex(),
+            # Refreshed by the reaper while the session lives, the TTL index
+            # removes the rows a crashed server never reaped.
+            last_seen=datetime.datetime.now(datetime.timezone.utc),
+            **options
         )
@@ -0,0 +1,166 @@
+import asyncio
+import queue
+import threading
+import time
+
+
+class WorkerPool:
+    def __init__(self, workers: int = 4, queue_size: int = 1024, batch_size: int = 32):
+        # One bounded queue per worker, packets of the same session always
+        # land on the same queue so they are processed in order.
+        self.queues = [queue.Queue(queue_size) for _ in range(workers)]
+        self.threads, self.dropped, self.batch_size = [], 0, batch_size
+
+    def start(self, handler):
+        for packets in self.queues:
+            thread = threading.Thread(target=self.work, args=(packets, handler))
+            thread.daemon = True
+            self.threads.append(thread), thread.start()
+
+    def work(self, packets: queue.Queue, handler):
+        running = True
+        while running:
+            items = [packets.get()]
+            # Take every packet already queued, up to the batch size, so the
+            # handler can send them with a single system call.
+            while len(items) < self.batch_size and not packets.empty():
+                items.append(packets.get_nowait())
+            if None in items:
+                running = False
+                items = items[:items.index(None)]
+            try: handler(items)
+            except Exception as error: print('Packets dropped:', error)
+
+    def submit(self, key, item: tuple) -> bool:
+        try:
+            self.queues[hash(key) % len(self.queues)].put_nowait(item)
+            return True
+        except queue.Full:
+            # Apply backpressure by dropping instead of growing the queue.
+            self.dropped += 1
+            return False
+
+    def stop(self):
+        [packets.put(None) for packets in self.queues]
+        [thread.join() for thread in self.threads]
+        self.threads = []
+
+
+class ThreadEngine:
+    def __init__(self, workers: int = 4, queue_size: int = 1024, batch_size: int = 32):
+        self.pool = WorkerPool(workers, queue_size, batch_size)
+        self.running = False
+
+    @property
+    def dropped(self):
+        return self.pool.dropped
+
+    def serve(self, server, tunnel: bool):
+        def handler(items: list):
+            outputs, traces = [], []
+            for session, connection, trace in items:
+                try: forwarded = server.forward(session, tunnel, connection, trace)
+                except Exception as error:
+                    print('Packet dropped:', error)
+                    continue
+                outputs.extend(forwarded)
+                if trace: traces.append((trace, bool(forwarded)))
+            # Bundles of coalesced packets are sealed once per batch.
+            outputs.extend(server.flush())
+            if outputs: server.io.send_batch(outputs)
+            # Sampled packets share the time of the batched send.
+            for trace, sent in traces: trace.finish('send' if sent else None)
+
+        self.running = True
+        self.pool.start(handler)
+        while self.running:
+            # The receive stage includes the wait for the first datagram.
+            tracer = server.tracer
+            received = time.perf_counter() if tracer is not None else None
+            try: datagrams = server.io.recv_batch()
+            except OSError:
+                # VPNServer.close() shuts the socket down to stop the loop.
+                if not self.running: break
+                raise
+            if not self.running: break
+            for connection in datagrams:
+                trace = tracer.sample(received) if tracer is not None else None
+                session = server.classify(connection)
+                if trace: trace.mark('classify')
+                if session is not None:
+                    self.pool.submit(connection[1], (session, connection, trace))
+
+    def stop(self):
+        if not self.running: return
+        self.running = False
+        self.pool.stop()
+
+
+class DatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, engine, server, tunnel: bool):
+        self.engine, self.server, self.tunnel = engine, server, tunnel
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, address: tuple):
+        tracer = self.server.tracer
+        trace = tracer.sample() if tracer is not None else None
+        session = self.server.classify((data, address))
+        if trace: trace.mark('classify')
+        if session is None: return
+        try: self.engine.packets.put_nowait((session, (data, address), trace))
+        except asyncio.QueueFull: self.engine.dropped += 1
+
+    def error_received(self, error):
+        print('Datagram error:', error)
+
+
+class AsyncioEngine:
+    def __init__(self, queue_size: int = 1024, batch_size: int = 64):
+        self.queue_size, self.batch_size = queue_size, batch_size
+        self.loop: asyncio.AbstractEventLoop or None = None
+        self.packets: asyncio.Queue or None = None
+        self.stopped: asyncio.Event or None = None
+        self.dropped = 0
+
+    async def consume(self, protocol: DatagramProtocol):
+        # A single consumer keeps every flow in arrival order and yields to
+        # the event loop after each batch so reads are not starved.
+        while True:
+            items = [await self.packets.get()]
+            while len(items) < self.batch_size and not self.packets.empty():
+                items.append(self.packets.get_nowait())
+            for session, connection, trace in items:
+                try: forwarded = protocol.server.forward(session, protocol.tunnel, connection, trace)
+                except Exception as error:
+                    print('Packet dropped:', error)
+                    continue
+                [protocol.transport.sendto(*output) for output in forwarded]
+                if trace: trace.finish('send' if forwarded else None)
+            [protocol.transport.sendto(*output) for output in protocol.server.flush()]
+
+    async def run(self, server, tunnel: bool):
+        self.loop = asyncio.get_running_loop()
+        self.packets, self.stopped = asyncio.Queue(self.queue_size), asyncio.Event()
+        protocol = DatagramProtocol(self, server, tunnel)
+        transport, _ = await self.loop.create_datagram_endpoint(lambda: protocol, sock=server.server)
+        consumer = asyncio.create_task(self.consume(protocol))
+        try: await self.stopped.wait()
+        finally: consumer.cancel(), transport.close()
+
+    def serve(self, server, tunnel: bool):
+        asyncio.run(self.run(server, tunnel))
+
+    def stop(self):
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.stopped.set)
+
+
+ENGINES = dict(threads=ThreadEngine, asyncio=AsyncioEngine)
+
+
+def new_engine(engine: str or object = 'threads', **kwargs):
+    # Accept either the name of a built-in engine or an engine instance.
+    return ENGINES[engine](**kwargs) if type(engine) is str else engine
@@ -0,0 +1,290 @@
+import collections
+import os
+import select
+import socket
+import struct
+import threading
+import time
+from typing import Optional
+
+from connection.packet import PacketHeader, ipv4_udp_packet, parse_ipv4, rewrite_ipv4
+from connection.timers import TimerWheel
+
+ICMP, TCP, UDP = 1, 6, 17
+# Idle timeouts in seconds by protocol, TCP flows that saw a FIN or a RST
+# expire after CLOSING_TIMEOUT.
+TIMEOUTS = {TCP: 300.0, UDP: 60.0, ICMP: 30.0}
+CLOSING_TIMEOUT = 10.0
+TCP_FIN_RST = 0x05
+# External ports of the TCP and ICMP flows. The kernel does not know about
+# them, so they sit above the Linux ephemeral range (32768-60999 by
+# default) and never collide with the host's own connections.
+NAT_PORTS = 61000, 65535
+
+
+class Flow:
+    __slots__ = 'key', 'network_id', 'ip_address', 'protocol', 'sport', 'remote', 'port', 'socket', \
+                'last_seen', 'timeout'
+
+    def __init__(self, key: tuple, remote: tuple, timeout: float):
+        # The key is (network id, virtual ip, protocol, source port, remote ip, remote port).
+        self.key, self.remote, self.timeout = key, remote, timeout
+        self.network_id, self.ip_address, self.protocol, self.sport = key[:4]
+        # External port (or ICMP identifier) of raw flows, socket of UDP flows.
+        self.port: int or None = None
+        self.socket: socket.socket or None = None
+        self.last_seen = time.monotonic()
+
+
+def ephemeral_overlap(ports: tuple) -> bool:
+    # Whether the kernel may pick one of `ports` for a socket of the host,
+    # ports listed in ip_local_reserved_ports are never picked.
+    try:
+        with open('/proc/sys/net/ipv4/ip_local_port_range') as file: first, last = map(int, file.read().split())
+        with open('/proc/sys/net/ipv4/ip_local_reserved_ports') as file: reserved = file.read().strip()
+    except (OSError, ValueError): return False
+    overlap = set(range(max(first, ports[0]), min(last, ports[1]) + 1))
+    for item in filter(None, reserved.split(',')):
+        bounds = list(map(int, item.split('-')))
+        overlap -= set(range(bounds[0], bounds[-1] + 1))
+    return bool(overlap)
+
+
+class PortPool:
+    def __init__(self, first: int, last: int):
+        self.free = collections.deque(range(first, last + 1))
+
+    def acquire(self) -> Optional[int]:
+        return self.free.popleft() if self.free else None
+
+    def release(self, port: int):
+        self.free.append(port)
+
+
+class FlowTable:
+    def __init__(self, max_flows: int = 65536, ports: tuple = NAT_PORTS, tick: float = 1.0):
+        # Flows by key for the outgoing packets, by (protocol, external port,
+        # remote ip, remote port) for the replies of raw flows and by file
+        # descriptor for the replies of UDP flows. Every lookup is a dict get.
+        self.flows: dict[tuple, Flow] = {}
+        self.replies: dict[tuple, Flow] = {}
+        self.sockets: dict[int, Flow] = {}
+        self.ports = {TCP: PortPool(*ports), ICMP: PortPool(*ports)}
+        self.wheel, self.max_flows = TimerWheel(tick), max_flows
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.flows)
+
+    @staticmethod
+    def reply_key(flow: Flow) -> tuple:
+        return flow.protocol, flow.port, flow.remote[0], flow.remote[1]
+
+    def add(self, flow: Flow) -> Optional[Flow]:
+        with self.lock:
+            # Like conntrack, new flows are refused while the table is full.
+            if len(self.flows) >= self.max_flows: return None
+            if flow.socket is None:
+                flow.port = self.ports[flow.protocol].acquire()
+                if flow.port is None: return None
+                self.replies[self.reply_key(flow)] = flow
+            else: self.sockets[flow.socket.fileno()] = flow
+            self.flows[flow.key] = flow
+        self.wheel.schedule(flow.key, flow.timeout)
+        return flow
+
+    def remove(self, flow: Flow):
+        with self.lock:
+            if self.flows.get(flow.key) is not flow: return
+            del self.flows[flow.key]
+            if flow.socket is None:
+                self.replies.pop(self.reply_key(flow), None)
+                self.ports[flow.protocol].release(flow.port)
+            else: self.sockets.pop(flow.socket.fileno(), None)
+        self.wheel.cancel(flow.key)
+
+    def expire(self, now: float = None) -> list[Flow]:
+        now = time.monotonic() if now is None else now
+        expired = []
+        for key in self.wheel.advance(now):
+            flow = self.flows.get(key)
+            if flow is None: continue
+            # Flows that saw traffic since they were scheduled get the rest
+            # of their timeout.
+            idle = now - flow.last_seen
+            if idle < flow.timeout: self.wheel.schedule(key, flow.timeout - idle)
+            else: self.remove(flow), expired.append(flow)
+        return expired
+
+
+class EgressEngine:
+    def __init__(self, server, address: str = None, max_flows: int = 65536,
+                 ports: tuple = NAT_PORTS, timeouts: dict = None):
+        # Source address of the rewritten packets, the address of the
+        # default route when not set.
+        self.server, self.address, self.ports = server, address, ports
+        self.table = FlowTable(max_flows, ports)
+        self.timeouts = {**TIMEOUTS, **(timeouts or {})}
+        # Raw sockets to send the rewritten TCP and ICMP packets and to
+        # receive their replies, they need CAP_NET_RAW.
+        self.source, self.raw = None, None
+        self.listeners: dict[int, socket.socket] = {}
+        self.poller: select.epoll or None = None
+        self.wakeup = os.pipe()
+        self.running, self.thread = False, None
+        registry = server.metrics.registry
+        self.packets = registry.counter('vpn_egress_packets_total', 'Packets through the egress by direction.',
+                                        ('direction',))
+        self.dropped = registry.counter('vpn_egress_dropped_total', 'Packets dropped by the egress by reason.',
+                                        ('reason',))
+        registry.gauge('vpn_egress_flows', 'Flows tracked by the egress.', lambda: len(self.table))
+
+    def drop(self, reason: str):
+        self.dropped.add(1, (reason,))
+
+    def source_address(self) -> str:
+        if self.address: return self.address
+        # Connecting a UDP socket picks the source address without sending.
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+            try:
+                probe.connect(('192.0.2.1', 9))
+                return probe.getsockname()[0]
+            except OSError: return '0.0.0.0'
+
+    def new_flow(self, key: tuple, header: PacketHeader) -> Optional[Flow]:
+        flow = Flow(key, (header.dst, key[5]), self.timeouts[header.protocol])
+        if header.protocol == UDP:
+            # UDP flows go through a connected socket, the kernel picks the
+            # external port and only delivers the replies of that flow.
+            flow.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            flow.socket.setblocking(False)
+            flow.socket.bind((self.address or '0.0.0.0', 0))
+            flow.socket.connect(flow.remote)
+        elif self.raw is None:
+            self.drop('raw_unavailable')
+            return None
+        if self.table.add(flow) is None:
+            if flow.socket is not None: flow.socket.close()
+            self.drop('table_full')
+            return None
+        if flow.socket is not None: self.poller.register(flow.socket.fileno(), select.EPOLLIN)
+        return flow
+
+    def send(self, session, header: PacketHeader, packet: bytes) -> bool:
+        # Called by forward() for packets without a destination session.
+        if header.version != 4: return self.drop('ipv6')
+        if header.protocol not in self.timeouts: return self.drop('protocol')
+        if header.src != session.ip_address: return self.drop('spoofed')
+        sport, dport = header.sport, header.dport
+        if header.protocol == ICMP:
+            # Only echo requests are translated, keyed by their identifier.
+            if len(packet) < header.offset + 8 or packet[header.offset] != 8: return self.drop('icmp_type')
+            sport, dport = struct.unpack_from('!H', packet, header.offset + 4)[0], 0
+        elif sport == 0: return self.drop('fragment')
+        key = session.network_id, header.src, header.protocol, sport, header.dst, dport
+        flow = self.table.flows.get(key) or self.new_flow(key, header)
+        if flow is None: return False
+        flow.last_seen = time.monotonic()
+        try:
+            if flow.socket is not None: flow.socket.send(memoryview(packet)[header.offset + 8:])
+            else:
+                if header.protocol == TCP and packet[header.offset + 13] & TCP_FIN_RST:
+                    flow.timeout = CLOSING_TIMEOUT
+                self.raw.sendto(rewrite_ipv4(packet, src=self.source, sport=flow.port), (header.dst, 0))
+        except OSError: return self.drop('send')
+        self.packets.add(1, ('out',))
+        return True
+
+    def reply(self, flow: Flow, packet: bytes or bytearray, header: PacketHeader = None):
+        # Encrypt the reply for the session currently holding the flow's
+        # virtual ip, it may have reconnected since the flow was created.
+        session = self.server.sessions.route(flow.network_id, flow.ip_address)
+        if session is None: return self.drop('no_session')
+        flow.last_seen = time.monotonic()
+        # Remote hosts answer SYNs with the MSS of their own link.
+        guard = self.server.mtu_guard
+        if header is not None: packet = guard.clamp(packet, header, session.mtu)
+        if len(packet) > session.mtu: guard.oversize.add(1)
+        data = self.server.seal(session, bytes(packet))
+        self.server.update_transfer(session, len(data))
+        self.server.metrics.sent(session.labels, len(data))
+        try: self.server.server.sendto(data, session.address)
+        except OSError: return self.drop('reply')
+        self.packets.add(1, ('in',))
+
+    def receive_flow(self, flow: Flow, batch: int = 64):
+        for _ in range(batch):
+            try: payload, (remote, port) = flow.socket.recvfrom(65535)
+            except (BlockingIOError, OSError): return
+            self.reply(flow, ipv4_udp_packet(remote, flow.ip_address, port, flow.sport, payload))
+
+    def receive_raw(self, listener: socket.socket, batch: int = 64):
+        for _ in range(batch):
+            try: packet = listener.recv(65535)
+            except (BlockingIOError, OSError): return
+            header = parse_ipv4(memoryview(packet))
+            if header is None: continue
+            if header.protocol == ICMP:
+                # Echo replies carry the identifier given by the egress.
+                if len(packet) < header.offset + 8 or packet[header.offset] != 0: continue
+                port = struct.unpack_from('!H', packet, header.offset + 4)[0]
+                key = ICMP, port, header.src, 0
+            else: key = header.protocol, header.dport, header.src, header.sport
+            flow = self.table.replies.get(key)
+            if flow is None: continue
+            if header.protocol == TCP and packet[header.offset + 13] & TCP_FIN_RST:
+                flow.timeout = CLOSING_TIMEOUT
+            if header.protocol == TCP: self.reply(flow, rewrite_ipv4(packet, dst=flow.ip_address, dport=flow.sport), header)
+            else: self.reply(flow, rewrite_ipv4(packet, dst=flow.ip_address, sport=flow.sport))
+
+    def close_flow(self, flow: Flow):
+        if flow.socket is None: return
+        try: self.poller.unregister(flow.socket.fileno())
+        except (OSError, ValueError): pass
+        flow.socket.close()
+
+    def close_raw(self):
+        for raw in [self.raw] + list(self.listeners.values()):
+            if raw is not None: raw.close()
+        self.raw, self.listeners = None, {}
+
+    def run(self):
+        listeners = {listener.fileno(): listener for listener in self.listeners.values()}
+        while self.running:
+            for fileno, _ in self.poller.poll(self.table.wheel.tick):
+                if fileno in listeners: self.receive_raw(listeners[fileno])
+                elif fileno in self.table.sockets: self.receive_flow(self.table.sockets[fileno])
+            # Idle flows are expired by the timer wheel on this thread.
+            [self.close_flow(flow) for flow in self.table.expire()]
+
+    def start(self):
+        if self.thread is not None: return self
+        self.source, self.poller = self.source_address(), select.epoll()
+        if ephemeral_overlap(self.ports):
+            print('Egress: ports {}-{} overlap net.ipv4.ip_local_port_range, reserve them with '
+                  'net.ipv4.ip_local_reserved_ports'.format(*self.ports))
+        self.poller.register(self.wakeup[0], select.EPOLLIN)
+        try:
+            self.raw = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_RAW)
+            for protocol in (TCP, ICMP):
+                listener = self.listeners[protocol] = socket.socket(socket.AF_INET, socket.SOCK_RAW, protocol)
+                listener.setblocking(False)
+                self.poller.register(listener.fileno(), select.EPOLLIN)
+        except PermissionError:
+            # Without CAP_NET_RAW only UDP flows are translated.
+            print('Egress: raw sockets unavailable, only UDP is forwarded')
+            [self.poller.unregister(listener) for listener in self.listeners.values()]
+            self.close_raw()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running, thread, self.thread = False, self.thread, None
+        os.write(self.wakeup[1], b'\x00')
+        if thread is not None: thread.join()
+        for flow in list(self.table.flows.values()):
+            self.table.remove(flow), self.close_flow(flow)
+        self.close_raw()
+        if self.poller is not None: self.poller.close()
@@ -0,0 +1,151 @@
+import multiprocessing
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from connection.limits import TokenBucket
+
+# Handshake options are appended after the credentials by the client and
+# after the configuration by the server as (type, length, value) entries.
+# Peers that do not know about them simply ignore the trailing bytes.
+OPTION_CIPHER = 0x01
+# Coalescing of small packets into bundle frames, needs a framed cipher.
+OPTION_COALESCE = 0x02
+# Payload compression codecs offered in order of preference, needs the frame
+# flags of a framed cipher.
+OPTION_COMPRESSION = 0x03
+# Session ticket sent by the server, the client adds it to its frames so the
+# session survives a change of address.
+OPTION_SESSION = 0x04
+# MTU of the path to the server offered by the client, and the tunnel MTU
+# the server replies with, 16-bit each.
+OPTION_MTU = 0x05
+
+
+def pack_options(options: dict[int, bytes]) -> bytes:
+    return b''.join(bytes([kind, len(value)]) + value for kind, value in options.items())
+
+
+def unpack_options(data: bytes) -> dict[int, bytes]:
+    options, offset = {}, 0
+    while offset + 2 <= len(data):
+        kind, length = data[offset], data[offset + 1]
+        options[kind] = data[offset + 2:offset + 2 + length]
+        offset += 2 + length
+    return options
+
+
+def is_handshake(packet: bytes, pending: int = 0x01) -> bool:
+    # A credentials packet starts with the pending code and its username and
+    # password lengths must fit in the datagram.
+    if len(packet) < 3 or packet[0] != pending: return False
+    return len(packet) > 2 + packet[1] and len(packet) >= 3 + packet[1] + packet[2 + packet[1]]
+
+
+def check_password(password: bytes, hashed: bytes) -> bool:
+    import bcrypt
+    return bcrypt.checkpw(password, hashed)
+
+
+def new_process_pool(processes: int = None) -> ProcessPoolExecutor:
+    # Pool of the bcrypt work. Forked workers do not re-import the main
+    # module, spawn is only used where fork is not available.
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('fork' if 'fork' in methods else 'spawn')
+    return ProcessPoolExecutor(processes, mp_context=context)
+
+
+class HandshakeStage:
+    def __init__(self, server, workers: int = 4, processes: int = None, queue_size: int = 256,
+                 rate: float = 2.0, burst: float = 5.0, max_sources: int = 65536):
+        self.server, self.workers, self.processes = server, workers, processes
+        # Bounded queue between the receive loop and the control plane.
+        self.queue = queue.Queue(queue_size)
+        # Token bucket per source ip to limit handshake attempts.
+        self.rate, self.burst, self.max_sources = rate, burst, max_sources
+        self.sources: dict[str, TokenBucket] = {}
+        self.pool: ProcessPoolExecutor or None = None
+        self.pool_lock = threading.Lock()
+        self.threads: list[threading.Thread] = []
+        # Counters and latency (queue wait + processing) in seconds.
+        self.accepted = self.queue_full = self.rate_limited = 0
+        self.completed = self.failed = 0
+        self.latency_total = self.latency_max = 0.0
+
+    def stats(self) -> dict:
+        done = self.completed + self.failed
+        return dict(queue_depth=self.queue.qsize(), queue_size=self.queue.maxsize,
+                    accepted=self.accepted, queue_full=self.queue_full,
+                    rate_limited=self.rate_limited, completed=self.completed,
+                    failed=self.failed, latency_max=self.latency_max,
+                    latency_average=self.latency_total / done if done else 0.0)
+
+    def allow(self, ip_address: str) -> bool:
+        bucket = self.sources.get(ip_address)
+        if bucket is None:
+            # Forget sources whose bucket is full again before growing.
+            if len(self.sources) >= self.max_sources:
+                now = time.monotonic()
+                self.sources = {key: value for key, value in self.sources.items()
+                                if value.refill(now) < value.burst}
+            # Under a flood from many sources nothing may be full again, the
+            # oldest ones are forgotten so the table stays bounded and is not
+            # pruned again for every new source.
+            if len(self.sources) >= self.max_sources:
+                for key in list(self.sources)[:max(self.max_sources // 8, 1)]: del self.sources[key]
+            bucket = self.sources[ip_address] = TokenBucket(self.rate, self.burst)
+        return bucket.consume()
+
+    def submit(self, connection: tuple[bytes, any]) -> bool:
+        # Called from the receive loop, it never blocks.
+        if not self.allow(connection[1][0]):
+            self.rate_limited += 1
+            return False
+        try: self.queue.put_nowait((time.monotonic(), connection))
+        except queue.Full:
+            self.queue_full += 1
+            return False
+        self.accepted += 1
+        return True
+
+    def new_pool(self) -> ProcessPoolExecutor:
+        with self.pool_lock:
+            # The pool is warmed up from start() before the data plane
+            # threads run, so they are not forked with it.
+            if self.pool is None: self.pool = new_process_pool(self.processes)
+            return self.pool
+
+    def check_password(self, password: bytes, hashed: bytes) -> bool:
+        # bcrypt runs in worker processes so it never holds the GIL of the
+        # forwarding threads.
+        return self.new_pool().submit(check_password, password, hashed).result()
+
+    def work(self):
+        while (item := self.queue.get()) is not None:
+            started, connection = item
+            try:
+                success = self.server.handshake(connection)
+            except Exception as error:
+                print('Handshake failed:', error)
+                success = False
+            elapsed = time.monotonic() - started
+            self.latency_total += elapsed
+            self.latency_max = max(self.latency_max, elapsed)
+            if success: self.completed += 1
+            else: self.failed += 1
+
+    def start(self):
+        self.new_pool().submit(int).result()
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self.work, daemon=True)
+            self.threads.append(thread), thread.start()
+        return self
+
+    def stop(self):
+        [self.queue.put(None) for _ in self.threads]
+        [thread.join() for thread in self.threads]
+        self.threads = []
+        with self.pool_lock:
+            if self.pool is not None: self.pool.shutdown(cancel_futures=True)
+            self.pool = None
@@ -0,0 +1,151 @@
+import heapq
+import itertools
+import threading
+import time
+from typing import Optional
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        # `rate` tokens are added per second, up to `burst` tokens.
+        self.rate, self.burst = rate, burst
+        self.tokens, self.updated = burst, time.monotonic()
+
+    def refill(self, now: float = None) -> float:
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+
+    def consume(self, amount: float = 1.0, now: float = None) -> bool:
+        if self.refill(now) < amount: return False
+        self.tokens -= amount
+        return True
+
+
+class BandwidthLimit:
+    def __init__(self, rate: float, burst: float = None, mode: str = 'drop', max_delay: float = 0.25):
+        # Rate in bytes per second and burst in bytes, one second of traffic
+        # by default.
+        self.bucket = TokenBucket(rate, burst or rate)
+        # 'drop' discards packets over the limit, 'queue' delays them for up
+        # to `max_delay` seconds before dropping.
+        self.mode, self.max_delay = mode, max_delay
+        self.lock = threading.Lock()
+        self.passed = self.delayed = self.dropped = 0
+
+    def update(self, rate: float, burst: float = None, mode: str = 'drop'):
+        with self.lock:
+            self.bucket.rate, self.bucket.burst, self.mode = rate, burst or rate, mode
+            self.bucket.tokens = min(self.bucket.tokens, self.bucket.burst)
+        return self
+
+    def charge(self, length: int, now: float) -> Optional[float]:
+        # Returns the delay before the packet can be sent, or None to drop it.
+        with self.lock:
+            tokens = self.bucket.refill(now)
+            if tokens >= length:
+                self.bucket.tokens -= length
+                self.passed += 1
+                return 0.0
+            # Queued packets borrow tokens, the debt is the delay.
+            delay = (length - tokens) / self.bucket.rate
+            if self.mode == 'queue' and delay <= self.max_delay:
+                self.bucket.tokens -= length
+                self.delayed += 1
+                return delay
+            self.dropped += 1
+            return None
+
+    def refund(self, length: int):
+        with self.lock: self.bucket.tokens += length
+
+    def stats(self) -> dict:
+        return dict(rate=self.bucket.rate, burst=self.bucket.burst, mode=self.mode,
+                    passed=self.passed, delayed=self.delayed, dropped=self.dropped)
+
+
+class RateLimiter:
+    def __init__(self, send, max_delay: float = 0.25):
+        # Limits shared by every session of an account or a network, keyed
+        # by the account and network ids as strings.
+        self.accounts: dict[str, BandwidthLimit] = {}
+        self.networks: dict[str, BandwidthLimit] = {}
+        self.max_delay = max_delay
+        # Delayed packets are released by a single thread through `send`,
+        # which receives a list of (packet, address) tuples.
+        self.send, self.delayed = send, []
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.running, self.thread = False, None
+
+    def configure(self, kind: str, key, limit: dict or None):
+        # `limit` is the rate_limit field of an account or network document.
+        limits, key = getattr(self, kind), str(key)
+        if not limit or not limit.get('rate'):
+            limits.pop(key, None)
+            return None
+        arguments = limit['rate'], limit.get('burst'), limit.get('mode', 'drop')
+        # Existing limits keep their tokens and counters.
+        if key in limits: return limits[key].update(*arguments)
+        limits[key] = BandwidthLimit(*arguments, max_delay=self.max_delay)
+        return limits[key]
+
+    def check(self, account_id, network_id, length: int) -> Optional[float]:
+        # Nothing to do on the packet path when no limit is configured.
+        if not self.accounts and not self.networks: return 0.0
+        account, network = self.accounts.get(str(account_id)), self.networks.get(network_id)
+        now, delay = time.monotonic(), 0.0
+        if account is not None:
+            delay = account.charge(length, now)
+            if delay is None: return None
+        if network is not None:
+            network_delay = network.charge(length, now)
+            if network_delay is None:
+                # The account is not charged for a packet the network dropped.
+                if account is not None: account.refund(length)
+                return None
+            delay = max(delay, network_delay)
+        return delay
+
+    def refund(self, account_id, network_id, length: int):
+        # Give back the tokens of a packet charged by check() but not sent.
+        for limit in self.accounts.get(str(account_id)), self.networks.get(network_id):
+            if limit is not None: limit.refund(length)
+
+    def delay(self, output: tuple, delay: float):
+        with self.condition:
+            heapq.heappush(self.delayed, (time.monotonic() + delay, next(self.sequence), output))
+            self.condition.notify()
+
+    def run(self):
+        while self.running:
+            with self.condition:
+                now = time.monotonic()
+                if not self.delayed or self.delayed[0][0] > now:
+                    self.condition.wait(self.delayed[0][0] - now if self.delayed else None)
+                    continue
+                outputs = []
+                while self.delayed and self.delayed[0][0] <= now:
+                    outputs.append(heapq.heappop(self.delayed)[2])
+            try: self.send(outputs)
+            except Exception as error: print('Delayed packets dropped:', error)
+
+    def stats(self) -> dict:
+        return dict(queued=len(self.delayed),
+                    accounts={key: limit.stats() for key, limit in self.accounts.items()},
+                    networks={key: limit.stats() for key, limit in self.networks.items()})
+
+    def start(self):
+        if self.thread is not None: return self
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        with self.condition:
+            self.running, thread, self.thread = False, self.thread, None
+            self.delayed = []
+            self.condition.notify()
+        if thread is not None: thread.join()
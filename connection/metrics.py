@@ -0,0 +1,282 @@
+import bisect
+import collections
+import math
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Default buckets of the packet size (bytes) and latency (seconds) histograms.
+SIZE_BUCKETS = 64, 128, 256, 512, 1024, 1280, 1500, 9000, 65535
+LATENCY_BUCKETS = 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 1e-2, 0.1
+
+
+def format_labels(names: tuple, values: tuple, extra: str = '') -> str:
+    def escape(value): return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    labels = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    labels += [extra] if extra else []
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+
+class Sharded:
+    def __init__(self, name: str, description: str, labels: tuple = ()):
+        self.name, self.description, self.labels = name, description, tuple(labels)
+        # Every thread writes to its own shard, readers add the shards up.
+        # The lock is only taken the first time a thread writes. Each shard
+        # comes with the folds its thread still has to apply.
+        self.local, self.shards, self.lock = threading.local(), [], threading.Lock()
+
+    def shard(self) -> dict:
+        try: shard, pending = self.local.shard
+        except AttributeError:
+            shard, pending = self.local.shard = {}, collections.deque()
+            with self.lock: self.shards.append((shard, pending))
+        while pending: self.move(shard, *pending.popleft())
+        return shard
+
+    @staticmethod
+    def move(shard: dict, labels: tuple, into: tuple, merge):
+        value = shard.pop(labels, None)
+        if value is not None: shard[into] = merge(shard[into], value) if into in shard else value
+
+    def collect(self, merge) -> dict:
+        totals = {}
+        with self.lock: shards = list(self.shards)
+        for shard, _ in shards:
+            for labels, value in shard.copy().items():
+                totals[labels] = merge(totals[labels], value) if labels in totals else value
+        return totals
+
+    def fold(self, labels: tuple, into: tuple, merge):
+        # Move the values of a label set into another one, used to forget
+        # closed sessions while keeping account and network totals. Writes
+        # are not locked, so the shards of other threads are folded by their
+        # own thread on its next write, the totals are right meanwhile.
+        own = getattr(self.local, 'shard', (None,))[0]
+        with self.lock: shards = list(self.shards)
+        for shard, pending in shards:
+            if shard is own: self.move(shard, labels, into, merge)
+            elif labels in shard: pending.append((labels, into, merge))
+
+
+class Counter(Sharded):
+    kind = 'counter'
+
+    def __init__(self, name: str, description: str, labels: tuple = (), half_life: float = 5.0):
+        super().__init__(name, description, labels)
+        # Rates are exponentially weighted averages updated when they are read.
+        self.half_life, self.previous, self.rates = half_life, (time.monotonic(), {}), {}
+        self.rate_lock = threading.Lock()
+
+    def add(self, amount: int or float = 1, labels: tuple = ()):
+        shard = self.shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def values(self) -> dict:
+        return self.collect(lambda a, b: a + b)
+
+    def value(self, labels: tuple = ()) -> int or float:
+        return self.values().get(labels, 0)
+
+    def rate(self) -> dict:
+        with self.rate_lock:
+            now, values = time.monotonic(), self.values()
+            if now > self.previous[0]:
+                elapsed, previous = now - self.previous[0], self.previous[1]
+                alpha = 1 - math.exp(-elapsed * math.log(2) / self.half_life)
+                for labels, value in values.items():
+                    current = max(value - previous.get(labels, 0), 0) / elapsed
+                    average = self.rates.get(labels)
+                    self.rates[labels] = current if average is None else average + alpha * (current - average)
+                # Label sets that were folded away stop having a rate.
+                self.rates = {labels: rate for labels, rate in self.rates.items() if labels in values}
+            self.previous = now, values
+            return dict(self.rates)
+
+    def forget(self, labels: tuple, into: tuple):
+        self.fold(labels, into, lambda a, b: a + b)
+
+    def snapshot(self) -> dict:
+        rates = self.rate()
+        return {labels: dict(value=value, rate=rates.get(labels, 0.0))
+                for labels, value in self.values().items()}
+
+    def exposition(self) -> list[str]:
+        return [f'{self.name}{format_labels(self.labels, labels)} {value}'
+                for labels, value in sorted(self.values().items())]
+
+
+class Histogram(Sharded):
+    kind = 'histogram'
+
+    def __init__(self, name: str, description: str, buckets: tuple, labels: tuple = ()):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: int or float, labels: tuple = ()):
+        shard = self.shard()
+        # Bucket counts followed by the sum of the observed values.
+        counts = shard.get(labels)
+        if counts is None: counts = shard[labels] = [0] * (len(self.buckets) + 2)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def values(self) -> dict:
+        return self.collect(lambda a, b: [x + y for x, y in zip(a, b)])
+
+    def quantile(self, quantile: float, labels: tuple = ()) -> float:
+        # Upper bound of the bucket holding the quantile.
+        counts = self.values().get(labels)
+        if not counts: return 0.0
+        total, seen = sum(counts[:-1]), 0
+        for index, count in enumerate(counts[:-1]):
+            seen += count
+            if seen >= quantile * total: return self.buckets[index] if index < len(self.buckets) else math.inf
+        return math.inf
+
+    def snapshot(self) -> dict:
+        snapshot = {}
+        for labels, counts in self.values().items():
+            count = sum(counts[:-1])
+            buckets = dict(zip(self.buckets + (math.inf,), counts[:-1]))
+            snapshot[labels] = dict(count=count, sum=counts[-1], buckets=buckets)
+        return snapshot
+
+    def exposition(self) -> list[str]:
+        lines = []
+        for labels, counts in sorted(self.values().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts[:-1]):
+                cumulative += count
+                bound = 'le="{}"'.format('+Inf' if bound == math.inf else repr(bound))
+                lines.append(f'{self.name}_bucket{format_labels(self.labels, labels, bound)} {cumulative}')
+            lines.append(f'{self.name}_sum{format_labels(self.labels, labels)} {counts[-1]}')
+            lines.append(f'{self.name}_count{format_labels(self.labels, labels)} {cumulative}')
+        return lines
+
+
+class Gauge:
+    kind = 'gauge'
+
+    def __init__(self, name: str, description: str, callback, labels: tuple = ()):
+        # The callback returns a number, or a dict of label values to numbers.
+        self.name, self.description, self.labels = name, description, tuple(labels)
+        self.callback = callback
+
+    def values(self) -> dict:
+        value = self.callback()
+        return value if isinstance(value, dict) else {(): value}
+
+    def snapshot(self) -> dict:
+        return self.values()
+
+    def exposition(self) -> list[str]:
+        return [f'{self.name}{format_labels(self.labels, labels)} {value}'
+                for labels, value in sorted(self.values().items())]
+
+
+class CallbackCounter(Gauge):
+    # A counter kept by another object (the dispatch engine, the handshake
+    # stage) and read when scraped.
+    kind = 'counter'
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: dict[str, Counter or Histogram or Gauge or CallbackCounter] = {}
+        self.http: ThreadingHTTPServer or None = None
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, description: str, labels: tuple = ()) -> Counter:
+        return self.register(Counter(name, description, labels))
+
+    def histogram(self, name: str, description: str, buckets: tuple, labels: tuple = ()) -> Histogram:
+        return self.register(Histogram(name, description, buckets, labels))
+
+    def gauge(self, name: str, description: str, callback, labels: tuple = ()) -> Gauge:
+        return self.register(Gauge(name, description, callback, labels))
+
+    def callback_counter(self, name: str, description: str, callback, labels: tuple = ()) -> CallbackCounter:
+        return self.register(CallbackCounter(name, description, callback, labels))
+
+    def snapshot(self) -> dict:
+        # Label values are joined with '/' so the snapshot can be dumped as JSON.
+        def key(labels): return '/'.join(map(str, labels))
+        return {name: {key(labels): value for labels, value in metric.snapshot().items()}
+                for name, metric in self.metrics.items()}
+
+    def exposition(self) -> str:
+        # Prometheus text format.
+        lines = []
+        for name, metric in self.metrics.items():
+            lines += [f'# HELP {name} {metric.description}', f'# TYPE {name} {metric.kind}']
+            try: lines += metric.exposition()
+            except Exception as error: lines.append(f'# {name} failed: {error}')
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port: int = 9732, address: str = '127.0.0.1') -> ThreadingHTTPServer:
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics': return self.send_error(404)
+                body = registry.exposition().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args): pass
+
+        # Scrapes are served on demand, nothing polls in the background.
+        self.http = ThreadingHTTPServer((address, port), Handler)
+        self.http.daemon_threads = True
+        threading.Thread(target=self.http.serve_forever, daemon=True).start()
+        return self.http
+
+    def close(self):
+        http, self.http = self.http, None
+        if http is not None: http.shutdown(), http.server_close()
+
+
+class TrafficMetrics:
+    def __init__(self, registry: MetricsRegistry = None, labels: tuple = ('account', 'network', 'session')):
+        self.registry = registry or MetricsRegistry()
+        self.labels, registry = tuple(labels), self.registry
+        self.received_bytes = registry.counter('vpn_received_bytes_total', 'Bytes received from the peers.', labels)
+        self.received_packets = registry.counter('vpn_received_packets_total', 'Packets received from the peers.', labels)
+        self.sent_bytes = registry.counter('vpn_sent_bytes_total', 'Bytes sent to the peers.', labels)
+        self.sent_packets = registry.counter('vpn_sent_packets_total', 'Packets sent to the peers.', labels)
+        self.dropped = registry.counter('vpn_dropped_packets_total', 'Packets dropped by reason.', ('reason',))
+        self.sizes = registry.histogram('vpn_packet_size_bytes', 'Size of the received packets.', SIZE_BUCKETS)
+        self.latency = registry.histogram('vpn_forward_latency_seconds', 'Time spent forwarding a packet.',
+                                          LATENCY_BUCKETS)
+
+    def received(self, labels: tuple, length: int, packets: int = 1):
+        self.received_bytes.add(length, labels), self.received_packets.add(packets, labels)
+
+    def sent(self, labels: tuple, length: int, packets: int = 1):
+        self.sent_bytes.add(length, labels), self.sent_packets.add(packets, labels)
+
+    def drop(self, reason: str):
+        self.dropped.add(1, (reason,))
+
+    def forwarded(self, started: float, length: int):
+        self.latency.observe(time.perf_counter() - started), self.sizes.observe(length)
+
+    def rates(self) -> dict:
+        # Download and upload rates in bytes per second over every label set.
+        received, sent = self.received_bytes.rate(), self.sent_bytes.rate()
+        return dict(download=sum(received.values()), upload=sum(sent.values()))
+
+    def added(self, session):
+        pass
+
+    def removed(self, session):
+        # Closed sessions are folded into their account and network totals.
+        into = session.labels[:-1] + ('',)
+        for counter in (self.received_bytes, self.received_packets, self.sent_bytes, self.sent_packets):
+            counter.forget(session.labels, into)
@@ -0,0 +1,64 @@
+import struct
+
+from connection.metrics import MetricsRegistry
+from connection.packet import PacketHeader, clamp_mss, icmp_too_big
+
+# IPv4 and UDP headers of the datagrams between the clients and the server.
+OUTER_HEADERS = 28
+LINK_MTU = 1500
+# IPv4 hosts must accept 576 bytes packets, the tunnel MTU never goes lower.
+MIN_MTU = 576
+ICMP, TCP, ICMPV6 = 1, 6, 58
+TCP_SYN = 0x02
+# "Don't fragment" bit of the IPv4 flags and fragment offset word.
+IPV4_DF = 0x4000
+# TCP and IP headers subtracted from the MTU to get the MSS.
+MSS_HEADERS = {4: 40, 6: 60}
+# Linux socket options (not exported by the socket module) to send probes
+# with DF set regardless of the path MTU the kernel has cached.
+IP_MTU_DISCOVER, IP_PMTUDISC_PROBE = 10, 3
+
+
+def tunnel_mtu(link_mtu: int, overhead: int) -> int:
+    # Largest inner packet whose datagram fits the link.
+    return max(link_mtu - OUTER_HEADERS - overhead, MIN_MTU)
+
+
+def is_icmp_error(packet: bytes or memoryview, header: PacketHeader) -> bool:
+    # ICMP errors are never answered with another one.
+    if len(packet) <= header.offset: return False
+    if header.protocol == ICMP: return packet[header.offset] not in (0, 8)
+    return header.protocol == ICMPV6 and packet[header.offset] < 128
+
+
+class MtuGuard:
+    def __init__(self, registry: MetricsRegistry = None):
+        registry = registry or MetricsRegistry()
+        self.avoided = registry.counter('vpn_mtu_fragments_avoided_total',
+                                        'Fragmentation avoided by clamping the TCP MSS or answering packet too big.',
+                                        ('action',))
+        self.oversize = registry.counter('vpn_mtu_oversize_total',
+                                         'Packets larger than the tunnel MTU forwarded anyway (fragments allowed).')
+
+    def clamp(self, packet: bytes or memoryview, header: PacketHeader, mtu: int) -> bytes or bytearray:
+        # TCP SYNs announce an MSS that fits the tunnel, so neither end
+        # sends segments that would have to be fragmented.
+        if header.protocol != TCP or len(packet) < header.offset + 14: return packet
+        if not packet[header.offset + 13] & TCP_SYN: return packet
+        clamped = clamp_mss(packet, header.offset, mtu - MSS_HEADERS[header.version])
+        if clamped is None: return packet
+        self.avoided.add(1, ('mss_clamp',))
+        return clamped
+
+    def fit(self, packet: bytes or memoryview, header: PacketHeader, mtu: int) -> tuple:
+        # Returns the packet to forward, None when it is dropped, and the
+        # ICMP error to send back to its sender.
+        packet = self.clamp(packet, header, mtu)
+        if len(packet) <= mtu: return packet, None
+        # IPv4 packets without DF may be fragmented, like a router would.
+        if header.version == 4 and not struct.unpack_from('!H', packet, 6)[0] & IPV4_DF \
+                or is_icmp_error(packet, header):
+            self.oversize.add(1)
+            return packet, None
+        self.avoided.add(1, ('too_big',))
+        return None, icmp_too_big(packet, header, mtu)
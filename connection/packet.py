@@ -0,0 +1,160 @@
+import socket
+import struct
+from typing import NamedTuple, Optional
+
+# Protocols whose header starts with a 16-bit source and destination port.
+PORT_PROTOCOLS = {6, 17, 132, 136}
+# IPv6 extension headers skipped to reach the upper-layer header.
+IPV6_EXTENSIONS = {0, 43, 44, 51, 60}
+
+
+class PacketHeader(NamedTuple):
+    version: int
+    src: str
+    dst: str
+    protocol: int
+    sport: int
+    dport: int
+    offset: int
+
+
+def ports(view: memoryview, protocol: int, offset: int) -> tuple[int, int]:
+    # Read the L4 ports without copying the payload.
+    if protocol not in PORT_PROTOCOLS or len(view) < offset + 4: return 0, 0
+    return struct.unpack_from('!HH', view, offset)
+
+
+def parse_ipv4(view: memoryview) -> Optional[PacketHeader]:
+    if len(view) < 20: return None
+    offset, protocol = (view[0] & 0x0F) * 4, view[9]
+    src, dst = socket.inet_ntoa(view[12:16]), socket.inet_ntoa(view[16:20])
+    # Only the first fragment carries the L4 header.
+    fragment = struct.unpack_from('!H', view, 6)[0] & 0x1FFF
+    sport, dport = ports(view, protocol, offset) if fragment == 0 else (0, 0)
+    return PacketHeader(4, src, dst, protocol, sport, dport, offset)
+
+
+def parse_ipv6(view: memoryview) -> Optional[PacketHeader]:
+    if len(view) < 40: return None
+    protocol, offset, fragment = view[6], 40, 0
+    src = socket.inet_ntop(socket.AF_INET6, view[8:24])
+    dst = socket.inet_ntop(socket.AF_INET6, view[24:40])
+    # Walk the extension header chain up to the upper-layer protocol.
+    while protocol in IPV6_EXTENSIONS and len(view) >= offset + 8:
+        if protocol == 44:
+            fragment = struct.unpack_from('!H', view, offset + 2)[0] & 0xFFF8
+            length = 8
+        elif protocol == 51: length = (view[offset + 1] + 2) * 4
+        else: length = (view[offset + 1] + 1) * 8
+        protocol, offset = view[offset], offset + length
+    sport, dport = ports(view, protocol, offset) if fragment == 0 else (0, 0)
+    return PacketHeader(6, src, dst, protocol, sport, dport, offset)
+
+
+def parse_header(packet: bytes or memoryview) -> Optional[PacketHeader]:
+    view = memoryview(packet)
+    if len(view) == 0: return None
+    version = view[0] >> 4
+    if version == 4: return parse_ipv4(view)
+    if version == 6: return parse_ipv6(view)
+    return None
+
+
+def checksum(data: bytes or memoryview) -> int:
+    # Internet checksum, the 16-bit words are added in host order and the
+    # folded result swapped back, which gives the same sum (RFC 1071).
+    data = bytes(data) + b'\x00' if len(data) % 2 else data
+    total = sum(memoryview(data).cast('H'))
+    while total >> 16: total = (total & 0xFFFF) + (total >> 16)
+    return socket.ntohs(~total & 0xFFFF)
+
+
+# Offset of the checksum field in the TCP, UDP and ICMP headers.
+CHECKSUM_OFFSETS = {6: 16, 17: 6, 1: 2}
+
+
+def update_checksums(packet: bytearray):
+    # Recompute the IPv4 header checksum and the TCP, UDP or ICMP checksum.
+    offset, protocol = (packet[0] & 0x0F) * 4, packet[9]
+    struct.pack_into('!H', packet, 10, 0)
+    struct.pack_into('!H', packet, 10, checksum(memoryview(packet)[:offset]))
+    if protocol not in CHECKSUM_OFFSETS: return packet
+    field = offset + CHECKSUM_OFFSETS[protocol]
+    if len(packet) < field + 2: return packet
+    struct.pack_into('!H', packet, field, 0)
+    segment = memoryview(packet)[offset:]
+    # TCP and UDP also cover a pseudo header with the addresses.
+    pseudo = b'' if protocol == 1 else bytes(packet[12:20]) + struct.pack('!BBH', 0, protocol, len(segment))
+    value = checksum(pseudo + bytes(segment))
+    struct.pack_into('!H', packet, field, 0xFFFF if protocol == 17 and value == 0 else value)
+    return packet
+
+
+def rewrite_ipv4(packet: bytes, src: str = None, dst: str = None,
+                 sport: int = None, dport: int = None) -> bytearray:
+    # Rewrite the addresses and ports (the identifier of ICMP echo messages)
+    # of an IPv4 packet and update its checksums.
+    packet, offset = bytearray(packet), (packet[0] & 0x0F) * 4
+    if src is not None: packet[12:16] = socket.inet_aton(src)
+    if dst is not None: packet[16:20] = socket.inet_aton(dst)
+    if packet[9] in PORT_PROTOCOLS:
+        if sport is not None: struct.pack_into('!H', packet, offset, sport)
+        if dport is not None: struct.pack_into('!H', packet, offset + 2, dport)
+    elif packet[9] == 1 and (sport or dport) is not None:
+        struct.pack_into('!H', packet, offset + 4, sport if sport is not None else dport)
+    return update_checksums(packet)
+
+
+def ipv4_udp_packet(src: str, dst: str, sport: int, dport: int, payload: bytes) -> bytearray:
+    header = struct.pack('!BBHHHBBH4s4sHHHH', 0x45, 0, 28 + len(payload), 0, 0x4000, 64, 17, 0,
+                         socket.inet_aton(src), socket.inet_aton(dst), sport, dport, 8 + len(payload), 0)
+    return update_checksums(bytearray(header + payload))
+
+
+def adjust_checksum(packet: bytearray, field: int, old: int, new: int):
+    # Incremental update of the checksum at `field` after a 16-bit word
+    # changed from `old` to `new` (RFC 1624).
+    total = (~struct.unpack_from('!H', packet, field)[0] & 0xFFFF) + (~old & 0xFFFF) + new
+    while total >> 16: total = (total & 0xFFFF) + (total >> 16)
+    struct.pack_into('!H', packet, field, ~total & 0xFFFF)
+
+
+def clamp_mss(packet: bytes or memoryview, offset: int, mss: int) -> Optional[bytearray]:
+    # Lower the MSS option of a TCP SYN to `mss`, None when it already fits.
+    if len(packet) < offset + 20: return None
+    end = min(offset + (packet[offset + 12] >> 4) * 4, len(packet))
+    position = offset + 20
+    while position < end:
+        kind = packet[position]
+        if kind == 0: break
+        if kind == 1:
+            position += 1
+            continue
+        if position + 1 >= end or packet[position + 1] < 2: break
+        if kind == 2 and packet[position + 1] == 4 and position + 4 <= end:
+            value = struct.unpack_from('!H', packet, position + 2)[0]
+            if value <= mss: return None
+            packet = bytearray(packet)
+            struct.pack_into('!H', packet, position + 2, mss)
+            adjust_checksum(packet, offset + 16, value, mss)
+            return packet
+        position += packet[position + 1]
+    return None
+
+
+def icmp_too_big(packet: bytes or memoryview, header: PacketHeader, mtu: int) -> bytearray:
+    # ICMP "fragmentation needed" or ICMPv6 "packet too big" for a packet
+    # larger than `mtu`, sent on behalf of its destination.
+    if header.version == 4:
+        quote = bytes(packet[:header.offset + 8])
+        icmp = bytearray(struct.pack('!BBHHH', 3, 4, 0, 0, mtu) + quote)
+        struct.pack_into('!H', icmp, 2, checksum(icmp))
+        return update_checksums(bytearray(struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(icmp), 0, 0, 64, 1, 0,
+                                                      bytes(packet[16:20]), bytes(packet[12:16]))) + icmp)
+    # As much of the packet as fits the IPv6 minimum MTU is quoted.
+    quote = bytes(packet[:1280 - 48])
+    icmp = bytearray(struct.pack('!BBHI', 2, 0, 0, mtu) + quote)
+    source, destination = bytes(packet[24:40]), bytes(packet[8:24])
+    pseudo = source + destination + struct.pack('!I3xB', len(icmp), 58)
+    struct.pack_into('!H', icmp, 2, checksum(pseudo + icmp))
+    return bytearray(struct.pack('!IHBB', 6 << 28, len(icmp), 58, 64) + source + destination) + icmp
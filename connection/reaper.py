@@ -0,0 +1,123 @@
+import datetime
+import threading
+import time
+
+from connection.timers import TimerWheel
+
+
+class SessionReaper:
+    def __init__(self, server, timeout: float = 180.0, tick: float = 1.0, batch_size: int = 500,
+                 refresh: float = 3600.0, stale: float = None):
+        # Sessions idle for `timeout` seconds are evicted, their addresses
+        # released and their connections deleted `batch_size` at a time.
+        # The connections of live sessions are refreshed every `refresh`
+        # seconds for the TTL index.
+        self.server, self.timeout, self.batch_size, self.refresh = server, timeout, batch_size, refresh
+        # Connections not refreshed for `stale` seconds were left by a
+        # process that is gone, they are reaped like idle sessions before
+        # the TTL index deletes them and leaks their addresses.
+        self.stale = stale or 2 * refresh
+        self.wheel = TimerWheel(tick)
+        self.wakeup, self.running = threading.Event(), False
+        self.thread: threading.Thread or None = None
+        registry = server.metrics.registry
+        self.evicted = registry.counter('vpn_sessions_evicted_total', 'Sessions evicted after being idle.')
+        self.released = registry.counter('vpn_reaper_released_addresses_total',
+                                         'Virtual addresses given back to the pools by the reaper.')
+        self.keepalives = registry.counter('vpn_keepalives_total', 'Keepalive frames received.')
+        registry.gauge('vpn_reaper_scheduled', 'Sessions watched by the reaper.', lambda: len(self.wheel))
+
+    def added(self, session):
+        self.wheel.schedule(session, self.timeout)
+
+    def removed(self, session):
+        self.wheel.cancel(session)
+
+    def expire(self, now: float = None) -> list:
+        now = time.monotonic() if now is None else now
+        idle = []
+        for session in self.wheel.advance(now):
+            # The packet path only updates last_seen, sessions that saw
+            # traffic are scheduled again for the rest of their timeout.
+            elapsed = now - session.last_seen
+            if elapsed < self.timeout: self.wheel.schedule(session, self.timeout - elapsed)
+            else: idle.append(session)
+        return idle
+
+    def evict(self, sessions: list):
+        # Remove the sessions from memory first so no packet is forwarded
+        # for them while the store is cleaned up.
+        [self.server.sessions.remove(session) for session in sessions]
+        self.evicted.add(len(sessions))
+        for index in range(0, len(sessions), self.batch_size):
+            batch = sessions[index:index + self.batch_size]
+            self.release([(session.id, session.account_id, session.network_id, session.ip_address)
+                          for session in batch])
+            self.server.table_name['connections'].delete_many({'_id': {'$in': [session.id for session in batch]}})
+
+    def release(self, connections: list[tuple]):
+        # Release the addresses of the (id, account id, network id, address)
+        # connections about to be deleted. Accounts that connected again,
+        # here or in another process, keep theirs.
+        from connection.database.mongodb import Network
+        database, live = self.server.table_name, self.server.sessions.accounts
+        query = {'account_id': {'$in': [connection[1] for connection in connections]},
+                 '_id': {'$nin': [connection[0] for connection in connections]}}
+        connected = {str(row['account_id']) for row in database['connections'].find(query, ['account_id'])}
+        networks = {}
+        for _, account_id, network_id, ip_address in connections:
+            if not ip_address or str(account_id) in live or str(account_id) in connected: continue
+            networks.setdefault(str(network_id), {})[str(account_id)] = ip_address
+        for network_id, addresses in networks.items():
+            self.released.add(Network(database['networks'], network_id).release_addresses(addresses))
+
+    def sweep(self):
+        # Reap the connections no process refreshed for `stale` seconds.
+        collection = self.server.table_name['connections']
+        cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=self.stale)
+        fields = ['account_id', 'network_id', 'ip_address']
+        while True:
+            live = [session.id for session in list(self.server.sessions.sessions.values())]
+            query = {'last_seen': {'$lt': cutoff}, '_id': {'$nin': live}}
+            rows = list(collection.find(query, fields).limit(self.batch_size))
+            if not rows: return
+            self.release([(row['_id'], row['account_id'], row['network_id'], row.get('ip_address'))
+                          for row in rows])
+            collection.delete_many({'_id': {'$in': [row['_id'] for row in rows]}, 'last_seen': {'$lt': cutoff}})
+            if len(rows) < self.batch_size: return
+
+    def touch(self):
+        # Keep the connections of live sessions away from the TTL index.
+        ids = [session.id for session in list(self.server.sessions.sessions.values())]
+        now = datetime.datetime.now(datetime.timezone.utc)
+        for index in range(0, len(ids), self.batch_size):
+            query = {'_id': {'$in': ids[index:index + self.batch_size]}}
+            self.server.table_name['connections'].update_many(query, {'$set': {'last_seen': now}})
+
+    def run(self):
+        touched = time.monotonic()
+        while self.running:
+            self.wakeup.wait(self.wheel.tick)
+            try:
+                idle = self.expire()
+                if idle: self.evict(idle)
+                if time.monotonic() - touched >= self.refresh:
+                    self.touch(), self.sweep()
+                    touched = time.monotonic()
+            except Exception as error: print('Session reaper failed:', error)
+
+    def start(self):
+        if self.thread is not None: return self
+        # Watch the sessions already in the table and the ones to come.
+        self.server.sessions.watchers.append(self)
+        [self.added(session) for session in list(self.server.sessions.sessions.values())]
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running, thread, self.thread = False, self.thread, None
+        self.wakeup.set()
+        if thread is not None: thread.join()
+        if self in self.server.sessions.watchers: self.server.sessions.watchers.remove(self)
@@ -0,0 +1,119 @@
+import threading
+import time
+from typing import Optional
+
+from connection.ciphers import TICKET_LENGTH, new_context
+from connection.compression import new_codec
+from connection.mtu import LINK_MTU, tunnel_mtu
+
+
+class Session:
+    def __init__(self, connection: dict, address: tuple):
+        self.id = connection['_id'] if '_id' in connection else connection['id']
+        self.account_id = connection['account_id']
+        self.network_id = str(connection['network_id'])
+        self.ip_address = connection['ip_address']
+        self.address = address
+        # Time of the last authenticated frame, read by the reaper.
+        self.last_seen = time.monotonic()
+        # Metric labels, built once instead of on every packet.
+        self.labels = str(self.account_id), self.network_id, str(self.id)
+        # Cipher negotiated during the handshake, the key material is derived
+        # once and kept for the lifetime of the session.
+        self.cipher_name = connection.get('cipher', 'salsa20')
+        # Whether small packets sent to the client are bundled.
+        self.coalesce = connection.get('coalesce', False)
+        # Codec of the payloads compressed for the client, None when off.
+        self.compression = connection.get('compression')
+        self.codec = new_codec(self.compression)
+        self.rekey(connection['encrypt'])
+        # Ticket carried by the client's frames, framed ciphers only.
+        ticket = connection.get('ticket')
+        self.ticket = bytes.fromhex(ticket) if ticket and self.cipher.framed else None
+        # Tunnel MTU agreed on during the handshake, lowered by path probes.
+        overhead = self.cipher.overhead + (TICKET_LENGTH if self.ticket else 0)
+        self.mtu = connection.get('mtu') or tunnel_mtu(LINK_MTU, overhead)
+
+    def rekey(self, token: bytes or str):
+        self.token = token.encode() if type(token) is str else token
+        self.cipher = new_context(self.cipher_name, self.token)
+
+
+class SessionTable:
+    def __init__(self):
+        # Sessions keyed by the client (ip, port) tuple, forwarding index
+        # keyed by network id and virtual ip, sessions by account and by
+        # session ticket.
+        self.sessions: dict[tuple, Session] = {}
+        self.tickets: dict[bytes, Session] = {}
+        self.routes: dict[str, dict[str, Session]] = {}
+        self.accounts: dict[str, set] = {}
+        # Readers never take the lock, writers keep the indexes consistent.
+        self.lock = threading.Lock()
+        # Objects notified through added(session) and removed(session).
+        self.watchers = []
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def get(self, address: tuple) -> Optional[Session]:
+        return self.sessions.get(address)
+
+    def route(self, network_id: str, ip_address: str) -> Optional[Session]:
+        return self.routes.get(network_id, {}).get(ip_address)
+
+    def add(self, session: Session) -> Session:
+        with self.lock:
+            # Drop any stale entry bound to the same client address.
+            removed = self._discard(self.sessions.get(session.address))
+            self.sessions[session.address] = session
+            self.routes.setdefault(session.network_id, {})[session.ip_address] = session
+            self.accounts.setdefault(str(session.account_id), set()).add(session)
+            if session.ticket: self.tickets[session.ticket] = session
+        self.notify(removed)
+        [watcher.added(session) for watcher in self.watchers]
+        return session
+
+    def ticket(self, ticket: bytes) -> Optional[Session]:
+        return self.tickets.get(ticket)
+
+    def move(self, session: Session, address: tuple) -> Session:
+        # The client's address changed, only the address index is updated.
+        with self.lock:
+            if self.sessions.get(session.address) is session: del self.sessions[session.address]
+            removed = self._discard(self.sessions.get(address))
+            session.address = address
+            self.sessions[address] = session
+        self.notify(removed)
+        return session
+
+    def remove(self, session: Session):
+        with self.lock: removed = self._discard(session)
+        self.notify(removed)
+
+    def remove_account(self, account_id):
+        with self.lock:
+            removed = [self._discard(session) for session in list(self.accounts.get(str(account_id), ()))]
+        self.notify(sum(removed, []))
+
+    def notify(self, removed: list):
+        # Watchers are called without the lock, they may talk to other
+        # processes or take locks of their own.
+        for session in removed: [watcher.removed(session) for watcher in self.watchers]
+
+    def _discard(self, session: Optional[Session]) -> list:
+        # Returns the removed session in a list, for notify().
+        if session is None: return []
+        # Only remove index entries that still point at this session.
+        if self.sessions.get(session.address) is session:
+            del self.sessions[session.address]
+        routes = self.routes.get(session.network_id, {})
+        if routes.get(session.ip_address) is session:
+            del routes[session.ip_address]
+        if not routes: self.routes.pop(session.network_id, None)
+        if session.ticket and self.tickets.get(session.ticket) is session: del self.tickets[session.ticket]
+        accounts = self.accounts.get(str(session.account_id), set())
+        if session not in accounts: return []
+        accounts.discard(session)
+        if not accounts: self.accounts.pop(str(session.account_id), None)
+        return [session]
@@ -0,0 +1,50 @@
+import math
+import threading
+import time
+
+
+class TimerWheel:
+    def __init__(self, tick: float = 1.0, size: int = 512):
+        # Each slot holds the keys due in it with the number of full turns
+        # of the wheel left, so delays longer than the wheel still fit.
+        self.tick, self.slots = tick, [{} for _ in range(size)]
+        self.entries: dict[any, int] = {}
+        self.position, self.updated = 0, time.monotonic()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def schedule(self, key, delay: float):
+        ticks = max(1, math.ceil(delay / self.tick))
+        rounds, offset = divmod(ticks - 1, len(self.slots))
+        with self.lock:
+            self._cancel(key)
+            slot = (self.position + offset + 1) % len(self.slots)
+            self.slots[slot][key], self.entries[key] = rounds, slot
+
+    def cancel(self, key):
+        with self.lock: self._cancel(key)
+
+    def _cancel(self, key):
+        slot = self.entries.pop(key, None)
+        if slot is not None: self.slots[slot].pop(key, None)
+
+    def advance(self, now: float = None) -> list:
+        # Move the wheel to `now` and return the keys that expired. Callers
+        # check whether the key is still idle and schedule it again if not,
+        # so the packet path only has to update a timestamp.
+        now = time.monotonic() if now is None else now
+        expired = []
+        with self.lock:
+            ticks = min(int((now - self.updated) / self.tick), len(self.slots))
+            self.updated += int((now - self.updated) / self.tick) * self.tick
+            for _ in range(ticks):
+                self.position = (self.position + 1) % len(self.slots)
+                slot = self.slots[self.position]
+                for key, rounds in list(slot.items()):
+                    if rounds: slot[key] = rounds - 1
+                    else:
+                        del slot[key], self.entries[key]
+                        expired.append(key)
+        return expired
@@ -0,0 +1,105 @@
+import itertools
+import json
+import signal
+import sys
+import threading
+import time
+from typing import Optional
+
+from connection.metrics import MetricsRegistry
+
+# Buckets of the stage histograms, in seconds.
+STAGE_BUCKETS = 1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 1e-3, 1e-2, 0.1
+# Stages in the order a forwarded packet goes through them.
+STAGES = 'receive', 'classify', 'queue', 'decrypt', 'parse', 'limit', 'route', 'encrypt', 'send'
+
+
+class TraceHook:
+    # Called for every sampled packet, started() and finished() run in the
+    # thread that forwards the packet.
+    def started(self, trace: 'PacketTrace'):
+        pass
+
+    def finished(self, trace: 'PacketTrace'):
+        pass
+
+
+class ProfilerHook(TraceHook):
+    def __init__(self):
+        import cProfile
+        # One profiler per forwarding thread, enabled from the start of a
+        # sampled packet until its batch is sent, so it samples the work of
+        # the forwarding threads.
+        self.new_profile, self.local, self.profiles = cProfile.Profile, threading.local(), []
+        self.lock = threading.Lock()
+
+    def started(self, trace: 'PacketTrace'):
+        profile = getattr(self.local, 'profile', None)
+        if profile is None:
+            profile = self.local.profile = self.new_profile()
+            with self.lock: self.profiles.append(profile)
+        profile.enable()
+
+    def finished(self, trace: 'PacketTrace'):
+        profile = getattr(self.local, 'profile', None)
+        if profile is not None: profile.disable()
+
+    def stats(self):
+        import pstats
+        with self.lock: profiles = list(self.profiles)
+        return pstats.Stats(*profiles) if profiles else None
+
+
+class PacketTrace:
+    __slots__ = 'tracer', 'last', 'stages'
+
+    def __init__(self, tracer: 'StageTracer', received: float = None):
+        self.tracer, self.last = tracer, time.perf_counter()
+        # (stage, seconds) in the order the stages ran.
+        self.stages = [] if received is None else [('receive', self.last - received)]
+
+    def mark(self, stage: str):
+        now = time.perf_counter()
+        self.stages.append((stage, now - self.last))
+        self.last = now
+
+    def enter(self):
+        # The packet left the dispatch queue and is being forwarded.
+        self.mark('queue')
+        [hook.started(self) for hook in self.tracer.hooks]
+
+    def finish(self, stage: str = None):
+        if stage: self.mark(stage)
+        [hook.finished(self) for hook in self.tracer.hooks]
+        histogram = self.tracer.histogram
+        for stage, elapsed in self.stages: histogram.observe(elapsed, (stage,))
+
+
+class StageTracer:
+    def __init__(self, registry: MetricsRegistry = None, sample_rate: float = 0.01):
+        registry = registry or MetricsRegistry()
+        self.histogram = registry.histogram('vpn_stage_seconds', 'Time spent in each stage by the sampled packets.',
+                                            STAGE_BUCKETS, ('stage',))
+        # One packet out of `interval` is traced.
+        self.interval, self.counter = max(1, round(1 / sample_rate)), itertools.count()
+        self.hooks: list[TraceHook] = []
+
+    def sample(self, received: float = None) -> Optional[PacketTrace]:
+        if next(self.counter) % self.interval: return None
+        return PacketTrace(self, received)
+
+    def stats(self) -> dict:
+        stats = {}
+        for (stage,), counts in self.histogram.values().items():
+            count = sum(counts[:-1])
+            stats[stage] = dict(count=count, mean_us=counts[-1] / count * 1e6 if count else 0.0,
+                                p50_us=self.histogram.quantile(0.5, (stage,)) * 1e6,
+                                p99_us=self.histogram.quantile(0.99, (stage,)) * 1e6)
+        return {stage: stats[stage] for stage in STAGES if stage in stats}
+
+    def dump(self, file=None):
+        print(json.dumps(self.stats(), indent=2), file=file or sys.stderr, flush=True)
+
+    def dump_on_signal(self, signum: int = signal.SIGUSR1):
+        # Must be called from the main thread.
+        return signal.signal(signum, lambda *_: self.dump())
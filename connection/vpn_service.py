@@ -1,27 +1,125 @@
-import select
+import os
 import socket
 import struct
-from threading import Thread
-from typing import Optional
+import time
+from typing import Optional, TYPE_CHECKING
 
-import bcrypt
-import pytun
 from Crypto.Cipher import Salsa20
-from bson import ObjectId
-from pymongo import MongoClient
-from scapy.layers.inet import IP
 
-from connection import DefaultAuth
-from connection.database.mongodb import Account, Connection, Network
-from connection.monitor import SpeedMonitor
+from connection.accounting import TransferAccounting
+from connection.authentication import DefaultAuth
+from connection.batch_io import BatchSocket
+from connection.ciphers import CIPHERS, CIPHER_IDS, FRAME_BUNDLE, FRAME_CHALLENGE, FRAME_DATA, FRAME_KEEPALIVE, \
+    FRAME_PROBE, TICKET_LENGTH, frame_ticket, new_context
+from connection.client_engine import ClientEngine
+from connection.coalesce import Coalescer, unbundle
+from connection.compression import CODECS, CODEC_IDS, Compressor, available_codecs, flow_key, new_codec
+from connection.dispatch import new_engine
+from connection.egress import EgressEngine
+from connection.handshake import HandshakeStage, OPTION_CIPHER, OPTION_COALESCE, OPTION_COMPRESSION, OPTION_MTU, \
+    OPTION_SESSION, is_handshake, pack_options, unpack_options
+from connection.limits import RateLimiter
+from connection.metrics import TrafficMetrics
+from connection.mtu import IP_MTU_DISCOVER, IP_PMTUDISC_PROBE, LINK_MTU, MIN_MTU, OUTER_HEADERS, MtuGuard, tunnel_mtu
+from connection.packet import PacketHeader, parse_header
+from connection.reaper import SessionReaper
+from connection.sessions import Session, SessionTable
+from connection.tracing import StageTracer
+
+# Challenges waiting for an answer are forgotten past this many addresses.
+MAX_CHALLENGES = 4096
+
+# Server-only dependencies (bcrypt, pymongo) and pytun are imported by the
+# methods that use them, so importing the client stays fast.
+if TYPE_CHECKING:
+    from bson import ObjectId
+    from pymongo import MongoClient
 
 
 class VPNServer:
-    def __init__(self, mongo_client: MongoClient, table_name: str):
+    def __init__(self, mongo_client: 'MongoClient', table_name: str,
+                 engine: str or object = 'threads', batch_size: int = 32, **engine_options):
         self.table_name = mongo_client[table_name]
-        self.token_length = 40
+        self.auth_method, self.token_length = DefaultAuth(), 40
         self.ip_address = '0.0.0.0'
+        # Ciphers the server accepts during the handshake.
+        self.ciphers = list(CIPHER_IDS)
+        # Compression codecs the server accepts, the clients ask for it.
+        self.codecs = available_codecs()
+        # MTU of the server's link, the tunnel MTU of a session also fits
+        # the path MTU given by its client.
+        self.link_mtu = LINK_MTU
+        # Set by VPNCluster when several processes share the same port.
+        self.reuse_port, self.peers = False, None
         self.server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # Receive and send vectors of datagrams per system call when possible.
+        self.io = BatchSocket(self.server, batch_size)
+        # In-memory session table and forwarding index for the data plane.
+        self.sessions = SessionTable()
+        # Transfer counters are aggregated in memory and flushed in bulk.
+        self.accounting = TransferAccounting(self.table_name)
+        # Control plane stage where handshakes and bcrypt run off the receive loop.
+        self.handshakes = HandshakeStage(self)
+        # Per-account and per-network bandwidth limits, loaded with the sessions.
+        self.limits = RateLimiter(self.io.send_batch)
+        # Traffic counters by account, network and session, and the gauges
+        # of every stage, exposed through snapshot() or serve_metrics().
+        self.metrics = TrafficMetrics()
+        self.sessions.watchers.append(self.metrics)
+        # Payload compression of the sessions that negotiated it, skipped
+        # per flow while it does not pay off.
+        self.compressor = Compressor(self.metrics.registry)
+        # Bundles of small packets for the sessions that negotiated them.
+        self.coalescer = Coalescer(seal=self.seal)
+        # MSS clamping and packet too big answers for the tunnel MTUs.
+        self.mtu_guard = MtuGuard(self.metrics.registry)
+        # Per-stage timings of sampled packets, None when disabled.
+        self.tracer: StageTracer or None = None
+        # NAT egress of the tunnel mode, created by run_server(tunnel=True)
+        # unless one is set beforehand.
+        self.egress: EgressEngine or None = None
+        # Evicts the sessions idle for longer than its timeout, replace it
+        # before run_server() to change the timeouts.
+        self.reaper = SessionReaper(self)
+        # Dispatch engine that runs the data plane ('threads' or 'asyncio').
+        self.engine = new_engine(engine, **engine_options)
+        # Sessions that moved to a new client address, by where they were found.
+        self.roamed = self.metrics.registry.counter('vpn_sessions_roamed_total',
+                                                    'Sessions resumed from a new client address.', ('source',))
+        # Nonces sent to the new addresses of sessions resumed from the store.
+        self.challenges: dict[tuple, tuple[bytes, bytes]] = {}
+        self.register_metrics()
+
+    def register_metrics(self):
+        registry, handshakes = self.metrics.registry, self.handshakes
+        registry.gauge('vpn_sessions', 'Active sessions.', lambda: len(self.sessions))
+        registry.callback_counter('vpn_dispatch_dropped_total', 'Packets dropped by the dispatch engine.',
+                                  lambda: getattr(self.engine, 'dropped', 0))
+        registry.gauge('vpn_handshake_queue_depth', 'Handshakes waiting for a worker.',
+                       lambda: handshakes.queue.qsize())
+        registry.callback_counter('vpn_handshakes_total', 'Handshakes by outcome.', lambda: {
+            ('completed',): handshakes.completed, ('failed',): handshakes.failed,
+            ('rate_limited',): handshakes.rate_limited, ('queue_full',): handshakes.queue_full}, ('outcome',))
+        registry.callback_counter('vpn_rate_limit_dropped_total',
+                                  'Packets dropped by the bandwidth limit of an account.',
+                                  lambda: {(key,): limit.dropped for key, limit in self.limits.accounts.items()},
+                                  ('account',))
+
+    def enable_tracing(self, sample_rate: float = 0.01, hooks: list = (), signum: int = None) -> StageTracer:
+        # Trace one packet out of 1 / sample_rate, the stage histograms are
+        # part of the metrics and `signum` dumps them to stderr.
+        tracer = StageTracer(self.metrics.registry, sample_rate)
+        tracer.hooks.extend(hooks)
+        if signum is not None: tracer.dump_on_signal(signum)
+        self.tracer = tracer
+        return tracer
+
+    def disable_tracing(self):
+        self.tracer = None
+
+    def serve_metrics(self, port: int = 9732, address: str = '127.0.0.1'):
+        # Prometheus endpoint at http://address:port/metrics.
+        return self.metrics.registry.serve(port, address)
 
     def algorithm(self, token: bytes or str) -> Salsa20.Salsa20Cipher:
         token = token.encode('utf-8') if type(token) is str else token
@@ -33,6 +131,48 @@ class VPNServer:
         username = packet[2:2 + packet[1]].decode()
         return username, packet[3 + packet[1]:password_end]
 
+    def handshake_options(self, packet: bytes) -> dict[int, bytes]:
+        # Options offered by the client follow the password.
+        return unpack_options(packet[3 + packet[1] + packet[2 + packet[1]]:])
+
+    def negotiate(self, packet: bytes) -> dict:
+        options, negotiated = self.handshake_options(packet), {}
+        # Pick the first cipher offered by the client that is enabled here,
+        # clients that send no options keep the legacy Salsa20 framing.
+        for cipher_id in options.get(OPTION_CIPHER, b''):
+            if cipher_id in CIPHERS and CIPHERS[cipher_id].name in self.ciphers:
+                negotiated['cipher'] = CIPHERS[cipher_id].name
+                break
+        # Bundles need the frame kind of a framed cipher.
+        cipher = CIPHERS[CIPHER_IDS[negotiated.get('cipher', 'salsa20')]]
+        if options.get(OPTION_COALESCE) and cipher.framed: negotiated['coalesce'] = True
+        # So does the compressed flag, the first codec offered that is
+        # available here is used.
+        for codec_id in options.get(OPTION_COMPRESSION, b'') if cipher.framed else b'':
+            if codec_id in CODECS and CODECS[codec_id].name in self.codecs:
+                negotiated['compression'] = CODECS[codec_id].name
+                break
+        # The tunnel MTU leaves room for the frame header, the ticket and the
+        # tag of the cipher within the smaller of both links. It is only
+        # answered to clients that offered their MTU, the others expect the
+        # reply they always got.
+        if len(options.get(OPTION_MTU, b'')) == 2:
+            link_mtu = min(self.link_mtu, int.from_bytes(options[OPTION_MTU], 'big'))
+            negotiated['mtu'] = tunnel_mtu(link_mtu, cipher.overhead + (TICKET_LENGTH if cipher.framed else 0))
+        return negotiated
+
+    def reply_options(self, connection: dict) -> dict[int, bytes]:
+        # Options sent back with the configuration, what was negotiated.
+        options = {}
+        if 'cipher' in connection: options[OPTION_CIPHER] = bytes([CIPHER_IDS[connection['cipher']]])
+        if connection.get('coalesce'): options[OPTION_COALESCE] = b'\x01'
+        if connection.get('compression'): options[OPTION_COMPRESSION] = bytes([CODEC_IDS[connection['compression']]])
+        # The ticket needs the frame header of a framed cipher too.
+        cipher = CIPHERS[CIPHER_IDS[connection.get('cipher', 'salsa20')]]
+        if connection.get('ticket') and cipher.framed: options[OPTION_SESSION] = bytes.fromhex(connection['ticket'])
+        if connection.get('mtu'): options[OPTION_MTU] = connection['mtu'].to_bytes(2, 'big')
+        return options
+
     def pack_data(self, token, ip_address, subnet_mask):
         def to_bytes(i): return bytes(map(int, i.split('.')))
         struct_format = f'4s4s{self.token_length}s'
@@ -40,45 +180,121 @@ class VPNServer:
         return struct.pack(struct_format, *arguments)
 
     def authenticate(self, connection: tuple[bytes, any]):
+        from connection.database.mongodb import Account
         username, password = self.unpack(connection[0])
         collection = self.table_name['accounts']
-        account = Account(collection).get(username=username)
+        account = Account(collection).get(['password', 'networks', 'rate_limit'], username=username)
+        if account is None: return None
         credentials = account['password'].encode()
-        if bcrypt.checkpw(password, credentials): return account
+        if self.handshakes.check_password(password, credentials): return account
 
-    def update_transfer(self, account_id: ObjectId or str, length: int):
-        account = Account(self.table_name['accounts'], account_id)
-        length += account.get().get('transfer_ratio', 0)
-        return account.update(transfer_ratio=length)
+    def update_transfer(self, session: Session, length: int):
+        self.accounting.add(session.account_id, session.id, length)
 
-    def get_destination(self, connection: tuple[bytes, any]):
+    def load_limits(self, account_id, network_id, account: dict = None):
+        # Read the rate limits of the account and its network on the control
+        # plane, the packet path only looks them up in memory.
+        from connection.database.mongodb import Account, Network
+        if account is None: account = Account(self.table_name['accounts'], account_id).get(['rate_limit'])
+        network = Network(self.table_name['networks'], network_id).get(['rate_limit'])
+        self.limits.configure('accounts', account_id, (account or {}).get('rate_limit'))
+        self.limits.configure('networks', network_id, (network or {}).get('rate_limit'))
+
+    def set_rate_limit(self, kind: str, _id: str or 'ObjectId', rate: float or None,
+                       burst: float = None, mode: str = 'drop'):
+        # Store the limit of an account or network ('accounts' or 'networks')
+        # and apply it to the live sessions.
+        from connection.database.mongodb import Account
+        Account(self.table_name[kind], _id).set_rate_limit(rate, burst, mode)
+        rate_limit = dict(rate=rate, burst=burst, mode=mode) if rate is not None else None
+        return self.limits.configure(kind, _id, rate_limit)
+
+    def get_destination(self, header: PacketHeader, session: Session) -> Optional[Session]:
+        # Look up the destination in the forwarding index of the sender's network.
+        return self.sessions.route(session.network_id, header.dst)
+
+    def seal(self, session: Session, payload: bytes, kind: int = FRAME_DATA) -> bytes:
+        # Compress the payload when the session negotiated it and encrypt it,
+        # the ratio is followed per flow and per session for bundles.
+        if session.codec is None: return session.cipher.seal(payload, kind)
+        key = session.id, flow_key(payload) if kind == FRAME_DATA else kind
+        return self.compressor.seal(session.cipher, session.codec, key, payload, kind)
+
+    def deliver(self, network_id: str, ip_address: str, packet: bytes):
+        # Encrypt and send a packet handed over by another worker process.
+        client = self.sessions.route(network_id, ip_address)
+        if client is None: return
+        packet = self.seal(client, packet)
+        self.update_transfer(client, len(packet))
+        self.metrics.sent(client.labels, len(packet))
+        self.server.sendto(packet, client.address)
+
+    def load_session(self, address: tuple, packet: bytes = b'') -> Optional[Session]:
+        # Fall back to the database for sessions created before this process
+        # started, and cache them in the session table. Sessions are looked
+        # up by address, or by the ticket of the packet when the client
+        # moved since.
+        from connection.database.mongodb import Connection
         collection = self.table_name['connections']
-        manager = Connection(collection)
-        # Convert the connection tuple into a unique key.
-        address = ':'.join(map(str, connection[1]))
-        packet = IP(connection[0])
-        connection = manager.get(connection=address)
-        if not connection: return None
-        # Get a list of connections from the network
-        network_id = connection['network_id']
-        kwargs = dict(network_id=network_id, ip_address=packet.dst)
-        return Connection(collection).get(**kwargs)
+        connection_key = ':'.join(map(str, address))
+        data = Connection(collection).get(connection=connection_key)
+        ticket = frame_ticket(packet) if not data else None
+        if ticket: data = Connection(collection).get(ticket=ticket[0].hex())
+        if not data: return None
+        session = Session(data, address)
+        # Sessions that moved away from a stored address live on in memory,
+        # and a ticket alone proves nothing, the client must answer a challenge.
+        if session.ticket and self.sessions.ticket(session.ticket) is not None: return None
+        if ticket and not self.challenge(session, address, packet): return None
+        self.load_limits(data['account_id'], data['network_id'])
+        if ticket:
+            # This runs on the control plane, so the new address is stored
+            # for the other processes.
+            Connection(collection, data['_id']).update(connection=connection_key)
+            self.roamed.add(1, ('store',))
+        return self.sessions.add(session)
+
+    def challenge(self, session: Session, address: tuple, frame: bytes) -> bool:
+        # The counter of a frame cannot be checked against a session read
+        # back from the store, so the frame may be a replay. The session only
+        # moves once the new address echoes a nonce sealed with its key,
+        # which only the client can open.
+        opened = session.cipher.open(frame)
+        if opened is None: return False
+        pending = self.challenges.get(address)
+        if pending is not None and pending[0] == session.ticket:
+            if opened[0] == FRAME_CHALLENGE and opened[2] == pending[1]:
+                self.challenges.pop(address, None)
+                return True
+            # Frames sent before the answer get the same nonce again, in case
+            # the challenge was lost.
+            nonce = pending[1]
+        else:
+            if len(self.challenges) >= MAX_CHALLENGES: self.challenges = {}
+            nonce = os.urandom(16)
+            self.challenges[address] = session.ticket, nonce
+        self.server.sendto(session.cipher.seal(nonce, FRAME_CHALLENGE), address)
+        return False
 
     def new_configuration(self, connection: dict):
+        from connection.database.mongodb import Network
         # Get the collection from the database that stores the network data.
         collection = self.table_name['networks']
         # Get the network data from the database.
         network_id = connection['network_id']
-        network = Network(collection, network_id).get()
+        network = Network(collection, network_id).get(['subnet_mask'])
         subnet_mask = network['subnet_mask']
         token = connection['encrypt']
         ip_address = connection['ip_address']
-        # Pack the data into a packet.
+        # Pack the data into a packet, followed by the negotiated options.
         packet = self.pack_data(token, ip_address, subnet_mask)
+        packet += pack_options(self.reply_options(connection))
         client = connection['connection'].split(':')
         self.server.sendto(packet, (client[0], int(client[1])))
 
     def new_account(self, username: str, password: str):
+        import bcrypt
+        from connection.database.mongodb import Account
         password = bcrypt.hashpw(password.encode(), bcrypt.gensalt(10))
         password = password.decode('utf-8')
         kwargs = dict(username=username, password=password, networks={})
@@ -86,87 +302,258 @@ class VPNServer:
         return account
 
     def new_connection(self, connection: tuple[bytes, any]):
+        from connection.database.mongodb import Account, Connection, Network
         account = self.authenticate(connection)
         if not account: return None
-        account_id = account['_id'].__str__()
+        account_id, account_document = account['_id'].__str__(), account
         # Get the first network key from the account's networks
         network = list(account['networks'].keys())[0]
         collection = self.table_name['networks']
         network = Network(collection, network)
-        # Get the IP address associated with the account from
-        # the network.
-        ip_address = network.get()['connections'][account_id]
-
         # Create an Account object using the account ID
         collection = self.table_name['accounts']
         account = Account(collection, account_id)
+        # Get the IP address associated with the account from the network,
+        # an address is taken from the pool if it has none.
+        ip_address = network.to_network(account)
 
         args = network, account, ip_address, connection[1]
         collection = self.table_name['connections']
         collection.delete_many({'account_id': account.id})
-        return Connection(collection).create(*args)
-
-    def send_packet(self, token: bytes, tunnel: bool, connection: tuple[bytes, any]):
-        # Decrypt the packet using the token.
-        packet = self.algorithm(token).decrypt(connection[0])
-        # Get the destination of the packet.
-        client = self.get_destination((packet, connection[1]))
-        # If the client is not None, then encrypt the packet again
-        # and update the transfer status.
+        self.sessions.remove_account(account.id)
+        data = Connection(collection).create(*args, **self.negotiate(connection[0]))
+        self.load_limits(account.id, network.id, account_document)
+        self.sessions.add(Session(data, connection[1]))
+        return data
+
+    def forward(self, session: Session, tunnel: bool, connection: tuple[bytes, any], trace=None) -> list[tuple]:
+        # Returns the (packet, address) pairs to send, packets for sessions
+        # that coalesce wait in the coalescer until flush().
+        if trace: trace.enter()
+        started = time.perf_counter()
+        self.update_transfer(session, len(connection[0]))
+        self.metrics.received(session.labels, len(connection[0]))
+        # Open the frame with the cipher context cached on the session.
+        frame = session.cipher.open(connection[0])
+        if trace: trace.mark('decrypt')
+        kind, flags, payload = frame if frame is not None else (None, 0, b'')
+        # Expand the payloads the client compressed.
+        if flags: payload = self.compressor.decompress(session.codec, flags, payload)
+        if payload is None: kind = None
+        # Only authenticated frames keep the session alive, keepalives of
+        # the legacy framing are empty data frames.
+        if kind is not None: session.last_seen = time.monotonic()
+        if kind == FRAME_KEEPALIVE or kind == FRAME_DATA and not payload:
+            self.reaper.keepalives.add(1)
+            return []
+        if kind == FRAME_PROBE: return self.probe(session, connection[0], payload)
+        # Answers to a challenge arriving after the session moved.
+        if kind == FRAME_CHALLENGE: return []
+        # Bundles carry several packets of a session that coalesces.
+        if kind == FRAME_DATA: packets = [payload]
+        elif kind == FRAME_BUNDLE: packets = unbundle(payload)
+        else:
+            self.metrics.drop('invalid')
+            return []
+        outputs = []
+        for packet in packets: self.route(session, tunnel, packet, outputs, trace)
+        self.metrics.forwarded(started, len(connection[0]))
+        return outputs
+
+    def route(self, session: Session, tunnel: bool, packet: bytes, outputs: list, trace=None):
+        # Read the destination straight from the IP header.
+        header = parse_header(packet) if packet else None
+        if trace: trace.mark('parse')
+        if header is None: return self.metrics.drop('invalid')
+        # Get the destination of the packet. Without a local session it may
+        # be owned by another worker process, or leave through the NAT
+        # egress when the tunnel flag is set.
+        client = self.get_destination(header, session)
+        handoff = client is None and self.peers is not None and self.peers.owns(session.network_id, header.dst)
+        egress = client is None and not handoff and tunnel and self.egress is not None
+        if trace: trace.mark('route')
+        if client is None and not handoff and not egress: return self.metrics.drop('no_route')
+        # Clamp the MSS of TCP SYNs to the tunnel MTUs, packets that do not
+        # fit the destination's tunnel are answered with packet too big.
+        if client is None: packet = self.mtu_guard.clamp(packet, header, session.mtu)
+        else:
+            packet, error = self.mtu_guard.fit(packet, header, min(session.mtu, client.mtu))
+            if error is not None: outputs.extend(self.emit([(session, self.seal(session, error))]))
+            if packet is None: return self.metrics.drop('too_big')
+        # Apply the bandwidth limits of the sender once the packet is known
+        # to be sent, packets over the limit are dropped or delayed.
+        delay = self.limits.check(session.account_id, session.network_id, len(packet))
+        if trace: trace.mark('limit')
+        if delay is None: return self.metrics.drop('rate_limit')
+        # Only the frames sent to a client can wait in the rate limiter, the
+        # handoff and the egress send the packet themselves.
+        if delay and client is None:
+            self.limits.refund(session.account_id, session.network_id, len(packet))
+            return self.metrics.drop('rate_limit')
+        # Packets for a session that coalesces are bundled with the other
+        # packets sent to it in the same batch.
+        if client is not None and client.coalesce and not delay:
+            outputs.extend(self.emit(self.coalescer.add(client, packet)))
+            return None
+        # Otherwise encrypt the packet with the client's cipher context.
         if client is not None:
-            # Split the client's connection string into the IP address and port.
-            client['connection'] = client['connection'].split(':')
-            # Convert the port to an integer.
-            client['connection'][1] = int(client['connection'][1])
-            # Encrypt the packet using the client's encryption key
-            packet = self.algorithm(client['encrypt']).encrypt(packet)
-            connection = packet, tuple(client['connection'])
-            args = client['account_id'], len(packet)
-            # Create a new thread to update the transfer status in the database
-            Thread(target=self.update_transfer, args=args, daemon=True).start()
-        # If the client is None or the tunnel flag is set, then tunnel the packet.
-        elif tunnel:
-            port = getattr(IP(packet), 'dport', 0)
-            # Update the connection object with the new packet and the destination
-            # port.
-            connection = packet, (IP(packet).dst, port)
-        self.server.sendto(*connection)
+            frame = self.seal(client, packet)
+            if trace: trace.mark('encrypt')
+            return self.shape(outputs, self.emit([(client, frame)]), delay)
+        if handoff: self.peers.handoff(session.network_id, header.dst, bytes(packet))
+        else: self.egress.send(session, header, bytes(packet))
+
+    def probe(self, session: Session, frame: bytes, payload: bytes) -> list[tuple]:
+        # Answer a path MTU probe with the size of its datagram, the last
+        # probe of a client announces the tunnel MTU it settled on.
+        if len(payload) < 2: return []
+        announced = int.from_bytes(payload[:2], 'big')
+        if announced:
+            session.mtu = max(min(session.mtu, announced), MIN_MTU)
+            return []
+        reply = (len(frame) + OUTER_HEADERS).to_bytes(2, 'big')
+        return self.emit([(session, session.cipher.seal(reply, FRAME_PROBE))])
+
+    def emit(self, frames: list[tuple]) -> list[tuple]:
+        # Account the (session, frame) pairs and turn them into outputs.
+        outputs = []
+        for client, frame in frames:
+            self.update_transfer(client, len(frame))
+            self.metrics.sent(client.labels, len(frame))
+            outputs.append((frame, client.address))
+        return outputs
+
+    def flush(self) -> list[tuple]:
+        # Seal the bundles left in the coalescer, the dispatch engines call
+        # it at the end of every batch so no packet waits longer than that.
+        return self.emit(self.coalescer.flush())
+
+    def shape(self, outputs: list, frames: list[tuple], delay: float):
+        # Delayed packets are sent later by the rate limiter thread.
+        if not delay: return outputs.extend(frames)
+        [self.limits.delay(output, delay) for output in frames]
+
+    def send_packet(self, session: Session, tunnel: bool, connection: tuple[bytes, any]):
+        outputs = self.forward(session, tunnel, connection) + self.flush()
+        if outputs: self.io.send_batch(outputs)
+
+    def handshake(self, connection: tuple[bytes, any]) -> bool:
+        # Runs on the control plane: packets from unknown addresses are either
+        # credentials or belong to a session stored before this process started.
+        if not is_handshake(connection[0], self.auth_method.pending[0]):
+            if self.load_session(connection[1], connection[0]) is not None: return True
+            # The session is gone (evicted by the reaper, or never existed),
+            # the client is told so it authenticates again. A challenge sent
+            # instead is answered first.
+            if connection[1] not in self.challenges: self.server.sendto(self.auth_method.error, connection[1])
+            return False
+        data = self.new_connection(connection)
+        if data is None:
+            self.server.sendto(self.auth_method.error, connection[1])
+            return False
+        self.new_configuration(data)
+        return True
+
+    def classify(self, connection: tuple[bytes, any]) -> Optional[Session]:
+        # Get the session associated with the client address, unknown
+        # addresses are handed to the handshake stage without blocking.
+        session = self.sessions.get(connection[1])
+        # Frame kinds start at 0x10, so credentials sent from the address of
+        # a framed session are a new handshake and never data. Legacy frames
+        # have no header and may start with any byte.
+        if session is not None and session.cipher.framed and is_handshake(connection[0], self.auth_method.pending[0]):
+            session = None
+        elif session is None: session = self.resume(connection)
+        if session is None: self.handshakes.submit(connection)
+        return session
+
+    def resume(self, connection: tuple[bytes, any]) -> Optional[Session]:
+        # A frame from an unknown address that carries the ticket of a live
+        # session moves the session there, without a handshake. Like
+        # WireGuard roaming, the frame must open and be newer than every
+        # frame received so far, so a replayed frame cannot move it.
+        found = frame_ticket(connection[0])
+        if found is None: return None
+        session = self.sessions.ticket(found[0])
+        if session is None or found[1] <= session.cipher.received: return None
+        if session.cipher.open(connection[0]) is None: return None
+        self.roamed.add(1, ('memory',))
+        return self.sessions.move(session, connection[1])
+
+    def prepare_storage(self):
+        # Create the indexes used by the control plane lookups.
+        from connection.database.mongodb import create_indexes
+        return create_indexes(self.table_name)
+
+    def close(self):
+        # Stop the data plane, write the pending transfer counters and
+        # release the socket.
+        self.engine.stop()
+        self.handshakes.stop()
+        self.limits.stop()
+        self.reaper.stop()
+        if self.egress is not None: self.egress.stop()
+        self.metrics.registry.close()
+        if self.peers is not None: self.peers.close()
+        self.accounting.stop()
+        # Shutting the socket down wakes up a receive loop blocked on it.
+        try: self.server.shutdown(socket.SHUT_RDWR)
+        except OSError: pass
+        self.server.close()
 
     def run_server(self, port: int = 5732, tunnel: bool = False):
+        if self.reuse_port:
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.server.bind((self.ip_address, port))
-        collection = self.table_name['connections']
-        while True:
-            connection = self.server.recvfrom(65535)
-            # Get the data associated with the connection from the database.
-            connection_key = ':'.join(map(str, connection[1]))
-            data = Connection(collection).get(connection=connection_key)
-            # If the data does not exist in the database, then create a new
-            # configuration for the connection.
-            if not data:
-                self.new_configuration(self.new_connection(connection))
-                continue
-            arguments = data['encrypt'].encode(), tunnel, connection
-            Thread(target=self.send_packet, args=arguments, daemon=True).start()
-            args = data['account_id'], len(connection[0])
-            # Create a new thread to update the transfer status in the database.
-            Thread(target=self.update_transfer, args=args, daemon=True).start()
+        self.prepare_storage()
+        self.handshakes.start(), self.accounting.start(), self.limits.start(), self.reaper.start()
+        if tunnel and self.egress is None: self.egress = EgressEngine(self)
+        if tunnel: self.egress.start()
+        try: self.engine.serve(self, tunnel)
+        finally: self.handshakes.stop(), self.limits.stop(), self.reaper.stop(), self.accounting.stop()
 
 
 class VPNClient:
-    def __init__(self, server_address: Optional[tuple or str] = '192.168.1.0:5732'):
+    def __init__(self, server_address: Optional[tuple or str] = '192.168.1.0:5732',
+                 batch_size: int = 32):
         self.server_address = server_address
-        self.speed_monitor = SpeedMonitor()
+        # Download and upload counters, rates and the snapshot API.
+        self.metrics = TrafficMetrics(labels=())
         # If the server address is provided as a string, parse it into a tuple.
         if type(self.server_address) == str:
             self.server_address = server_address.split(':')
             self.server_address[1] = int(self.server_address[1])
             self.server_address = tuple(self.server_address)
         self.auth_method, self.token_length = DefaultAuth(), 40
-        # Set the MTU (Maximum Transmission Unit).
-        self.mtu = 1500
+        # Ciphers offered to the server in order of preference, and the one
+        # it picked.
+        self.ciphers, self.cipher = ['chacha20-poly1305', 'salsa20'], 'salsa20'
+        # Offer to bundle small packets, and whether the server accepted.
+        # A bundle waits up to `flush_delay` seconds for more packets.
+        self.coalesce, self.coalescing, self.flush_delay = True, False, 0.0
+        # Compression codecs to ask for, none by default, and the one the
+        # server picked.
+        self.compression, self.codec = [], None
+        # Session ticket given by the server, carried by the frames so the
+        # session survives a change of address (NAT rebinding, roaming).
+        self.ticket = b''
+        # Seconds without sending after which a keepalive frame is sent, it
+        # must stay below the idle timeout of the server, 0 disables them.
+        self.keepalive = 25.0
+        # Authenticate again when the server no longer knows the session,
+        # otherwise connect() returns.
+        self.reconnect = True
+        # MTU of the path to the server, lowered by probe_mtu(), and the MTU
+        # of the TUN device, agreed on with the server so a full packet and
+        # its encapsulation fit the path without fragments.
+        self.link_mtu, self.mtu = LINK_MTU, LINK_MTU
+        # Whether connect() probes the path MTU before bringing the device up.
+        self.probe = False
         self.connection = [self.server_address[0], '255.255.255.0']
         # Create a UDP socket for server communication.
         self.socket_server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.io = BatchSocket(self.socket_server, batch_size)
+        self.engine: ClientEngine or None = None
 
     def authenticate(self, username: str, password: str) -> tuple:
         # Define a function to decode IP addresses from bytes.
@@ -174,41 +561,109 @@ class VPNClient:
 
         # Wrap the provided username and password in an authentication packet
         packet = self.auth_method.wrap_credentials(username, password)
+        ciphers = bytes(CIPHER_IDS[cipher] for cipher in self.ciphers)
+        options = {OPTION_CIPHER: ciphers}
+        if self.coalesce: options[OPTION_COALESCE] = b'\x01'
+        if self.compression: options[OPTION_COMPRESSION] = bytes(CODEC_IDS[codec] for codec in self.compression)
+        options[OPTION_MTU] = self.link_mtu.to_bytes(2, 'big')
+        packet += pack_options(options)
         self.socket_server.sendto(packet, self.server_address)
         # Check if the received packet indicates a failed connection.
         recv_packet, connection = self.socket_server.recvfrom(65535)
         if recv_packet == b'\x03' or len(recv_packet) == 0:
             raise Exception('Connection failed: incorrect credentials')
-        # Unpack the received packet to extract decoded data.
-        packet = struct.unpack(f'4s4s{self.token_length}s', recv_packet)
+        # Unpack the received packet to extract decoded data, servers that
+        # do not know about options reply without them.
+        struct_format = f'4s4s{self.token_length}s'
+        packet = struct.unpack_from(struct_format, recv_packet)
+        options = unpack_options(recv_packet[struct.calcsize(struct_format):])
+        self.cipher = CIPHERS[options.get(OPTION_CIPHER, b'\x00')[0]].name
+        self.coalescing = OPTION_COALESCE in options
+        codec_id = options.get(OPTION_COMPRESSION)
+        self.codec = CODECS[codec_id[0]].name if codec_id else None
+        self.ticket = options.get(OPTION_SESSION, b'')
+        # Servers that do not agree on an MTU get one computed the same way.
+        overhead = CIPHERS[CIPHER_IDS[self.cipher]].overhead + len(self.ticket)
+        mtu = options.get(OPTION_MTU, b'')
+        self.mtu = int.from_bytes(mtu, 'big') if len(mtu) == 2 else tunnel_mtu(self.link_mtu, overhead)
         return decode(packet[0]), decode(packet[1]), packet[2]
 
-    def connect(self, credentials: tuple, interface: str):
-        # Create a TUN device with the specified interface.
-        tun = pytun.TunTapDevice(name=interface, flags=pytun.IFF_TUN | pytun.IFF_NO_PI)
+    def new_cipher(self, token: bytes):
+        cipher = new_context(self.cipher, token, initiator=True)
+        if self.ticket: cipher.attach(self.ticket)
+        return cipher
+
+    def send_probe(self, cipher, size: int) -> bool:
+        # Send a datagram of `size` bytes (with the IP and UDP headers) and
+        # wait for the server to confirm it arrived whole.
+        frame = cipher.seal(bytes(size - OUTER_HEADERS - cipher.overhead), FRAME_PROBE)
+        try: self.socket_server.sendto(frame, self.server_address)
+        except OSError: return False
+        deadline = time.monotonic() + self.socket_server.gettimeout()
+        while time.monotonic() < deadline:
+            try: reply = cipher.open(self.socket_server.recv(65535))
+            except OSError: return False
+            if reply is not None and reply[0] == FRAME_PROBE and int.from_bytes(reply[2][:2], 'big') == size:
+                return True
+        return False
+
+    def probe_mtu(self, token: bytes, timeout: float = 0.3, attempts: int = 2) -> int:
+        # Search the largest datagram that reaches the server unfragmented,
+        # then tell the server the tunnel MTU that fits it. Needs a framed
+        # cipher and runs before the engine takes over the socket.
+        cipher = self.new_cipher(token)
+        if not cipher.framed: return self.mtu
+        server = self.socket_server
+        discover = server.getsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER)
+        server.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, IP_PMTUDISC_PROBE)
+        server.settimeout(timeout)
+        low, high = MIN_MTU + OUTER_HEADERS + cipher.overhead, self.link_mtu
+        try:
+            while low < high:
+                size = (low + high + 1) // 2
+                if any(self.send_probe(cipher, size) for _ in range(attempts)): low = size
+                else: high = size - 1
+            self.link_mtu, self.mtu = low, min(self.mtu, tunnel_mtu(low, cipher.overhead))
+            server.sendto(cipher.seal(self.mtu.to_bytes(2, 'big'), FRAME_PROBE), self.server_address)
+        finally:
+            server.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, discover)
+            server.settimeout(None)
+        return self.mtu
+
+    def open_devices(self, interface: str, queues: int = 1) -> list:
+        import pytun
+        flags = pytun.IFF_TUN | pytun.IFF_NO_PI
+        # Multi-queue devices give one file descriptor per queue on the same
+        # interface, so each queue can be served by its own worker.
+        if queues > 1: flags |= pytun.IFF_MULTI_QUEUE
+        return [pytun.TunTapDevice(name=interface, flags=flags) for _ in range(queues)]
+
+    def start_engine(self, devices: list, token: bytes) -> ClientEngine:
+        # Derive the key material once for the whole session.
+        arguments = self.io, self.server_address, self.new_cipher(token), devices, self.metrics
+        self.engine = ClientEngine(*arguments, batch_size=self.io.batch_size, coalesce=self.coalescing,
+                                   flush_delay=self.flush_delay, codec=new_codec(self.codec),
+                                   keepalive=self.keepalive, max_datagram=self.link_mtu - OUTER_HEADERS,
+                                   error=self.auth_method.error)
+        return self.engine.start()
+
+    def connect(self, credentials: tuple, interface: str, queues: int = 1):
+        # Create the TUN device (one file descriptor per queue).
+        devices = self.open_devices(interface, queues)
+        tun = devices[0]
         # Authenticate with the provided credentials and set the connection details.
         self.connection = self.authenticate(*credentials)
+        if self.probe: self.probe_mtu(self.connection[2])
         # Configure the TUN device with IP address, netmask, token, and MTU.
         tun.addr, tun.netmask, token, tun.mtu = list(self.connection) + [self.mtu]
-        token, nonce = token[:len(token) - 8], token[len(token) - 8:]
-        print(tun.addr, tun.netmask, token)
+        print(tun.addr, tun.netmask, token, self.cipher, self.codec)
         # Enable TUN device persistence and bring it up.
         tun.persist(True), tun.up()
-        self.speed_monitor.start_monitoring()
-        while True:
-            # Monitor I/O sources for the TUN device and the socket server.
-            for source in select.select([tun, self.socket_server], [], [])[0]:
-                salsa_cipher = Salsa20.new(key=token, nonce=nonce)
-                # If the source is the TUN device, read data and send it to
-                # the server.
-                if type(source) == pytun.TunTapDevice:
-                    packet = salsa_cipher.encrypt(source.read(source.mtu))
-                    arguments = packet, self.server_address
-                    length = self.socket_server.sendto(*arguments)
-                    self.speed_monitor.update_transfer(0, length)
-                    continue
-                # If the source is the socket server, receive data and write
-                # it to the TUN device.
-                packet_data = salsa_cipher.decrypt(source.recvfrom(65535)[0])
-                if len(packet_data) > 0:
-                    self.speed_monitor.update_transfer(tun.write(packet_data), 0)
+        # Serve the TUN queues and the server socket until stopped.
+        while self.start_engine(devices, token).join() and self.reconnect:
+            # The server lost the session, the devices are kept and the
+            # address they had may have been given back to the pool.
+            self.socket_server.setblocking(True)
+            self.connection = self.authenticate(*credentials)
+            if self.probe: self.probe_mtu(self.connection[2])
+            tun.addr, tun.netmask, token, tun.mtu = list(self.connection) + [self.mtu]
@@ -1,4 +1,5 @@
 import argparse
+import csv
 import ctypes
 import json
 import os
@@ -8,7 +9,7 @@ from getpass import getpass
 from pymongo import MongoClient
 
 from connection import VPNClient, VPNServer
-from connection.network import Manager
+from connection.admin import AdminAPI
 
 
 def check_permissions() -> bool:
@@ -42,32 +43,35 @@ def launch_client(host: str, port: int, interface: str):
     except Exception as error: print(error)
 
 
-def server_commands(args, net_manager: Manager):
-    user = hasattr(args, 'username') and hasattr(args, 'password')
-    if args.add_user and user and hasattr(args, 'network_id'):
-        user_id = net_manager.new_account(args.username, args.password)
-        print('Created a new account: ', user_id)
+def server_commands(args, admin: AdminAPI):
+    user = args.username and args.password
+    if args.add_user and user:
+        result = admin.create_accounts([(args.username, args.password)], args.network_id)
+        print('Created a new account: ', *result['created'] or ['(already exists)'])
+    if args.import_users:
+        # One username,password pair per line.
+        with open(args.import_users, newline='') as file:
+            users = ((row[0], row[1]) for row in csv.reader(file) if row)
+            result = admin.create_accounts(users, args.network_id)
+        print('Created accounts:', len(result['created']), 'skipped:', len(result['skipped']))
     if args.list_users:
         print('Listing all users: ')
-        [print(user) for user in net_manager.list_accounts()]
-    if args.add_network and hasattr(args, 'network_range'):
-        network_id = net_manager.new_network(args.network_range, 5)
+        [print(user) for user in admin.accounts(('username', 'networks'), after=args.after)]
+    if args.add_network and args.network_range:
+        network_id = admin.create_network(args.network_range, int(args.max_address or 5))
         print('New network added:', network_id)
     if args.list_networks:
-        for network in net_manager.list_networks():
+        for network in admin.networks(after=args.after):
             print('Network ID:', network['_id'])
             print('Connection Limit:', network['max_address'])
             print('Subnet Mask:', network['subnet_mask'])
             print('Network Range:', network['network_range'])
-            print('Connections:')
-            for connection in network['connections'].items():
-                print(connection[0], '=>', connection[1])
 
 
 def launch_server(commands: dict, host: str, port: int):
     mongo_client = MongoClient("mongodb://localhost:27017/")
     vpn = VPNServer(mongo_client, 'test_network')
-    vpn.ip_address, manager = host, vpn.network_manager
+    vpn.ip_address, manager = host, AdminAPI(vpn.table_name)
     server = threading.Thread(target=vpn.run_server, args=(port, ), daemon=True)
     server.start()
     while True:
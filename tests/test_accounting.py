@@ -0,0 +1,22 @@
+import threading
+
+from connection.accounting import TransferAccounting
+from connection.database import open_client
+
+
+def test_concurrent_add_and_flush():
+    database = open_client('memory://')['test']
+    database['accounts'].insert_one({'_id': 'a', 'transfer_ratio': 0})
+    database['connections'].insert_one({'_id': 'c', 'transfer_ratio': 0})
+    accounting, done = TransferAccounting(database), threading.Event()
+
+    def add():
+        for _ in range(50000): accounting.add('a', 'c', 1)
+        done.set()
+
+    thread = threading.Thread(target=add)
+    thread.start()
+    while not done.is_set(): accounting.flush()
+    thread.join(), accounting.flush()
+    assert database['accounts'].find_one({'_id': 'a'})['transfer_ratio'] == 50000
+    assert database['connections'].find_one({'_id': 'c'})['transfer_ratio'] == 50000
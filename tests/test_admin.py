@@ -0,0 +1,36 @@
+import pytest
+
+from connection.admin import AdminAPI
+from connection.database import open_client
+
+
+@pytest.fixture
+def admin():
+    admin = AdminAPI(open_client('memory://')['test'], processes=1, rounds=4, batch_size=2)
+    yield admin
+    admin.close()
+
+
+def test_pages_end_without_a_cursor(admin):
+    ids = [str(admin.create_network(f'10.{index}.0.0/24', 10)) for index in range(4)]
+    page, cursor = admin.page('networks', ('network_range',), page_size=2)
+    assert [str(network['_id']) for network in page] == ids[:2] and cursor == ids[1]
+    # The last page is full, there is nothing after it.
+    page, cursor = admin.page('networks', ('network_range',), page_size=2, after=cursor)
+    assert [str(network['_id']) for network in page] == ids[2:] and cursor is None
+    page, cursor = admin.page('networks', ('network_range',), page_size=5)
+    assert len(page) == 4 and cursor is None
+
+
+def test_stream_reads_every_page(admin):
+    ids = [admin.create_network(f'10.{index}.0.0/24', 10) for index in range(5)]
+    assert [network['_id'] for network in admin.networks(('network_range',))] == ids
+    assert [network['_id'] for network in admin.networks(('network_range',), after=str(ids[2]))] == ids[3:]
+
+
+def test_create_accounts_joins_the_network(admin):
+    network_id = admin.create_network('10.8.0.0/24', 10)
+    result = admin.create_accounts([('alice', 'a'), ('bob', 'b'), ('carol', 'c')], network_id)
+    again = admin.create_accounts([('alice', 'a')])
+    assert len(result['created']) == 3 and again['skipped'] == ['alice']
+    assert sorted(result['addresses'].values()) == ['10.8.0.1', '10.8.0.2', '10.8.0.3']
@@ -0,0 +1,91 @@
+import socket
+
+from connection import VPNServer
+from connection.authentication import DefaultAuth
+from connection.ciphers import FLAG_SESSION, FRAME_DATA, FRAME_HEADER, FRAME_KEEPALIVE, TAG_LENGTH, frame_ticket, \
+    new_context
+from connection.database import open_client
+from connection.database.mongodb import Account, Network
+
+TOKEN = b'k' * 40
+TICKET = bytes(range(8))
+
+
+def pair() -> tuple:
+    return new_context('chacha20-poly1305', TOKEN, initiator=True), new_context('chacha20-poly1305', TOKEN)
+
+
+def test_both_directions_open():
+    client, server = pair()
+    frame = client.seal(b'ping')
+    assert len(frame) == len(b'ping') + client.overhead
+    assert server.open(frame) == (FRAME_DATA, 0, b'ping')
+    assert client.open(server.seal(b'pong', FRAME_KEEPALIVE)) == (FRAME_KEEPALIVE, 0, b'pong')
+
+
+def test_directions_use_their_own_nonces():
+    # A frame is never accepted by the end that sealed it, even with the
+    # same key and counter.
+    client, server = pair()
+    assert client.open(client.seal(b'ping')) is None
+    assert server.open(server.seal(b'pong')) is None
+
+
+def test_counters_increase():
+    client, server = pair()
+    frames = [client.seal(b'') for _ in range(3)]
+    counters = [FRAME_HEADER.unpack_from(frame)[2] for frame in frames]
+    assert counters[1] == counters[0] + 1 and counters[2] == counters[0] + 2
+    [server.open(frame) for frame in reversed(frames)]
+    assert server.received == counters[2]
+    # A context rebuilt from the same token starts somewhere else.
+    assert FRAME_HEADER.unpack_from(pair()[0].seal(b''))[2] != counters[0] + 3
+
+
+def test_tampered_frames_are_refused():
+    client, server = pair()
+    frame = bytearray(client.seal(b'payload'))
+    for offset in 0, 1, FRAME_HEADER.size, len(frame) - 1:
+        tampered = bytearray(frame)
+        tampered[offset] ^= 0x01
+        assert server.open(bytes(tampered)) is None
+    assert server.open(bytes(frame[:FRAME_HEADER.size + TAG_LENGTH - 1])) is None
+    assert server.received == -1
+
+
+def test_attached_ticket_is_authenticated():
+    client, server = pair()
+    client.attach(TICKET)
+    frame = client.seal(b'ping')
+    assert frame[1] & FLAG_SESSION and len(frame) == len(b'ping') + client.overhead
+    assert frame_ticket(frame) == (TICKET, FRAME_HEADER.unpack_from(frame)[2])
+    # The flag is not part of the flags returned.
+    assert server.open(frame) == (FRAME_DATA, 0, b'ping')
+    # The ticket is associated data, another ticket does not open.
+    forged = frame[:FRAME_HEADER.size] + bytes(8) + frame[FRAME_HEADER.size + 8:]
+    assert frame_ticket(forged)[0] == bytes(8) and server.open(forged) is None
+    assert frame_ticket(pair()[0].seal(b'ping')) is None
+
+
+def test_legacy_client_gets_a_salsa20_session():
+    client = open_client('memory://')
+    server = VPNServer(client, 'test')
+    network = Network(client['test']['networks'])
+    network.create('10.8.0.0/24', 10)
+    account = server.new_account('alice', 'secret')
+    network.to_network(Account(client['test']['accounts'], account['id']))
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(('127.0.0.1', 0)), receiver.settimeout(1)
+    try:
+        credentials = DefaultAuth().wrap_credentials('alice', 'secret')
+        assert server.handshake((credentials, receiver.getsockname()))
+        # The legacy client unpacks exactly '4s4s40s'.
+        reply = receiver.recv(1500)
+        assert len(reply) == 48
+        session = server.sessions.get(receiver.getsockname())
+        assert session.cipher.name == 'salsa20' and session.ticket is None
+        legacy = new_context('salsa20', reply[8:])
+        assert session.cipher.open(legacy.seal(b'packet')) == (FRAME_DATA, 0, b'packet')
+    finally:
+        server.handshakes.stop(), receiver.close()
+
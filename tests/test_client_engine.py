@@ -0,0 +1,37 @@
+import os
+import socket
+
+from connection import VPNServer
+from connection.batch_io import BatchSocket
+from connection.ciphers import new_context
+from connection.client_engine import ClientEngine
+from connection.database import open_client
+
+
+def udp_socket() -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.settimeout(1)
+    return sock
+
+
+def test_unknown_sessions_are_told_to_authenticate_again():
+    server, client = VPNServer(open_client('memory://'), 'test'), udp_socket()
+    frame = new_context('chacha20-poly1305', b'k' * 40, initiator=True).seal(b'packet')
+    assert not server.handshake((frame, client.getsockname()))
+    assert client.recv(64) == server.auth_method.error
+    server.server.close()
+
+
+def test_engine_stops_when_the_session_is_lost():
+    server, client = udp_socket(), udp_socket()
+    engine = ClientEngine(BatchSocket(client), server.getsockname(), new_context('salsa20', b'k' * 40), [])
+    engine.running = True
+    read, write = os.pipe()
+    # An error from elsewhere is ignored.
+    udp_socket().sendto(b'\x03', client.getsockname())
+    engine.drain_socket(write)
+    assert not engine.lost
+    server.sendto(b'\x03', client.getsockname())
+    engine.drain_socket(write)
+    assert engine.lost and not engine.running and engine.join()
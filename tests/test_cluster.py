@@ -0,0 +1,45 @@
+import tempfile
+
+from connection import VPNServer
+from connection.cluster import WorkerPeers
+from connection.database import open_client
+from connection.sessions import Session, SessionTable
+
+
+class LockWatcher:
+    def __init__(self, table: SessionTable):
+        self.table, self.locked = table, []
+
+    def added(self, session):
+        self.locked.append(self.table.lock.locked())
+
+    def removed(self, session):
+        self.locked.append(self.table.lock.locked())
+
+
+def new_session(port: int, account_id: str = 'a') -> Session:
+    connection = dict(id=port, account_id=account_id, network_id='n', ip_address=f'10.8.0.{port}', encrypt=b'k' * 40)
+    return Session(connection, ('192.0.2.1', port))
+
+
+def test_watchers_run_outside_the_lock():
+    table = SessionTable()
+    watcher = LockWatcher(table)
+    table.watchers.append(watcher)
+    # Added, replaced, removed by account, added again and replaced by a move.
+    session = table.add(new_session(1))
+    table.add(new_session(1)), table.remove_account('a')
+    table.add(session), table.move(new_session(2), session.address)
+    assert watcher.locked == [False] * 6
+
+
+def test_handoff_drops_instead_of_blocking():
+    directory = tempfile.mkdtemp()
+    servers = [VPNServer(open_client('memory://'), 'test') for _ in range(2)]
+    # The second worker never reads its channel.
+    peers = [WorkerPeers(server, index, 2, directory) for index, server in enumerate(servers)]
+    peers[0].routes['n', '10.8.0.2'] = 1
+    for _ in range(10000):
+        assert peers[0].handoff('n', '10.8.0.2', b'\x00' * 1024)
+    assert peers[0].dropped.value(('P',)) > 0
+    [peer.close() for peer in peers]
@@ -0,0 +1,51 @@
+from connection.ciphers import FRAME_BUNDLE, FRAME_DATA, new_context
+from connection.coalesce import BUNDLE_ENTRY, Coalescer, bundle, group, unbundle
+from connection.sessions import Session
+
+
+def new_session(mtu: int = None) -> Session:
+    connection = dict(id=1, account_id='a', network_id='n', ip_address='10.8.0.1', encrypt=b'k' * 40,
+                      cipher='chacha20-poly1305', coalesce=True, mtu=mtu)
+    return Session(connection, ('192.0.2.1', 1))
+
+
+def test_bundle_round_trip():
+    packets = [b'a' * 10, b'', b'b' * 300]
+    assert [bytes(packet) for packet in unbundle(bundle(packets))] == packets
+    assert unbundle(b'') == []
+
+
+def test_truncated_entries_end_the_bundle():
+    payload = bundle([b'first', b'second'])
+    assert [bytes(packet) for packet in unbundle(payload[:-1])] == [b'first']
+    assert [bytes(packet) for packet in unbundle(payload + b'\x00')] == [b'first', b'second']
+    assert unbundle(BUNDLE_ENTRY.pack(10) + b'short') == []
+
+
+def test_groups_fit_the_budget():
+    packets = [b'x' * 100] * 10
+    groups = group(packets, 2 * (100 + BUNDLE_ENTRY.size))
+    assert [len(packets) for packets in groups] == [2] * 5
+    assert sum(groups, []) == packets
+    # A packet larger than the budget gets a group of its own.
+    assert group([b'x' * 10, b'y' * 500, b'z'], 100) == [[b'x' * 10], [b'y' * 500], [b'z']]
+
+
+def test_budget_is_the_smaller_of_the_datagram_and_the_mtu():
+    coalescer = Coalescer(max_datagram=1472)
+    assert coalescer.budget(new_session(1000)) == 1000
+    session = new_session(1460)
+    assert coalescer.budget(session) == 1472 - session.cipher.overhead
+
+
+def test_packets_are_sealed_when_the_next_does_not_fit():
+    coalescer, session = Coalescer(), new_session(1000)
+    client = new_context('chacha20-poly1305', b'k' * 40, initiator=True)
+    packets = [bytes([index]) * 300 for index in range(4)]
+    sealed = sum((coalescer.add(session, packet) for packet in packets), [])
+    # Three entries of 302 bytes fit 1000, the fourth waits for flush().
+    assert len(sealed) == 1 and client.open(sealed[0][1])[0] == FRAME_BUNDLE
+    assert [bytes(packet) for packet in unbundle(client.open(sealed[0][1])[2])] == packets[:3]
+    flushed = coalescer.flush()
+    assert client.open(flushed[0][1]) == (FRAME_DATA, 0, packets[3])
+    assert coalescer.flush() == [] and (coalescer.bundles, coalescer.packets) == (1, 3)
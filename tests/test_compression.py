@@ -0,0 +1,65 @@
+import os
+
+import pytest
+
+from connection.ciphers import FRAME_DATA, new_context
+from connection.compression import FLAG_COMPRESSED, MAX_LENGTH, MIN_LENGTH, Compressor, ZlibCodec, new_codec
+
+TEXT = b'GET /index.html HTTP/1.1\r\nHost: example.com\r\n' * 20
+
+
+def test_round_trip():
+    compressor, codec = Compressor(), ZlibCodec()
+    payload, flags = compressor.compress(codec, 'flow', TEXT)
+    assert flags == FLAG_COMPRESSED and len(payload) < len(TEXT)
+    assert compressor.decompress(codec, flags, payload) == TEXT
+    # Uncompressed frames are returned as they are.
+    assert compressor.decompress(codec, 0, b'raw') == b'raw'
+    assert compressor.decompress(None, FLAG_COMPRESSED, payload) is None
+
+
+def test_sealed_frames_carry_the_flag():
+    compressor, codec = Compressor(), ZlibCodec()
+    sender, receiver = new_context('chacha20-poly1305', b'k' * 40, True), new_context('chacha20-poly1305', b'k' * 40)
+    kind, flags, payload = receiver.open(compressor.seal(sender, codec, 'flow', TEXT))
+    assert (kind, flags) == (FRAME_DATA, FLAG_COMPRESSED) and codec.decompress(payload) == TEXT
+    assert receiver.open(compressor.seal(sender, codec, 'flow', b'short'))[1:] == (0, b'short')
+    assert len(b'short') < MIN_LENGTH
+
+
+def test_incompressible_flows_back_off():
+    compressor, codec = Compressor(max_backoff=16), ZlibCodec()
+    random = os.urandom(1024)
+    assert compressor.compress(codec, 'flow', random) == (random, 0)
+    # The next 8 payloads are not even tried, then twice as many.
+    assert [compressor.compress(codec, 'flow', TEXT)[1] for _ in range(8)] == [0] * 8
+    assert compressor.compress(codec, 'flow', random)[1] == 0
+    assert compressor.flows['flow'].skip == 16
+    [compressor.compress(codec, 'flow', TEXT) for _ in range(16)]
+    assert compressor.compress(codec, 'flow', random)[1] == 0 and compressor.flows['flow'].skip == 16
+    # Other flows are not affected, and a payload that shrinks resets it.
+    assert compressor.compress(codec, 'other', TEXT)[1] == FLAG_COMPRESSED
+    [compressor.compress(codec, 'flow', TEXT) for _ in range(16)]
+    assert compressor.compress(codec, 'flow', TEXT)[1] == FLAG_COMPRESSED
+    assert compressor.flows['flow'].backoff == 0
+    assert compressor.packets.values() == {('incompressible',): 3, ('skipped',): 40, ('compressed',): 2}
+
+
+def test_zlib_bomb_is_refused():
+    codec = ZlibCodec()
+    assert codec.decompress(codec.compress(bytes(MAX_LENGTH))) == bytes(MAX_LENGTH)
+    assert codec.decompress(codec.compress(bytes(MAX_LENGTH + 1))) is None
+    assert codec.decompress(codec.compress(bytes(100 * MAX_LENGTH))) is None
+    assert codec.decompress(b'not deflate') is None
+    # A truncated stream is refused too.
+    assert codec.decompress(codec.compress(TEXT)[:-4]) is None
+
+
+def test_lz4_bomb_is_refused():
+    pytest.importorskip('lz4')
+    codec = new_codec('lz4')
+    assert codec.decompress(codec.compress(TEXT)) == TEXT
+    assert codec.decompress(codec.compress(bytes(MAX_LENGTH + 1))) is None
+    # The announced size is checked before anything is expanded.
+    assert codec.decompress((MAX_LENGTH + 1).to_bytes(4, 'little') + b'\x00') is None
+    assert codec.decompress(b'\x01') is None
@@ -0,0 +1,56 @@
+import socket
+
+from connection.egress import ICMP, TCP, UDP, Flow, FlowTable
+
+
+def flow(sport: int, protocol: int = TCP, timeout: float = 30.0) -> Flow:
+    return Flow(('n', '10.8.0.2', protocol, sport, '198.51.100.1', 443), ('198.51.100.1', 443), timeout)
+
+
+def test_add_and_remove():
+    table = FlowTable(ports=(61000, 61009))
+    added = table.add(flow(40000))
+    assert added.port == 61000 and table.flows[added.key] is added
+    assert table.replies[TCP, 61000, '198.51.100.1', 443] is added and len(table.wheel) == 1
+    table.remove(added), table.remove(added)
+    assert len(table) == 0 and not table.replies and len(table.wheel) == 0
+    # The port goes back to the end of the pool.
+    assert list(table.ports[TCP].free)[-1] == 61000
+
+
+def test_udp_flows_are_found_by_socket():
+    table, sock = FlowTable(), socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    udp = flow(40000, UDP)
+    udp.socket = sock
+    table.add(udp)
+    assert udp.port is None and table.sockets[sock.fileno()] is udp and not table.replies
+    table.remove(udp)
+    assert not table.sockets
+    sock.close()
+
+
+def test_port_pool_exhaustion():
+    table = FlowTable(ports=(61000, 61001))
+    first, second = table.add(flow(1)), table.add(flow(2))
+    assert table.add(flow(3)) is None and len(table) == 2
+    # TCP and ICMP have pools of their own.
+    assert table.add(flow(1, ICMP)).port == 61000
+    table.remove(first)
+    assert table.add(flow(3)).port == first.port
+
+
+def test_max_flows():
+    table = FlowTable(max_flows=2)
+    table.add(flow(1)), table.add(flow(2))
+    assert table.add(flow(3)) is None and len(table) == 2 and len(table.ports[TCP].free) == 4536 - 2
+
+
+def test_idle_flows_expire():
+    table = FlowTable()
+    table.wheel.updated = 0.0
+    idle, active = table.add(flow(1, timeout=5)), table.add(flow(2, timeout=5))
+    idle.last_seen = active.last_seen = 0.0
+    active.last_seen = 3.0
+    assert table.expire(5) == [idle] and len(table) == 1
+    # The active flow was scheduled again for the rest of its timeout.
+    assert table.expire(7) == [] and table.expire(8) == [active] and len(table) == 0
@@ -0,0 +1,37 @@
+from connection import VPNServer
+from connection.authentication import DefaultAuth
+from connection.database import open_client
+from connection.handshake import HandshakeStage
+from connection.sessions import Session
+
+CREDENTIALS = DefaultAuth().wrap_credentials('alice', 'secret')
+
+
+def new_session(cipher: str) -> Session:
+    connection = dict(id=1, account_id='a', network_id='n', ip_address='10.8.0.1', encrypt=b'k' * 40, cipher=cipher)
+    return Session(connection, ('192.0.2.1', 1))
+
+
+def test_sources_stay_bounded():
+    stage = HandshakeStage(None, max_sources=64)
+    for index in range(1000):
+        assert stage.allow(f'198.51.{index // 256}.{index % 256}')
+    assert len(stage.sources) <= 64
+    # The latest sources are kept.
+    assert '198.51.3.231' in stage.sources
+
+
+def test_credentials_from_a_framed_session_are_a_handshake():
+    server = VPNServer(open_client('memory://'), 'test')
+    session = server.sessions.add(new_session('chacha20-poly1305'))
+    assert server.classify((CREDENTIALS, session.address)) is None
+    assert server.handshakes.queue.qsize() == 1
+    # Frames of the session are still data.
+    assert server.classify((session.cipher.seal(CREDENTIALS), session.address)) is session
+
+
+def test_legacy_frames_are_always_data():
+    server = VPNServer(open_client('memory://'), 'test')
+    session = server.sessions.add(new_session('salsa20'))
+    assert server.classify((CREDENTIALS, session.address)) is session
+    assert server.handshakes.queue.qsize() == 0
@@ -0,0 +1,62 @@
+import socket
+import struct
+
+import pytest
+
+from connection import VPNServer
+from connection.database import open_client
+from connection.sessions import Session
+
+
+def new_session(port: int) -> Session:
+    connection = dict(id=port, account_id='a', network_id='n', ip_address=f'10.8.0.{port}', encrypt=b'k' * 40)
+    return Session(connection, ('192.0.2.1', port))
+
+
+def udp(destination: str, length: int) -> bytes:
+    return struct.pack('!BBHHHBBH4s4s', 0x45, 0, 28 + length, 0, 0x4000, 64, 17, 0,
+                       socket.inet_aton('10.8.0.1'), socket.inet_aton(destination)) + \
+        struct.pack('!HHHH', 40000, 53, 8 + length, 0) + b'\x00' * length
+
+
+class Egress:
+    def __init__(self):
+        self.sent = []
+
+    def send(self, session, header, packet: bytes):
+        self.sent.append(packet)
+
+
+@pytest.fixture
+def server():
+    server = VPNServer(open_client('memory://'), 'test')
+    server.limits.configure('accounts', 'a', dict(rate=1000, burst=1000, mode='queue'))
+    return server
+
+
+def test_unrouted_packets_are_not_charged(server):
+    sender = server.sessions.add(new_session(1))
+    outputs = []
+    for _ in range(5): server.route(sender, False, udp('10.8.0.9', 472), outputs)
+    assert server.limits.accounts['a'].stats()['passed'] == 0
+    assert server.metrics.dropped.value(('no_route',)) == 5
+
+
+def test_delayed_packets_wait_for_clients(server):
+    sender, receiver = server.sessions.add(new_session(1)), server.sessions.add(new_session(2))
+    outputs = []
+    server.route(sender, False, udp('10.8.0.2', 972), outputs)
+    server.route(sender, False, udp('10.8.0.2', 72), outputs)
+    # The first packet passed, the second one waits in the rate limiter.
+    assert len(outputs) == 1 and len(server.limits.delayed) == 1
+
+
+def test_delayed_packets_of_the_egress_are_dropped(server):
+    sender, server.egress = server.sessions.add(new_session(1)), Egress()
+    outputs = []
+    server.route(sender, True, udp('198.51.100.1', 972), outputs)
+    server.route(sender, True, udp('198.51.100.1', 72), outputs)
+    assert len(server.egress.sent) == 1 and not server.limits.delayed
+    assert server.metrics.dropped.value(('rate_limit',)) == 1
+    # The tokens of the dropped packet are given back.
+    assert server.limits.accounts['a'].bucket.tokens == pytest.approx(0, abs=1)
@@ -0,0 +1,91 @@
+import pytest
+from pymongo import ReturnDocument
+
+from connection.database.memory.collection import MemoryCollection, matches
+
+
+def pool_collection() -> MemoryCollection:
+    collection = MemoryCollection('networks')
+    collection.insert_one(dict(_id=1, next_address=4, released=[3, 5, 7], connections={'a': '10.0.0.1'}))
+    return collection
+
+
+def test_pop_with_slice_returns_the_popped_id():
+    # The query, update and projection Network._get_address() uses.
+    collection = pool_collection()
+    query = {'_id': 1, 'released.0': {'$exists': True}}
+    fields = {'released': {'$slice': 1}, 'next_address': 1}
+    before = collection.find_one_and_update(query, {'$pop': {'released': -1}}, fields)
+    assert before == dict(_id=1, released=[3], next_address=4)
+    assert collection.find_one({'_id': 1})['released'] == [5, 7]
+    after = collection.find_one_and_update(query, {'$pop': {'released': -1}}, fields,
+                                           return_document=ReturnDocument.AFTER)
+    assert after['released'] == [7]
+
+
+def test_pop_from_the_end_and_empty_list():
+    collection = pool_collection()
+    collection.update_one({'_id': 1}, {'$pop': {'released': 1}})
+    assert collection.find_one({'_id': 1})['released'] == [3, 5]
+    collection.update_one({'_id': 1}, {'$set': {'released': []}})
+    query = {'_id': 1, 'released.0': {'$exists': True}}
+    assert collection.find_one_and_update(query, {'$pop': {'released': -1}}) is None
+    assert collection.find_one({'_id': 1})['released'] == []
+
+
+def test_negative_slice_projection():
+    collection = pool_collection()
+    assert collection.find_one({'_id': 1}, {'released': {'$slice': -2}})['released'] == [5, 7]
+
+
+def test_conditional_set_only_when_missing():
+    # Network.to_network() only sets an address nobody assigned first.
+    collection = pool_collection()
+    query = {'_id': 1, 'connections.b': {'$exists': False}}
+    assert collection.update_one(query, {'$set': {'connections.b': '10.0.0.2'}}).modified_count == 1
+    assert collection.update_one(query, {'$set': {'connections.b': '10.0.0.9'}}).modified_count == 0
+    assert collection.find_one({'_id': 1})['connections'] == {'a': '10.0.0.1', 'b': '10.0.0.2'}
+
+
+def test_exists_on_null_and_missing_fields():
+    collection = MemoryCollection('accounts')
+    collection.insert_one(dict(_id=1, networks={'n': dict(ip_address=None)}))
+    assert collection.find_one({'networks.n': {'$exists': True}}) is not None
+    assert collection.find_one({'networks.n.ip_address': {'$exists': True}}) is not None
+    assert collection.find_one({'networks.m': {'$exists': True}}) is None
+    assert collection.find_one({'networks.m': {'$exists': False}}) is not None
+
+
+def test_find_one_and_update_unset_returns_the_removed_fields():
+    # The document returned before the update holds the unset fields.
+    collection = pool_collection()
+    query = {'_id': 1, 'connections.a': {'$exists': True}}
+    before = collection.find_one_and_update(query, {'$unset': {'connections.a': ''}}, {'connections.a': 1})
+    assert before['connections'] == {'a': '10.0.0.1'}
+    assert collection.find_one_and_update(query, {'$unset': {'connections.a': ''}}) is None
+
+
+DOCUMENTS = [dict(_id=1, a=1, b='x'), dict(_id=2, a=None, b='x'), dict(_id=3, b='y'),
+             dict(_id=4, a=[1, 2], b='x'), dict(_id=5, a=2, b='y', c=dict(d=1))]
+
+
+@pytest.mark.parametrize('query', [{'a': 1}, {'a': 2}, {'a': None}, {'a': [1, 2]}, {'a': 3},
+                                   {'a': 1, 'b': 'x'}, {'a': None, 'b': 'y'}, {'b': 'x', 'a': {'$exists': True}},
+                                   {'c.d': 1}, {'_id': 4}, {'_id': 6}])
+def test_index_candidates_agree_with_a_full_scan(query):
+    collection = MemoryCollection('items')
+    for fields in ('a', [('a', 1), ('b', 1)], 'c.d'): collection.create_index(fields)
+    collection.insert_many([dict(document) for document in DOCUMENTS])
+    found = sorted(document['_id'] for document in collection.find(query))
+    assert found == [document['_id'] for document in DOCUMENTS if matches(document, query)]
+
+
+def test_index_follows_updates_and_deletes():
+    collection = MemoryCollection('items')
+    collection.create_index('a')
+    collection.insert_many([dict(document) for document in DOCUMENTS])
+    collection.update_one({'_id': 4}, {'$set': {'a': 7}})
+    collection.update_one({'_id': 1}, {'$set': {'a': [7]}})
+    assert sorted(document['_id'] for document in collection.find({'a': 7})) == [1, 4]
+    collection.delete_one({'_id': 1})
+    assert [document['_id'] for document in collection.find({'a': 7})] == [4]
@@ -0,0 +1,51 @@
+import threading
+
+from connection.metrics import MetricsRegistry
+
+
+def in_thread(target):
+    thread = threading.Thread(target=target)
+    thread.start(), thread.join()
+
+
+def test_fold_of_the_own_shard_is_immediate():
+    counter = MetricsRegistry().counter('bytes_total', 'Bytes.', ('account', 'session'))
+    counter.add(10, ('a', 's1')), counter.add(5, ('a', ''))
+    counter.forget(('a', 's1'), ('a', ''))
+    assert counter.values() == {('a', ''): 15}
+
+
+def test_fold_of_another_thread_waits_for_its_next_write():
+    counter = MetricsRegistry().counter('bytes_total', 'Bytes.', ('account', 'session'))
+    writer = threading.Event(), threading.Event(), threading.Event()
+
+    def work():
+        counter.add(10, ('a', 's1'))
+        writer[0].set(), writer[1].wait()
+        counter.add(1, ('a', 's2'))
+        writer[2].set()
+
+    thread = threading.Thread(target=work)
+    thread.start(), writer[0].wait()
+    counter.forget(('a', 's1'), ('a', ''))
+    # Not moved yet, but nothing is lost or counted twice.
+    assert counter.values() == {('a', 's1'): 10}
+    writer[1].set(), writer[2].wait(), thread.join()
+    assert counter.values() == {('a', ''): 10, ('a', 's2'): 1}
+
+
+def test_fold_skips_shards_without_the_labels():
+    counter = MetricsRegistry().counter('bytes_total', 'Bytes.', ('session',))
+    in_thread(lambda: counter.add(3, ('s2',)))
+    counter.forget(('s1',), ('',))
+    assert all(not pending for _, pending in counter.shards)
+
+
+def test_callback_counter_exposition():
+    registry, dropped = MetricsRegistry(), {('completed',): 3}
+    registry.callback_counter('handshakes_total', 'Handshakes by outcome.', lambda: dropped, ('outcome',))
+    registry.gauge('queue_depth', 'Queued handshakes.', lambda: 2)
+    lines = registry.exposition().splitlines()
+    assert '# TYPE handshakes_total counter' in lines and 'handshakes_total{outcome="completed"} 3' in lines
+    assert '# TYPE queue_depth gauge' in lines and 'queue_depth 2' in lines
+    assert registry.snapshot()['handshakes_total'] == {'completed': 3}
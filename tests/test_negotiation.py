@@ -0,0 +1,28 @@
+from connection import VPNServer
+from connection.authentication import DefaultAuth
+from connection.ciphers import CIPHER_IDS
+from connection.database import open_client
+from connection.handshake import OPTION_CIPHER, OPTION_MTU, pack_options
+
+CREDENTIALS = DefaultAuth().wrap_credentials('alice', 'secret')
+
+
+def negotiate(options: dict = None) -> tuple[dict, dict]:
+    server = VPNServer(open_client('memory://'), 'test')
+    negotiated = server.negotiate(CREDENTIALS + (pack_options(options) if options else b''))
+    return negotiated, server.reply_options(negotiated)
+
+
+def test_clients_without_options_get_the_legacy_reply():
+    # The legacy client unpacks exactly '4s4s40s', nothing may follow.
+    negotiated, options = negotiate()
+    assert negotiated == {} and options == {}
+
+
+def test_mtu_is_only_answered_when_offered():
+    ciphers = {OPTION_CIPHER: bytes([CIPHER_IDS['chacha20-poly1305']])}
+    assert OPTION_MTU not in negotiate(ciphers)[1]
+    negotiated, options = negotiate({**ciphers, OPTION_MTU: (1400).to_bytes(2, 'big')})
+    # IPv4 + UDP, frame header, ticket and tag.
+    assert negotiated['mtu'] == 1400 - 28 - 10 - 8 - 16
+    assert options[OPTION_MTU] == negotiated['mtu'].to_bytes(2, 'big')
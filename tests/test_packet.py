@@ -0,0 +1,129 @@
+import socket
+import struct
+
+from connection.packet import adjust_checksum, checksum, clamp_mss, icmp_too_big, ipv4_udp_packet, parse_header, \
+    rewrite_ipv4, update_checksums
+
+
+def ipv4(protocol: int, segment: bytes, flags: int = 0x4000) -> bytes:
+    return struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(segment), 0, flags, 64, protocol, 0,
+                       socket.inet_aton('10.0.0.2'), socket.inet_aton('10.0.0.3')) + segment
+
+
+def ipv6(protocol: int, payload: bytes) -> bytes:
+    source, destination = socket.inet_pton(socket.AF_INET6, 'fd00::2'), socket.inet_pton(socket.AF_INET6, 'fd00::3')
+    return struct.pack('!IHBB', 6 << 28, len(payload), protocol, 64) + source + destination + payload
+
+
+def tcp_syn(mss: int, options: bytes = b'') -> bytearray:
+    # IPv4 TCP SYN whose options are `options` followed by the MSS option.
+    options += struct.pack('!BBH', 2, 4, mss)
+    options += b'\x00' * (-len(options) % 4)
+    tcp = struct.pack('!HHIIBBHHH', 40000, 443, 1, 0, (5 + len(options) // 4) << 4, 0x02, 64240, 0, 0) + options
+    return update_checksums(bytearray(ipv4(6, tcp)))
+
+
+def valid_ipv4(packet: bytes) -> bool:
+    # A header or segment holding its own checksum sums to zero.
+    offset = (packet[0] & 0x0F) * 4
+    if checksum(packet[:offset]): return False
+    segment = bytes(packet[offset:])
+    pseudo = b'' if packet[9] == 1 else bytes(packet[12:20]) + struct.pack('!BBH', 0, packet[9], len(segment))
+    return checksum(pseudo + segment) == 0
+
+
+def test_ipv4_ports():
+    header = parse_header(ipv4(17, struct.pack('!HHHH', 40000, 53, 8, 0)))
+    assert header == (4, '10.0.0.2', '10.0.0.3', 17, 40000, 53, 20)
+    # ICMP has no ports, later fragments carry no L4 header.
+    assert parse_header(ipv4(1, b'\x08\x00' * 4))[4:6] == (0, 0)
+    assert parse_header(ipv4(17, struct.pack('!HHHH', 40000, 53, 8, 0), flags=10))[4:6] == (0, 0)
+
+
+def test_ipv6_extension_headers():
+    udp = struct.pack('!HHHH', 40000, 53, 8, 0)
+    header = parse_header(ipv6(17, udp))
+    assert header == (6, 'fd00::2', 'fd00::3', 17, 40000, 53, 40)
+    # Hop-by-hop options, then a first fragment.
+    chain = struct.pack('!BB6x', 44, 0) + struct.pack('!BxHI', 17, 0, 1) + udp
+    assert parse_header(ipv6(0, chain))[3:] == (17, 40000, 53, 56)
+    later = struct.pack('!BxHI', 17, 8, 1) + udp
+    assert parse_header(ipv6(44, later))[3:6] == (17, 0, 0)
+
+
+def test_truncated_packets():
+    assert parse_header(b'') is None and parse_header(b'\x00' * 20) is None
+    assert parse_header(ipv4(6, b'')[:19]) is None and parse_header(ipv6(6, b'')[:39]) is None
+    # A header without room for the ports.
+    assert parse_header(ipv4(6, b'\x9c\x40'))[4:6] == (0, 0)
+
+
+def test_checksum_of_odd_length_data():
+    assert checksum(b'\x01') == checksum(b'\x01\x00')
+    assert checksum(b'') == 0xFFFF
+
+
+def test_udp_packet_checksums():
+    packet = ipv4_udp_packet('10.0.0.2', '192.0.2.1', 40000, 53, b'query')
+    assert valid_ipv4(packet)
+    header = parse_header(packet)
+    assert (header.src, header.dst, header.sport, header.dport) == ('10.0.0.2', '192.0.2.1', 40000, 53)
+
+
+def test_rewrite_keeps_checksums_valid():
+    packet = rewrite_ipv4(tcp_syn(1460), src='203.0.113.10', sport=20001)
+    assert valid_ipv4(packet)
+    assert parse_header(packet)[1::3] == ('203.0.113.10', 20001)
+
+
+def test_incremental_checksum_matches_a_full_one():
+    packet = tcp_syn(1460)
+    struct.pack_into('!H', packet, 20 + 14, 1024)
+    adjust_checksum(packet, 20 + 16, 64240, 1024)
+    assert packet == update_checksums(bytearray(packet))
+
+
+def test_clamp_mss():
+    clamped = clamp_mss(tcp_syn(1460), 20, 1360)
+    assert struct.unpack_from('!H', clamped, 20 + 22)[0] == 1360
+    assert valid_ipv4(clamped)
+    assert clamp_mss(tcp_syn(1200), 20, 1360) is None
+
+
+def test_clamp_mss_after_other_options():
+    # NOP, NOP and a timestamp option before the MSS.
+    options = b'\x01\x01' + struct.pack('!BBII', 8, 10, 1, 0)
+    clamped = clamp_mss(tcp_syn(1460, options), 20, 1000)
+    assert struct.unpack_from('!H', clamped, 20 + 20 + len(options) + 2)[0] == 1000
+    assert valid_ipv4(clamped)
+
+
+def test_clamp_mss_without_the_option():
+    packet = tcp_syn(1460)
+    packet[20 + 20] = 0
+    assert clamp_mss(packet, 20, 1000) is None
+    assert clamp_mss(packet[:30], 20, 1000) is None
+
+
+def test_fragmentation_needed():
+    packet = ipv4_udp_packet('10.0.0.2', '192.0.2.1', 40000, 53, b'\x00' * 1400)
+    error = icmp_too_big(packet, parse_header(packet), 1400)
+    assert valid_ipv4(error)
+    header = parse_header(error)
+    assert (header.src, header.dst, header.protocol) == ('192.0.2.1', '10.0.0.2', 1)
+    assert struct.unpack_from('!BBHHH', error, 20)[::4] == (3, 1400)
+    assert error[20 + 1] == 4
+    # The IP header and the first 8 bytes of the packet are quoted.
+    assert error[28:] == packet[:28]
+
+
+def test_packet_too_big():
+    packet = ipv6(17, struct.pack('!HHHH', 40000, 53, 8 + 1500, 0) + b'\x00' * 1500)
+    error = icmp_too_big(packet, parse_header(packet), 1280)
+    assert len(error) == 1280
+    assert struct.unpack_from('!BBHI', error, 40)[::3] == (2, 1280)
+    assert (error[8:24], error[24:40]) == (packet[24:40], packet[8:24])
+    icmp = bytes(error[40:])
+    pseudo = error[8:40] + struct.pack('!I3xB', len(icmp), 58)
+    assert checksum(pseudo + icmp) == 0
+    assert struct.unpack_from('!H', error, 4)[0] == len(icmp)
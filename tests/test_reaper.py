@@ -0,0 +1,80 @@
+import datetime
+
+import pytest
+
+from connection import VPNServer
+from connection.database import open_client
+from connection.database.mongodb import Account, Connection, Network
+from connection.sessions import Session
+
+
+@pytest.fixture
+def server():
+    server = VPNServer(open_client('memory://'), 'test')
+    server.network = Network(server.table_name['networks'])
+    server.network.create('10.8.0.0/24', 50)
+    return server
+
+
+def new_account(server) -> Account:
+    accounts = server.table_name['accounts']
+    username = f'user-{accounts.count_documents({})}'
+    account = Account(accounts, Account(accounts).create(username=username, networks={})['id'])
+    server.network.to_network(account)
+    return account
+
+
+def addresses(server) -> dict:
+    return server.network.get(['connections'])['connections']
+
+
+def connect(server, account: Account, port: int, last_seen: datetime.datetime = None) -> Session:
+    ip_address = addresses(server)[str(account.id)]
+    connections = server.table_name['connections']
+    data = Connection(connections).create(server.network, account, ip_address, ('192.0.2.1', port))
+    if last_seen is not None:
+        connections.update_one({'_id': data['id']}, {'$set': {'last_seen': last_seen}})
+    return Session(data, ('192.0.2.1', port))
+
+
+def test_evict_releases_the_address(server):
+    session = server.sessions.add(connect(server, new_account(server), 1))
+    server.reaper.evict([session])
+    assert addresses(server) == {} and server.reaper.released.value() == 1
+    assert server.table_name['connections'].count_documents({}) == 0
+
+
+def test_evict_keeps_the_address_of_an_account_that_connected_again(server):
+    account = new_account(server)
+    idle, again = connect(server, account, 1), server.sessions.add(connect(server, account, 2))
+    server.reaper.evict([idle])
+    assert addresses(server) == {str(account.id): again.ip_address}
+    assert server.reaper.released.value() == 0
+
+
+def test_evict_keeps_the_address_of_an_account_connected_elsewhere(server):
+    account = new_account(server)
+    idle = server.sessions.add(connect(server, account, 1))
+    connect(server, account, 2)
+    server.reaper.evict([idle])
+    assert str(account.id) in addresses(server)
+
+
+def test_evict_only_releases_the_address_the_session_had(server):
+    account = new_account(server)
+    idle = server.sessions.add(connect(server, account, 1))
+    moved = {'$set': {f'connections.{account.id}': '10.8.0.9'}}
+    server.network.collection.update_one({'_id': server.network.id}, moved)
+    server.reaper.evict([idle])
+    assert addresses(server) == {str(account.id): '10.8.0.9'}
+    assert server.network.get(['released'])['released'] == []
+
+
+def test_sweep_reaps_stale_connections(server):
+    stale = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=server.reaper.stale + 60)
+    crashed, provisioned, live = new_account(server), new_account(server), new_account(server)
+    connect(server, crashed, 1, stale)
+    server.sessions.add(connect(server, live, 2, stale))
+    server.reaper.sweep()
+    assert set(addresses(server)) == {str(provisioned.id), str(live.id)}
+    assert [row['account_id'] for row in server.table_name['connections'].find()] == [live.id]
@@ -0,0 +1,94 @@
+import os
+import socket
+
+import pytest
+
+from connection import VPNServer
+from connection.ciphers import FRAME_CHALLENGE, new_context
+from connection.database import open_client
+from connection.database.mongodb import Account, Connection, Network
+from connection.sessions import Session
+
+
+class Client:
+    # One end of a session, each address is a socket of its own.
+    def __init__(self, data: dict):
+        self.cipher = new_context(data['cipher'], data['encrypt'], initiator=True)
+        self.cipher.attach(bytes.fromhex(data['ticket']))
+        self.sockets = []
+
+    def address(self) -> tuple:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0)), sock.settimeout(1)
+        self.sockets.append(sock)
+        return sock.getsockname()
+
+    def receive(self, address: tuple) -> tuple:
+        return self.cipher.open(next(sock for sock in self.sockets if sock.getsockname() == address).recv(1500))
+
+
+@pytest.fixture
+def server():
+    server = VPNServer(open_client('memory://'), 'test')
+    yield server
+    server.server.close()
+
+
+@pytest.fixture
+def stored(server) -> dict:
+    network = Network(server.table_name['networks'])
+    network.create('10.8.0.0/24', 10)
+    accounts = server.table_name['accounts']
+    account = Account(accounts, Account(accounts).create(username='alice', networks={})['id'])
+    ip_address = network.to_network(account)
+    return Connection(server.table_name['connections']).create(network, account, ip_address, ('192.0.2.1', 1),
+                                                                cipher='chacha20-poly1305')
+
+
+def stored_address(server, data: dict) -> str:
+    return Connection(server.table_name['connections'], data['id']).get(['connection'])['connection']
+
+
+def test_replayed_frames_do_not_move_a_live_session(server, stored):
+    session, client = server.sessions.add(Session(stored, ('192.0.2.1', 1))), Client(stored)
+    old, new = client.cipher.seal(b'old'), client.cipher.seal(b'new')
+    roamed = client.address()
+    assert server.classify((new, roamed)) is session and session.address == roamed
+    # The older frame, or the same one again, from another address.
+    assert server.classify((old, client.address())) is None
+    assert server.classify((new, client.address())) is None
+    assert session.address == roamed and server.roamed.values() == {('memory',): 1}
+
+
+def test_stored_sessions_move_after_the_echoed_nonce(server, stored):
+    client = Client(stored)
+    address = client.address()
+    assert server.load_session(address, client.cipher.seal(b'packet')) is None
+    assert server.sessions.ticket(bytes.fromhex(stored['ticket'])) is None
+    assert stored_address(server, stored) == '192.0.2.1:1'
+    kind, _, nonce = client.receive(address)
+    assert kind == FRAME_CHALLENGE and len(nonce) == 16
+    # Frames sent before the answer get the same nonce again.
+    assert server.load_session(address, client.cipher.seal(b'packet')) is None
+    assert client.receive(address)[2] == nonce
+    session = server.load_session(address, client.cipher.seal(nonce, FRAME_CHALLENGE))
+    assert session.address == address and server.sessions.ticket(session.ticket) is session
+    assert stored_address(server, stored) == ':'.join(map(str, address))
+    assert server.roamed.values() == {('store',): 1} and not server.challenges
+
+
+def test_wrong_nonces_are_refused(server, stored):
+    client = Client(stored)
+    address = client.address()
+    server.load_session(address, client.cipher.seal(b'packet'))
+    challenge = client.sockets[0].recv(1500)
+    nonce = client.cipher.open(challenge)[2]
+    assert server.load_session(address, client.cipher.seal(os.urandom(16), FRAME_CHALLENGE)) is None
+    # Reflecting the sealed challenge does not answer it either.
+    assert server.load_session(address, challenge) is None
+    # Nor does the right nonce from another address, which gets its own.
+    other = client.address()
+    assert server.load_session(other, client.cipher.seal(nonce, FRAME_CHALLENGE)) is None
+    assert client.receive(other)[2] != nonce
+    assert server.sessions.ticket(bytes.fromhex(stored['ticket'])) is None
+    assert stored_address(server, stored) == '192.0.2.1:1'
@@ -0,0 +1,35 @@
+from connection.timers import TimerWheel
+
+
+def wheel(size: int = 8) -> TimerWheel:
+    wheel = TimerWheel(1.0, size)
+    wheel.updated = 0.0
+    return wheel
+
+
+def test_keys_expire_after_their_delay():
+    timers = wheel()
+    timers.schedule('a', 2), timers.schedule('b', 3.5)
+    assert timers.advance(1) == [] and timers.advance(2) == ['a']
+    assert timers.advance(3.9) == [] and timers.advance(4) == ['b'] and len(timers) == 0
+
+
+def test_delays_longer_than_the_wheel():
+    timers = wheel(4)
+    timers.schedule('a', 10)
+    assert [timers.advance(now) for now in range(1, 10)] == [[]] * 9
+    assert timers.advance(10) == ['a']
+
+
+def test_reschedule_and_cancel():
+    timers = wheel()
+    timers.schedule('a', 2), timers.schedule('b', 2)
+    # Scheduling again replaces the previous deadline.
+    timers.schedule('a', 5), timers.cancel('b'), timers.cancel('missing')
+    assert len(timers) == 1 and timers.advance(4) == [] and timers.advance(5) == ['a']
+
+
+def test_short_delays_take_one_tick():
+    timers = wheel()
+    timers.schedule('a', 0)
+    assert timers.advance(0.5) == [] and timers.advance(1) == ['a']